@@ -0,0 +1,239 @@
+"""
+This module implements the bulk operations on the products (/products/bulk).
+
+The body of a bulk request is a JSON array or NDJSON (one JSON value per line,
+with the Content-Type application/x-ndjson). Each row is validated separately:
+the invalid rows are reported in the results and the other rows are written.
+All the rows of a request are written in a single transaction, with one
+statement per batch of rows (executemany) instead of one request per product.
+"""
+
+import json
+from typing import List, Tuple
+
+from fastapi import HTTPException
+from pydantic import TypeAdapter, ValidationError
+from sqlalchemy import delete, insert, select, update
+
+from . import id_allocator, models
+
+# number of values in the IN clauses used to look for existing rows
+BULK_CHUNK_SIZE: int = 1000
+
+
+def chunks(values: list, size: int = BULK_CHUNK_SIZE):
+  for start in range(0, len(values), size):
+    yield values[start:start + size]
+
+
+def parse_body(body: bytes, content_type: str, max_rows: int) -> list:
+  """
+  Return the rows of a JSON array or NDJSON body, which must contain at most
+  max_rows rows
+  """
+  try:
+    if content_type.startswith("application/x-ndjson"):
+      rows = [line for line in body.splitlines() if line.strip()]
+      check_size(rows, max_rows)
+      return [json.loads(line) for line in rows]
+    rows = json.loads(body)
+  except ValueError:
+    raise HTTPException(status_code=400,
+                        detail="Corps de la requête invalide")
+  if not isinstance(rows, list):
+    raise HTTPException(status_code=400,
+                        detail="Le corps de la requête doit être un tableau JSON")
+  check_size(rows, max_rows)
+  return rows
+
+
+def check_size(rows: list, max_rows: int):
+  if len(rows) > max_rows:
+    raise HTTPException(status_code=413,
+                        detail=f"Trop de lignes dans la requête (maximum {max_rows})")
+
+
+def validate_rows(rows: list, schema) -> Tuple[List[tuple], List[dict]]:
+  """
+  Validate each row with the schema. Return the (index, row) pairs of the valid
+  rows and the results of the invalid ones.
+  """
+  adapter = TypeAdapter(schema)
+  valid, results = [], []
+  for index, row in enumerate(rows):
+    try:
+      valid.append((index, adapter.validate_python(row)))
+    except ValidationError as error:
+      detail = "; ".join(".".join(map(str, err["loc"])) + ": " + err["msg"] if err["loc"]
+                         else err["msg"] for err in error.errors())
+      results.append({"index": index, "status": "invalid", "detail": detail})
+  return valid, results
+
+
+# the attributes of a product, except its id
+PRODUCT_FIELDS = ("product_name", "description", "price", "category", "stock")
+
+
+def row_hash(row) -> str:
+  return models.product_hash(row.product_name, row.description, row.price, row.category)
+
+
+async def existing_ids(session, column, ids: list) -> set:
+  """
+  Return the values of the column found among the given ids
+  """
+  found = set()
+  for chunk in chunks(list(set(ids))):
+    query = select(column).where(column.in_(chunk))
+    found.update((await session.execute(query)).scalars())
+  return found
+
+
+async def hash_owners(session, hashes: list) -> dict:
+  """
+  Return the ids of the stored products having one of the given content hashes
+  """
+  owners = {}
+  for chunk in chunks(list(set(hashes))):
+    query = (
+        select(models.Product.content_hash, models.Product.id)
+        .where(models.Product.content_hash.in_(chunk))
+    )
+    owners.update((await session.execute(query)).all())
+  return owners
+
+
+async def write_new_products(session, mappings: List[dict]) -> List[int]:
+  """
+  Insert the products and return their ids
+  """
+  if not mappings:
+    return []
+  await id_allocator.assign_mapping_ids(models.Product, mappings)
+  # one executemany per chunk of rows: the ids are not read back by the insert,
+  # which would need one INSERT per row on the databases without RETURNING
+  for chunk in chunks(mappings):
+    await session.execute(insert(models.Product), chunk)
+  if id_allocator.allocator is not None:
+    return [mapping["id"] for mapping in mappings]
+  # the ids generated by the database are found with the unique content hashes
+  owners = await hash_owners(session, [mapping["content_hash"] for mapping in mappings])
+  return [owners[mapping["content_hash"]] for mapping in mappings]
+
+
+async def add_new_products(session, rows: List[tuple], hashes: List[str],
+                           owners: dict) -> Tuple[List[dict], List[int]]:
+  """
+  Add the products of the rows whose hash is not owned by another product
+  """
+  results, indexes, mappings = [], [], []
+  for (index, row), content_hash in zip(rows, hashes):
+    if content_hash in owners:
+      results.append({"index": index, "status": "conflict", "id": owners[content_hash],
+                      "detail": "Produit déjà existant"})
+      continue
+    # an identical product later in the body is a conflict
+    owners[content_hash] = None
+    indexes.append(index)
+    mappings.append(dict(row.model_dump(include=set(PRODUCT_FIELDS)),
+                         content_hash=content_hash))
+  ids = await write_new_products(session, mappings)
+  results.extend({"index": index, "status": "created", "id": id_}
+                 for index, id_ in zip(indexes, ids))
+  return results, ids
+
+
+async def insert_products(session, rows: List[tuple]) -> Tuple[List[dict], List[int]]:
+  """
+  Add the new products which are not identical to an existing product.
+  Return the results of the rows and the ids of the added products.
+  """
+  hashes = [row_hash(row) for _, row in rows]
+  owners = await hash_owners(session, hashes)
+  return await add_new_products(session, rows, hashes, owners)
+
+
+async def upsert_products(session, rows: List[tuple]) -> Tuple[List[dict], List[int]]:
+  """
+  Update the products having an id (only the provided attributes are changed)
+  and add the products without id.
+  Return the results of the rows and the ids of the written products.
+  """
+  # the current attributes of the products to update, to compute their new hash
+  stored = {}
+  ids = list({row.id for _, row in rows if row.id is not None})
+  for chunk in chunks(ids):
+    query = (
+        select(models.Product.id, models.Product.product_name, models.Product.description,
+               models.Product.price, models.Product.category, models.Product.content_hash)
+        .where(models.Product.id.in_(chunk))
+    )
+    stored.update((product.id, product._asdict()) for product in await session.execute(query))
+
+  def merged(product_id: int, changes: dict) -> Tuple[dict, str]:
+    product = dict(stored[product_id], **changes)
+    return product, models.product_hash(product["product_name"], product["description"],
+                                        product["price"], product["category"])
+
+  results, updates, new_rows, new_hashes = [], [], [], []
+  for index, row in rows:
+    if row.id is None:
+      new_rows.append((index, row))
+      new_hashes.append(row_hash(row))
+    elif row.id not in stored:
+      results.append({"index": index, "status": "not_found", "id": row.id,
+                      "detail": "Produit introuvable"})
+    else:
+      updates.append((index, row.id, row.model_dump(exclude_unset=True, exclude={"id"})))
+
+  owners = await hash_owners(session, new_hashes + [merged(product_id, changes)[1]
+                                                    for _, product_id, changes in updates])
+  mappings = []
+  for index, product_id, changes in updates:
+    # computed again: a previous row of the body can have modified the same product
+    product, new_hash = merged(product_id, changes)
+    if owners.get(new_hash, product_id) != product_id:
+      results.append({"index": index, "status": "conflict", "id": product_id,
+                      "detail": "Produit déjà existant"})
+      continue
+    # the previous hash of the product can be used by another row of the body
+    old_hash = stored[product_id]["content_hash"]
+    if owners.get(old_hash) == product_id:
+      del owners[old_hash]
+    owners[new_hash] = product_id
+    stored[product_id] = dict(product, content_hash=new_hash)
+    mappings.append({"id": product_id, **changes, "content_hash": new_hash})
+    results.append({"index": index, "status": "updated", "id": product_id})
+  for chunk in chunks(mappings):
+    # UPDATE ... WHERE id = ? executed once per group of rows with the same attributes
+    await session.execute(update(models.Product), chunk)
+
+  new_results, ids = await add_new_products(session, new_rows, new_hashes, owners)
+  return results + new_results, [mapping["id"] for mapping in mappings] + ids
+
+
+async def delete_products(session, rows: List[tuple]) -> Tuple[List[dict], List[int]]:
+  """
+  Delete the products with the given ids, except the ordered ones.
+  Return the results of the rows and the ids of the deleted products.
+  """
+  ids = [product_id for _, product_id in rows]
+  found = await existing_ids(session, models.Product.id, ids)
+  # a product appearing in an order cannot be deleted (foreign key of the orderlines)
+  ordered = await existing_ids(session, models.OrderLine.product_id, ids)
+  results, deleted = [], []
+  for index, product_id in rows:
+    if product_id in ordered:
+      results.append({"index": index, "status": "conflict", "id": product_id,
+                      "detail": "Produit présent dans une commande"})
+    elif product_id not in found:
+      results.append({"index": index, "status": "not_found", "id": product_id,
+                      "detail": "Produit introuvable"})
+    else:
+      # an id present twice in the body is deleted once
+      found.discard(product_id)
+      deleted.append(product_id)
+      results.append({"index": index, "status": "deleted", "id": product_id})
+  for chunk in chunks(deleted):
+    await session.execute(delete(models.Product).where(models.Product.id.in_(chunk)))
+  return results, deleted
@@ -0,0 +1,171 @@
+"""
+This module defines the caches of the api:
+- the cache of the responses of the catalog (GET /products). The responses are
+stored by normalized query parameters with their ETag. A generation counter is
+incremented by every write on the products: the entries built by a previous
+generation are not used anymore.
+- the read-through caches of the products, users and orders read by id
+As each worker has its own caches, the entries also expire after a TTL so that
+the writes made by the other workers are seen.
+"""
+
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from .db import get_setting
+
+
+class CatalogCache:
+  """
+  A LRU cache of serialized responses, invalidated by a generation counter
+  """
+
+  def __init__(self, max_entries: int, ttl: float):
+    self.max_entries = max_entries
+    self.ttl = ttl
+    self.generation = 0
+    self.hits = 0
+    self.misses = 0
+    # key -> (generation, expiration time, etag, body)
+    self._entries = OrderedDict()
+
+  def get(self, key: tuple) -> Optional[Tuple[str, bytes]]:
+    """
+    Return the etag and the body cached for the key, None if there is no valid entry
+    """
+    entry = self._entries.get(key)
+    if entry is None:
+      self.misses += 1
+      return None
+    generation, expires_at, etag, body = entry
+    if generation != self.generation or expires_at < time.monotonic():
+      del self._entries[key]
+      self.misses += 1
+      return None
+    self._entries.move_to_end(key)
+    self.hits += 1
+    return etag, body
+
+  def put(self, key: tuple, body: bytes, generation: int) -> str:
+    """
+    Store the body of the response for the key, built from the database when
+    the cache had the given generation, and return its etag
+    """
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    if generation != self.generation:
+      # the products were modified while they were read
+      return etag
+    self._entries[key] = (generation, time.monotonic() + self.ttl, etag, body)
+    self._entries.move_to_end(key)
+    if len(self._entries) > self.max_entries:
+      # remove the least recently used entry
+      self._entries.popitem(last=False)
+    return etag
+
+  def invalidate(self):
+    """
+    To be called after each write on the products
+    """
+    self.generation += 1
+    self._entries.clear()
+
+  def statistics(self) -> dict:
+    return {
+        "size": len(self._entries),
+        "max_size": self.max_entries,
+        "generation": self.generation,
+        "hits": self.hits,
+        "misses": self.misses,
+    }
+
+
+class EntityCache:
+  """
+  A LRU cache with a time to live, storing the entities of one type by id
+  """
+
+  def __init__(self, max_entries: int, ttl: float):
+    self.max_entries = max_entries
+    self.ttl = ttl
+    # incremented by each invalidation, so that a value read from the database
+    # before an invalidation is not stored after it
+    self.generation = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    # id -> (expiration time, value)
+    self._entries = OrderedDict()
+
+  def get(self, key):
+    entry = self._entries.get(key)
+    if entry is None or entry[0] < time.monotonic():
+      if entry is not None:
+        del self._entries[key]
+      self.misses += 1
+      return None
+    self._entries.move_to_end(key)
+    self.hits += 1
+    return entry[1]
+
+  def put(self, key, value, generation: int):
+    """
+    Store the value read from the database when the cache had the given generation
+    """
+    if generation != self.generation:
+      # the entity was modified while it was read
+      return
+    self._entries[key] = (time.monotonic() + self.ttl, value)
+    self._entries.move_to_end(key)
+    if len(self._entries) > self.max_entries:
+      self._entries.popitem(last=False)
+      self.evictions += 1
+
+  def invalidate(self, *keys):
+    """
+    To be called after each write on the entities with the given ids
+    """
+    self.generation += 1
+    for key in keys:
+      self._entries.pop(key, None)
+
+  def statistics(self) -> dict:
+    return {
+        "size": len(self._entries),
+        "max_size": self.max_entries,
+        "hits": self.hits,
+        "misses": self.misses,
+        "evictions": self.evictions,
+    }
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+  """
+  Check if the etag is in the If-None-Match header of the request
+  """
+  if not if_none_match:
+    return False
+  if if_none_match.strip() == "*":
+    return True
+  # the client can send weak etags (W/"...") and several etags separated by commas
+  return etag in {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+
+
+catalog_cache = CatalogCache(int(get_setting("CATALOG_CACHE_SIZE", 1024)),
+                             float(get_setting("CATALOG_CACHE_TTL", 5)))
+
+entity_cache_size = int(get_setting("ENTITY_CACHE_SIZE", 10000))
+entity_cache_ttl = float(get_setting("ENTITY_CACHE_TTL", 30))
+product_cache = EntityCache(entity_cache_size, entity_cache_ttl)
+user_cache = EntityCache(entity_cache_size, entity_cache_ttl)
+order_cache = EntityCache(entity_cache_size, entity_cache_ttl)
+
+
+def cache_statistics() -> dict:
+  return {
+      "catalog": catalog_cache.statistics(),
+      "products": product_cache.statistics(),
+      "users": user_cache.statistics(),
+      "orders": order_cache.statistics(),
+  }
@@ -1,25 +1,414 @@
 """
-This module starts the database
+This module starts the database.
+
+Importing it does not connect to the database: the engine is created by
+start_db, called by the lifespan of the api before it accepts requests.
 """
 
-from sqlalchemy import create_engine
+import asyncio
+import logging
+import os
+import time
+from typing import List, Optional
+
+from sqlalchemy import Double, Float, exc, inspect, make_url, select, text, update
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.schema import CreateColumn
 # Retrieve secrets from .env file
 from dotenv import dotenv_values
 
-from .models import Base
+from metrics import instrument_engine
+
+from . import replicas
+from .models import Base, Product, product_hash
+
 
+logger = logging.getLogger(__name__)
 
 db_config = dotenv_values(".env")  # dictionnary
 
 
-user = db_config["USER"]
-pswd = db_config["PSWD"]
-host = db_config["HOST"]
-port = db_config["PORT"]
-name = db_config["NAME"]
+def get_setting(key: str, default=None):
+  """
+  Read an optional setting, the environment variables override the .env file
+  """
+  return os.environ.get(key, db_config.get(key, default))
+
+
+# the async driver used to reach MySQL (aiomysql or asyncmy)
+driver = get_setting("DRIVER", "mysql+aiomysql")
+
+
+def database_url() -> str:
+  """
+  DATABASE_URL can be set to use another database, for example a local
+  SQLite database: DATABASE_URL=sqlite+aiosqlite:///./local.db
+  """
+  url = get_setting("DATABASE_URL")
+  if url:
+    return url
+  user = db_config["USER"]
+  pswd = db_config["PSWD"]
+  host = db_config["HOST"]
+  port = db_config["PORT"]
+  name = db_config["NAME"]
+  return f"{driver}://{user}:{pswd}@{host}:{port}/{name}"
+
+
+class MonitoredQueuePool(AsyncAdaptedQueuePool):
+  """
+  A queue pool which records how long the requests wait for a connection
+  and how many of them gave up because the pool was exhausted
+  """
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.checkouts = 0
+    self.checkout_timeouts = 0
+    self.total_wait_time = 0.0
+    self.max_wait_time = 0.0
+
+  def connect(self):
+    start = time.perf_counter()
+    try:
+      return super().connect()
+    except exc.TimeoutError:
+      self.checkout_timeouts += 1
+      raise
+    finally:
+      wait_time = time.perf_counter() - start
+      self.checkouts += 1
+      self.total_wait_time += wait_time
+      self.max_wait_time = max(self.max_wait_time, wait_time)
+
+  def statistics(self) -> dict:
+    return {
+        "size": self.size(),
+        "checked_in": self.checkedin(),
+        "checked_out": self.checkedout(),
+        "overflow": self.overflow(),
+        "max_overflow": self._max_overflow,
+        "checkouts": self.checkouts,
+        "checkout_timeouts": self.checkout_timeouts,
+        "total_wait_time": round(self.total_wait_time, 6),
+        "max_wait_time": round(self.max_wait_time, 6),
+        "average_wait_time": round(self.total_wait_time / self.checkouts, 6)
+        if self.checkouts else 0.0,
+    }
+
+
+def pool_options(url: str) -> dict:
+  """
+  Build the pool arguments of the engine from the settings
+  """
+  options = {
+      "pool_pre_ping": get_setting("POOL_PRE_PING", "false").lower() == "true",
+      "pool_recycle": int(get_setting("POOL_RECYCLE", -1)),
+  }
+  url = make_url(url)
+  if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+    # an in memory SQLite database only lives in a single connection
+    return options
+  options.update({
+      "poolclass": MonitoredQueuePool,
+      "pool_size": int(get_setting("POOL_SIZE", 5)),
+      "max_overflow": int(get_setting("POOL_MAX_OVERFLOW", 10)),
+      "pool_timeout": float(get_setting("POOL_TIMEOUT", 30)),
+  })
+  return options
+
+
+# the queries lasting more than SLOW_QUERY_THRESHOLD seconds are logged
+SLOW_QUERY_THRESHOLD: float = float(get_setting("SLOW_QUERY_THRESHOLD", 0.5))
+
+
+# number of connections opened at startup, so that the first requests do not
+# wait for them (POOL_SIZE by default)
+POOL_WARM_UP: Optional[str] = get_setting("POOL_WARM_UP")
+
+# the read replicas used by the GET requests (comma separated database URLs, see replicas.py)
+REPLICA_URLS: List[str] = [url.strip() for url in get_setting("REPLICA_URLS", "").split(",")
+                           if url.strip()]
+# seconds between two health checks of the replicas
+REPLICA_CHECK_INTERVAL: float = float(get_setting("REPLICA_CHECK_INTERVAL", 10))
+
+# created by get_engine
+engine: Optional[AsyncEngine] = None
+# the sessions are bound to the engine when it is created.
+# expire_on_commit=False keeps the loaded attributes usable after a commit
+# (an async session cannot lazy load them again)
+async_session = async_sessionmaker(sync_session_class=replicas.RoutingSession,
+                                   expire_on_commit=False)
+
+
+def create_engine(url: str) -> AsyncEngine:
+  new_engine = create_async_engine(url, **pool_options(url))
+  # count the SQL queries of each request (see GET /metrics), log the slow
+  # queries and record the queries of the traced requests (see query_trace.py)
+  instrument_engine(new_engine, SLOW_QUERY_THRESHOLD)
+  return new_engine
+
+
+def get_engine() -> AsyncEngine:
+  """
+  Return the engine of the database, created at the first call (no connection
+  is opened before the first query). The engines of the replicas are created
+  at the same time.
+  """
+  global engine
+  if engine is None:
+    engine = create_engine(database_url())
+    async_session.configure(bind=engine)
+    if REPLICA_URLS:
+      replicas.replica_set = replicas.ReplicaSet([create_engine(url) for url in REPLICA_URLS])
+  return engine
+
+
+async def warm_up_pool(size: Optional[int] = None):
+  """
+  Open size connections (POOL_WARM_UP, or the size of the pool by default),
+  each one with a first query, so that the first requests do not wait for them
+  """
+  engine = get_engine()
+  if size is None:
+    size = (int(POOL_WARM_UP) if POOL_WARM_UP is not None
+            else getattr(engine.pool, "size", lambda: 1)())
+  opened = 0
+  all_opened = asyncio.Event()
+
+  async def connect():
+    nonlocal opened
+    try:
+      async with engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+        opened += 1
+        if opened == size:
+          all_opened.set()
+        # keep the connection until all are open, otherwise the same one is reused
+        await all_opened.wait()
+    finally:
+      # a failed connection does not block the others
+      all_opened.set()
+
+  await asyncio.gather(*(connect() for _ in range(size)))
+
+
+async def stop_db():
+  """
+  Close the connections of the engine, which is created again at the next use
+  """
+  global engine
+  if engine is not None:
+    await engine.dispose()
+    engine = None
+  if replicas.replica_set is not None:
+    await replicas.replica_set.dispose()
+    replicas.replica_set = None
+
+
+def pool_statistics() -> dict:
+  """
+  Return the state of the connection pools of the engine and of the replicas
+  """
+  statistics = engine_pool_statistics(get_engine())
+  if replicas.replica_set is not None:
+    statistics["replicas"] = [
+        dict(replica.statistics(), pool=engine_pool_statistics(replica.engine))
+        for replica in replicas.replica_set.replicas
+    ]
+  return statistics
+
+
+def engine_pool_statistics(engine: AsyncEngine) -> dict:
+  pool = engine.pool
+  if isinstance(pool, MonitoredQueuePool):
+    return pool.statistics()
+  return {"status": pool.status()}
+
+
+def missing_columns(conn) -> list:
+  """
+  Return the columns declared on the models which do not exist in the database
+  (create_all does not modify the existing tables)
+  """
+  inspector = inspect(conn)
+  columns = []
+  for table in Base.metadata.sorted_tables:
+    existing = {column["name"] for column in inspector.get_columns(table.name)}
+    columns.extend(column for column in table.columns if column.name not in existing)
+  return columns
+
+
+async def add_missing_columns():
+  """
+  Add the missing columns to an existing database. Only nullable columns can be
+  added this way: the existing rows have no value for them.
+  """
+  async with get_engine().begin() as conn:
+    columns = await conn.run_sync(missing_columns)
+    for column in columns:
+      preparer = conn.dialect.identifier_preparer
+      definition = CreateColumn(column).compile(dialect=conn.dialect)
+      await conn.execute(text(f"ALTER TABLE {preparer.format_table(column.table)} "
+                              f"ADD COLUMN {definition}"))
+      logger.info("Column %s.%s added", column.table.name, column.name)
+
+
+def single_precision_columns(conn) -> list:
+  """
+  Return the columns declared as Double on the models which are stored as a
+  single precision FLOAT (MySQL databases created before)
+  """
+  if conn.dialect.name != "mysql":
+    # SQLite stores all the floats in double precision
+    return []
+  inspector = inspect(conn)
+  columns = []
+  for table in Base.metadata.sorted_tables:
+    existing = {column["name"]: column["type"] for column in inspector.get_columns(table.name)}
+    columns.extend(column for column in table.columns
+                   if isinstance(column.type, Double) and column.name in existing
+                   and isinstance(existing[column.name], Float)
+                   and not isinstance(existing[column.name], Double))
+  return columns
+
+
+async def widen_float_columns():
+  """
+  Store the Double columns of an existing database in double precision
+  """
+  async with get_engine().begin() as conn:
+    columns = await conn.run_sync(single_precision_columns)
+    for column in columns:
+      preparer = conn.dialect.identifier_preparer
+      definition = CreateColumn(column).compile(dialect=conn.dialect)
+      await conn.execute(text(f"ALTER TABLE {preparer.format_table(column.table)} "
+                              f"MODIFY {definition}"))
+      logger.info("Column %s.%s stored in double precision", column.table.name, column.name)
+
+
+async def fill_content_hashes(batch_size: int = 1000):
+  """
+  Compute the content hash of the products stored before this column existed
+  """
+  last_id = 0
+  async with async_session() as session:
+    while True:
+      query = (
+          select(Product.id, Product.product_name, Product.description,
+                 Product.price, Product.category)
+          .where(Product.content_hash.is_(None), Product.id > last_id)
+          .order_by(Product.id)
+          .limit(batch_size)
+      )
+      rows = (await session.execute(query)).all()
+      if not rows:
+        return
+      last_id = rows[-1].id
+      hashes = {row.id: product_hash(*row[1:]) for row in rows}
+      try:
+        await session.execute(update(Product), [
+            {"id": id_, "content_hash": hash_} for id_, hash_ in hashes.items()
+        ])
+        await session.commit()
+      except exc.IntegrityError:
+        # the unique index already exists and identical products have the same hash
+        await session.rollback()
+        await fill_distinct_hashes(session, hashes)
+
+
+async def fill_distinct_hashes(session, hashes: dict):
+  """
+  Fill the hashes (product id -> hash) which are not already used by another
+  product, and log the ids of the identical products, whose hash stays empty
+  """
+  query = (
+      select(Product.content_hash, Product.id)
+      .where(Product.content_hash.in_(set(hashes.values())))
+  )
+  owners = dict((await session.execute(query)).all())
+  mappings = []
+  identical = []
+  for id_, hash_ in hashes.items():
+    if hash_ in owners:
+      identical.append((id_, owners[hash_]))
+    else:
+      owners[hash_] = id_
+      mappings.append({"id": id_, "content_hash": hash_})
+  if mappings:
+    await session.execute(update(Product), mappings)
+    await session.commit()
+  logger.error("The content hash of %d products cannot be filled, they are identical to "
+               "other products (id, id of the identical product): %s",
+               len(identical), identical)
+
+
+def is_covered(index, existing: list) -> bool:
+  """
+  Tell whether a non unique index is useless: its columns start an existing
+  index, for example the index that MySQL creates for a foreign key
+  """
+  columns = [column.name for column in index.columns]
+  return not index.unique and any(
+      other["column_names"][:len(columns)] == columns for other in existing)
+
+
+def missing_indexes(conn) -> list:
+  """
+  Return the indexes declared on the models which do not exist in the database
+  (create_all only creates the indexes of the new tables)
+  """
+  inspector = inspect(conn)
+  indexes = []
+  for table in Base.metadata.sorted_tables:
+    existing = inspector.get_indexes(table.name)
+    names = {index["name"] for index in existing}
+    indexes.extend(index for index in table.indexes
+                   if index.name not in names and not is_covered(index, existing))
+  return indexes
+
+
+async def create_missing_indexes():
+  """
+  Add the missing indexes to an existing database
+  """
+  async with get_engine().connect() as conn:
+    indexes = await conn.run_sync(missing_indexes)
+  for index in indexes:
+    try:
+      # each index in its own transaction: one failure does not cancel the others
+      async with get_engine().begin() as conn:
+        await conn.run_sync(index.create)
+      logger.info("Index %s created", index.name)
+    except exc.SQLAlchemyError as error:
+      # for example a unique index on a column which contains duplicates
+      logger.error("Index %s cannot be created: %s", index.name, error)
+
+
+async def init_db():
+  """
+  Create the tables and the schema
+  """
+  async with get_engine().begin() as conn:
+    await conn.run_sync(Base.metadata.create_all)
+  await add_missing_columns()
+  await widen_float_columns()
+  # before the creation of the unique index on the hashes
+  await fill_content_hashes()
+  await create_missing_indexes()
 
-DATABASE_URL = f"mysql://{user}:{pswd}@{host}:{port}/{name}"
 
-engine = create_engine(DATABASE_URL)
-# create the table and the schema
-Base.metadata.create_all(engine)
+async def start_db():
+  """
+  Create the engine, check the schema of the database and open the connections
+  of the pool
+  """
+  start = time.perf_counter()
+  get_engine()
+  await init_db()
+  await warm_up_pool()
+  if replicas.replica_set is not None:
+    # eject the replicas which cannot be reached
+    await replicas.replica_set.check()
+  logger.info("Database started in %.3f s", time.perf_counter() - start)
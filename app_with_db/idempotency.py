@@ -0,0 +1,97 @@
+"""
+This module implements the Idempotency-Key header of POST /admin/orders.
+
+The response of a request sent with an Idempotency-Key header is stored in the
+idempotency_keys table, in the same transaction as the order it created. When
+the client sends the request again with the same key (for example after a
+timeout), the stored response is returned and no new order is created.
+The keys expire after IDEMPOTENCY_TTL seconds (24 hours by default).
+"""
+
+import asyncio
+import hashlib
+import logging
+import time
+from typing import Optional
+
+from fastapi import HTTPException, Response
+from pydantic import BaseModel
+from sqlalchemy import delete, exc
+
+from . import models
+from .db import async_session, get_setting
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_TTL: float = float(get_setting("IDEMPOTENCY_TTL", 24 * 3600))
+# seconds between two deletions of the expired keys
+IDEMPOTENCY_PURGE_INTERVAL: float = float(get_setting("IDEMPOTENCY_PURGE_INTERVAL", 3600))
+
+
+def check_key(key: str):
+  if len(key) > models.MAX_STRING_LENGTH:
+    raise HTTPException(
+        status_code=400,
+        detail=f"Idempotency-Key header must have at most {models.MAX_STRING_LENGTH} characters"
+    )
+
+
+def fingerprint(request_body: BaseModel) -> str:
+  """
+  Identify the body of a request, to detect a key used for two different requests
+  """
+  return hashlib.sha256(request_body.model_dump_json().encode()).hexdigest()
+
+
+async def stored_response(session, key: str, request_fingerprint: str) -> Optional[Response]:
+  """
+  Return the stored response of the request sent with the key, None if there is none
+  """
+  stored = await session.get(models.IdempotencyKey, key)
+  if stored is None or stored.expires_at < time.time():
+    return None
+  if stored.fingerprint != request_fingerprint:
+    raise HTTPException(status_code=422,
+                        detail="Clé d'idempotence déjà utilisée pour une autre requête")
+  return Response(stored.body, status_code=stored.status_code,
+                  media_type="application/json", headers={"Idempotent-Replayed": "true"})
+
+
+async def remember(session, key: str, request_fingerprint: str, status_code: int, body: str):
+  """
+  Store the response in the transaction of the session. If another request with
+  the same key is committed first, the commit raises an IntegrityError.
+  """
+  # an expired key can be used again
+  await session.execute(
+      delete(models.IdempotencyKey)
+      .where(models.IdempotencyKey.key == key,
+             models.IdempotencyKey.expires_at < time.time())
+  )
+  session.add(models.IdempotencyKey(key=key,
+                                    fingerprint=request_fingerprint,
+                                    status_code=status_code,
+                                    body=body,
+                                    expires_at=time.time() + IDEMPOTENCY_TTL,
+                                    ))
+
+
+async def purge_expired_keys():
+  async with async_session() as session:
+    query = delete(models.IdempotencyKey).where(models.IdempotencyKey.expires_at < time.time())
+    rows_affected = (await session.execute(query)).rowcount
+    await session.commit()
+  if rows_affected:
+    logger.info("%s expired idempotency keys deleted", rows_affected)
+
+
+async def purge_expired_keys_periodically():
+  """
+  Delete the expired keys every IDEMPOTENCY_PURGE_INTERVAL seconds, until cancelled
+  """
+  while True:
+    try:
+      await purge_expired_keys()
+    except exc.SQLAlchemyError as error:
+      logger.error("The expired idempotency keys cannot be deleted: %s", error)
+    await asyncio.sleep(IDEMPOTENCY_PURGE_INTERVAL)
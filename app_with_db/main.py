@@ -1,18 +1,74 @@
 # imports for API operation
-from fastapi import FastAPI, HTTPException
-from sqlalchemy.orm import Session
-from sqlalchemy import select, insert, update, delete, exc, func
-from typing import List
-
-from . import models, schemas
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Header, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from typing import List, Optional
+from sqlalchemy import select, insert, update, delete, exc
+from sqlalchemy.orm import selectinload
+
+from cursor_pagination import DEFAULT_PAGE_SIZE
+from metrics import MetricsMiddleware, metrics_response
+
+from . import bulk, idempotency, models, replicas, schemas
 from .schemas import ErrorMessage
-from .db import engine
+from .cache import (
+    catalog_cache, etag_matches, cache_statistics,
+    product_cache, user_cache, order_cache,
+)
+from .db import (
+    REPLICA_CHECK_INTERVAL, async_session, get_setting, pool_statistics, start_db, stop_db,
+)
+from .id_allocator import assign_ids, assign_mapping_ids
+from .pagination import paginate
+from .query_trace import QueryTraceMiddleware
+from .serialization import (
+    FastJSONResponse, dumps, fast_response,
+    product_to_dict, user_to_dict, order_to_dict,
+)
+
+
+# number of rows read at once from the database by the export endpoints
+EXPORT_BATCH_SIZE: int = 1000
+# maximum number of rows in the body of a bulk request (the rows and their
+# results are kept in memory, and written in a single transaction)
+BULK_MAX_ROWS: int = int(get_setting("BULK_MAX_ROWS", 200000))
+
+# when enabled, the rows read from the database are encoded directly in JSON
+# (with orjson) instead of being validated again by the Pydantic schemas
+FAST_JSON: bool = get_setting("FAST_JSON", "false").lower() == "true"
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+  """
+  Connect to the database and create the tables before the api server accepts
+  requests, and close the connections when it stops
+  """
+  await start_db()
+  tasks = [asyncio.create_task(idempotency.purge_expired_keys_periodically())]
+  if replicas.replica_set is not None:
+    tasks.append(asyncio.create_task(
+        replicas.replica_set.check_periodically(REPLICA_CHECK_INTERVAL)))
+  yield
+  for task in tasks:
+    task.cancel()
+  await stop_db()
 
 
 """
 Start the api server
 """
-app = FastAPI()
+app = FastAPI(lifespan=lifespan,
+              default_response_class=FastJSONResponse if FAST_JSON else JSONResponse)
+# the last middleware added runs first
+# trace the SQL queries on demand (X-Query-Trace header)
+app.add_middleware(QueryTraceMiddleware)
+# send the reads of the GET requests to the replicas (REPLICA_URLS)
+app.add_middleware(replicas.ReplicaReadsMiddleware)
+# count the requests, their latency and their SQL queries (see GET /metrics):
+# outermost, it gives its statistics to the other middlewares
+app.add_middleware(MetricsMiddleware)
 
 """
 Define all endpoints relative to products below
@@ -25,8 +81,12 @@ async def welcome():
 
 
 @app.get("/products",
-         description="Retourne un tableau JSON contenant les produits avec leurs détails",
+         description="Retourne un tableau JSON contenant les produits avec leurs détails. "
+         "Le résultat est paginé: passer le curseur next de la réponse dans le paramètre "
+         "cursor pour obtenir la page suivante",
          response_description="	Liste des produits",
+         response_model=schemas.Page[schemas.Product],
+         responses={304: {"description": "Liste des produits inchangée (If-None-Match)"}},
          )
 # example of product_name parameter usage:
 # http://127.0.0.1:8000/products?product_name=Cafe Gourmet
@@ -36,25 +96,48 @@ async def get_all_products(product_name: str = "",
                            min_stock: int = 0,
                            min_price: float = 0,
                            max_price: float = float('inf'),
-                           ) -> List[schemas.Product]:
-  # start a session to make requests to the database
-  with Session(engine) as session:
-    try:
-      if max_price < min_price:
-        raise HTTPException(
-            status_code=400,
-            detail="max_price parameter must be superior than min_price"
-        )
-      if max_price < 0 or min_price < 0:
-        raise HTTPException(
-            status_code=400,
-            detail="Prices must be positive"
-        )
-      if min_stock < 0:
-        raise HTTPException(
-            status_code=400,
-            detail="Stock parameter must be positive"
-        )
+                           sort: str = "id",
+                           limit: int = DEFAULT_PAGE_SIZE,
+                           cursor: str = "",
+                           if_none_match: Optional[str] = Header(default=None),
+                           ) -> Response:
+  if max_price < min_price:
+    raise HTTPException(
+        status_code=400,
+        detail="max_price parameter must be superior than min_price"
+    )
+  if max_price < 0 or min_price < 0:
+    raise HTTPException(
+        status_code=400,
+        detail="Prices must be positive"
+    )
+  if min_stock < 0:
+    raise HTTPException(
+        status_code=400,
+        detail="Stock parameter must be positive"
+    )
+  if sort not in ("id", "price"):
+    raise HTTPException(
+        status_code=400,
+        detail="sort parameter must be id or price"
+    )
+  """ Answer from the cache if the same request was already made  """
+  # the key is built from the parsed parameters: "10" and "10.0" give the same key
+  cache_key = (product_name, product_category, min_stock, min_price, max_price,
+               sort, limit, cursor)
+  cached = catalog_cache.get(cache_key)
+  if cached is not None:
+    etag, body = cached
+    if etag_matches(if_none_match, etag):
+      return Response(status_code=304, headers={"ETag": etag})
+    return Response(body, media_type="application/json", headers={"ETag": etag})
+
+  generation = catalog_cache.generation
+  # the page is cached: it is read from the primary (a lagging replica could
+  # return the rows of before a write, cached as current)
+  with replicas.primary_reads():
+    # start a session to make requests to the database
+    async with async_session() as session:
       query = select(models.Product)
       if product_name:
         query = query.where(models.Product.product_name == product_name)
@@ -64,11 +147,128 @@ async def get_all_products(product_name: str = "",
       query = query.where(models.Product.price >= min_price)
       query = query.where(models.Product.price <= max_price)
 
-      return session.execute(query).scalars().all()
-    # manage error in case no product was found
-    except exc.NoResultFound:
-      # no product found in the db
-      return {}
+      # the id makes the sort key unique when sorting on the price
+      keys = [models.Product.id]
+      if sort == "price":
+        keys = [models.Product.price, models.Product.id]
+      products, next_cursor = await paginate(session, query, keys, limit, cursor)
+  if FAST_JSON:
+    body = dumps({"items": [product_to_dict(product) for product in products],
+                  "next": next_cursor})
+  else:
+    page = schemas.Page[schemas.Product].model_validate({"items": products, "next": next_cursor},
+                                                        from_attributes=True)
+    body = page.model_dump_json().encode()
+  etag = catalog_cache.put(cache_key, body, generation)
+  if etag_matches(if_none_match, etag):
+    return Response(status_code=304, headers={"ETag": etag})
+  return Response(body, media_type="application/json", headers={"ETag": etag})
+
+
+async def export_products():
+  """
+  Yield the products as NDJSON (one JSON object per line), one batch at a time
+  """
+  # the session is opened here and not in the endpoint because it must stay
+  # open until the whole response is sent
+  async with async_session() as session:
+    query = (
+        select(models.Product)
+        .order_by(models.Product.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    # stream uses a server side cursor: only one batch of rows is in memory
+    result = await session.stream(query)
+    async for products in result.scalars().partitions():
+      if FAST_JSON:
+        yield b"".join(dumps(product_to_dict(product)) + b"\n" for product in products)
+        continue
+      yield "".join(
+          schemas.Product.model_validate(product, from_attributes=True).model_dump_json() + "\n"
+          for product in products
+      )
+
+
+@app.get("/products/export",
+         description="Exporte tous les produits au format NDJSON (un objet JSON par ligne)",
+         response_description="Flux NDJSON des produits",
+         response_class=StreamingResponse,
+         )
+async def get_products_export():
+  return StreamingResponse(export_products(), media_type="application/x-ndjson")
+
+
+# the errors of the bulk endpoints, besides the results of the rows
+BULK_RESPONSES = {400: {"model": ErrorMessage, "description": "Corps de la requête invalide"},
+                  413: {"model": ErrorMessage, "description": "Trop de lignes dans la requête"}}
+
+
+def bulk_body(schema) -> dict:
+  """
+  Document the body of a bulk endpoint, which is read from the request
+  so that each row is validated separately
+  """
+  array = {"type": "array", "items": schema}
+  return {"requestBody": {"required": True, "content": {
+      "application/json": {"schema": array},
+      "application/x-ndjson": {"schema": array},
+  }}}
+
+
+async def run_bulk(request: Request, schema, operation) -> List[dict]:
+  """
+  Validate the rows of the body and write the valid ones in a single transaction
+  """
+  rows = bulk.parse_body(await request.body(), request.headers.get("content-type", ""),
+                         BULK_MAX_ROWS)
+  rows, results = bulk.validate_rows(rows, schema)
+  async with async_session() as session:
+    try:
+      operation_results, product_ids = await operation(session, rows)
+      await session.commit()
+    except exc.IntegrityError:
+      # a concurrent request added an identical product: nothing was written
+      raise HTTPException(status_code=409,
+                          detail="Conflit avec une autre modification des produits")
+  if product_ids:
+    catalog_cache.invalidate()
+    product_cache.invalidate(*product_ids)
+  results.extend(operation_results)
+  results.sort(key=lambda result: result["index"])
+  return results
+
+
+@app.post("/products/bulk",
+          description="Ajouter plusieurs produits en une requête (tableau JSON ou NDJSON). "
+          "Les produits identiques à un produit existant ne sont pas ajoutés",
+          response_description="Résultat de chaque ligne",
+          openapi_extra=bulk_body(schemas.ProductBase.model_json_schema()),
+          responses=BULK_RESPONSES,
+          )
+async def add_products(request: Request) -> List[schemas.BulkResult]:
+  return await run_bulk(request, schemas.ProductBase, bulk.insert_products)
+
+
+@app.put("/products/bulk",
+         description="Modifier les produits ayant un id (seuls les attributs fournis sont "
+         "modifiés) et ajouter les autres (tableau JSON ou NDJSON)",
+         response_description="Résultat de chaque ligne",
+         openapi_extra=bulk_body(schemas.BulkProduct.model_json_schema()),
+         responses=BULK_RESPONSES,
+         )
+async def upsert_products(request: Request) -> List[schemas.BulkResult]:
+  return await run_bulk(request, schemas.BulkProduct, bulk.upsert_products)
+
+
+@app.delete("/products/bulk",
+            description="Supprimer plusieurs produits à partir de leurs ids "
+            "(tableau JSON ou NDJSON)",
+            response_description="Résultat de chaque ligne",
+            openapi_extra=bulk_body({"type": "integer"}),
+            responses=BULK_RESPONSES,
+            )
+async def delete_products(request: Request) -> List[schemas.BulkResult]:
+  return await run_bulk(request, int, bulk.delete_products)
 
 
 @app.get("/products/{product_id}",
@@ -78,18 +278,26 @@ async def get_all_products(product_name: str = "",
                           "description": "Produit introuvable"}},
          )
 async def get_product_by_id(product_id: int) -> schemas.Product:
-  with Session(engine) as session:
-    try:
-      """ Search the product in the database with its id  """
-      query = (
-          select(models.Product)
-          .where(models.Product.id == product_id)
-      )
-      product = session.execute(query).scalar_one()
-    # manage error in case no product was found
-    except exc.NoResultFound:
-      raise HTTPException(status_code=404,
-                          detail="Produit introuvable")
+  product = product_cache.get(product_id)
+  if product is not None:
+    return product
+  generation = product_cache.generation
+  # cached: read from the primary (see get_all_products)
+  with replicas.primary_reads():
+    async with async_session() as session:
+      try:
+        """ Search the product in the database with its id  """
+        query = (
+            select(models.Product)
+            .where(models.Product.id == product_id)
+        )
+        product = (await session.execute(query)).scalar_one()
+      # manage error in case no product was found
+      except exc.NoResultFound:
+        raise HTTPException(status_code=404,
+                            detail="Produit introuvable")
+  product = schemas.Product.model_validate(product, from_attributes=True)
+  product_cache.put(product_id, product, generation)
   return product
 
 
@@ -103,60 +311,42 @@ async def get_product_by_id(product_id: int) -> schemas.Product:
                            "description": "Produit déjà existant"}},
           )
 async def add_product(new_product: schemas.ProductBase) -> schemas.Product:
-  with Session(engine) as session:
+  async with async_session() as session:
+    """ Add the product to the database  """
+    # create a product model compatible with SQLAlchemy using the models module
+    db_product = models.Product(product_name=new_product.product_name,
+                                description=new_product.description,
+                                price=new_product.price,
+                                category=new_product.category,
+                                stock=new_product.stock,
+                                content_hash=models.product_hash(new_product.product_name,
+                                                                 new_product.description,
+                                                                 new_product.price,
+                                                                 new_product.category),
+                                )
+    await assign_ids(models.Product, [db_product])
+    session.add(db_product)
     try:
-      """
-      Check that the product is not already in the database
-      """
-      query = (
-          select(models.Product)
-          .where(models.Product.product_name == new_product.product_name,
-                 models.Product.description == new_product.description,
-                 models.Product.price == new_product.price,
-                 models.Product.category == new_product.category,
-                 models.Product.stock == new_product.stock,
-                 )
-      )
-      # WARNING: KEEP the .scalar_one() to raise the exception
-      session.execute(query).scalar_one()
+      # commit to register in the database, the flush sets the id of the product
+      await session.commit()
+    except exc.IntegrityError:
+      # an identical product exists (unique index on the content hash)
       raise HTTPException(status_code=409,
                           detail="Produit déjà existant")
-    except exc.NoResultFound:
-      """ Add the product to the database  """
-      # create a product model compatible with SQLAlchemy using the models module
-      max_id_query = select(func.max(models.Product.id))
-      max_id = session.execute(max_id_query).scalar_one()
-      db_product = models.Product(id=max_id + 1,
-                                  product_name=new_product.product_name,
-                                  description=new_product.description,
-                                  price=new_product.price,
-                                  category=new_product.category,
-                                  stock=new_product.stock,
-                                  )
-      session.add(db_product)
-      # commit to register in the database
-      session.commit()
-      """ Retrieve the product and its id in the database  """
-      query = (
-          select(models.Product)
-          .where(models.Product.product_name == new_product.product_name,
-                 models.Product.description == new_product.description,
-                 models.Product.price == new_product.price,
-                 models.Product.category == new_product.category,
-                 models.Product.stock == new_product.stock,
-                 )
-      )
-      return session.execute(query).scalar_one()
+    catalog_cache.invalidate()
+    return db_product
 
 
 @app.put("/products/{product_id}",
          description="Modifier un produit existant",
          response_description="Produit mis à jour",
          responses={404: {"model": ErrorMessage,
-                          "description": "Produit introuvable"}},
+                          "description": "Produit introuvable"},
+                    409: {"model": ErrorMessage,
+                          "description": "Produit déjà existant"}},
          )
 async def modify_product(product_id: int, new_product: schemas.ProductBase) -> schemas.Product:
-  with Session(engine) as session:
+  async with async_session() as session:
     """ Search the given product in the database with its name  """
     query = (
         update(models.Product)
@@ -166,26 +356,32 @@ async def modify_product(product_id: int, new_product: schemas.ProductBase) -> s
                 price=new_product.price,
                 category=new_product.category,
                 stock=new_product.stock,
+                content_hash=models.product_hash(new_product.product_name,
+                                                 new_product.description,
+                                                 new_product.price,
+                                                 new_product.category),
                 )
     )
-    rows_affected = session.execute(query).rowcount
+    try:
+      rows_affected = (await session.execute(query)).rowcount
+    except exc.IntegrityError:
+      # the product would become identical to another product
+      raise HTTPException(status_code=409,
+                          detail="Produit déjà existant")
     if rows_affected == 0:
       # no row was changed
       raise HTTPException(status_code=404,
                           detail="Produit introuvable")
     # Do not forget to save changes in the database
-    session.commit()
-    """ Retrieve the product and its id in the database  """
+    await session.commit()
+    catalog_cache.invalidate()
+    product_cache.invalidate(product_id)
+    """ Retrieve the product in the database with its id  """
     query = (
         select(models.Product)
-        .where(models.Product.product_name == new_product.product_name,
-               models.Product.description == new_product.description,
-               models.Product.price == new_product.price,
-               models.Product.category == new_product.category,
-               models.Product.stock == new_product.stock,
-               )
+        .where(models.Product.id == product_id)
     )
-    return session.execute(query).scalar_one()
+    return (await session.execute(query)).scalar_one()
 
 
 @app.delete("/products/{product_id}",
@@ -196,20 +392,22 @@ async def modify_product(product_id: int, new_product: schemas.ProductBase) -> s
                              "description": "Produit introuvable"}},
             )
 async def delete_product(product_id: int):
-  with Session(engine) as session:
+  async with async_session() as session:
     """ Search the given product in the database with its name  """
     query = (
         delete(models.Product)
         .where(models.Product.id == product_id)
     )
-    rows_affected = session.execute(query).rowcount
+    rows_affected = (await session.execute(query)).rowcount
     if rows_affected == 0:
       # no row was changed
       raise HTTPException(status_code=404,
                           detail="Produit introuvable")
 
     # Do not forget to save changes in the database
-    session.commit()
+    await session.commit()
+    catalog_cache.invalidate()
+    product_cache.invalidate(product_id)
 
 
 """
@@ -218,34 +416,31 @@ Define all endpoints relative to users below
 
 
 @app.get("/admin/users",
-         description="Retourne un tableau JSON contenant les utilisateurs avec leurs détails",
+         description="Retourne un tableau JSON contenant les utilisateurs avec leurs détails. "
+         "Le résultat est paginé: passer le curseur next de la réponse dans le paramètre "
+         "cursor pour obtenir la page suivante",
          response_description="	Liste des utilisateurs",
          )
-async def get_all_users(username: str = "", email: str = "") -> List[schemas.User]:
+async def get_all_users(username: str = "",
+                        email: str = "",
+                        limit: int = DEFAULT_PAGE_SIZE,
+                        cursor: str = "",
+                        ) -> schemas.Page[schemas.User]:
   # start a session to make requests to the database
-  with Session(engine) as session:
-    try:
-      if username:
-        """ Retrieve all elements of name "name" if the name parameter is declared  """
-        query = (
-            select(models.User)
-            .where(models.User.username == username)
-        )
-        return [session.execute(query).scalar_one()]
-      elif email:
-        """ Retrieve all elements of email "email" if the email parameter is declared  """
-        query = (
-            select(models.User)
-            .where(models.User.email == email)
-        )
-        return [session.execute(query).scalar_one()]
-      else:
-        """ Retrieve all users if no parameter is declared  """
-        query = select(models.User)
-        return session.execute(query).scalars().all()
-    # manage error in case no user was found
-    except exc.NoResultFound:
-      return {}
+  async with async_session() as session:
+    query = select(models.User)
+    if username:
+      """ Retrieve all elements of name "name" if the name parameter is declared  """
+      query = query.where(models.User.username == username)
+    if email:
+      """ Retrieve all elements of email "email" if the email parameter is declared  """
+      query = query.where(models.User.email == email)
+    users, next_cursor = await paginate(session, query, [models.User.id], limit, cursor)
+    if FAST_JSON:
+      # returning a response skips the validation of the users by FastAPI
+      return fast_response({"items": [user_to_dict(user) for user in users],
+                            "next": next_cursor})
+    return {"items": users, "next": next_cursor}
 
 
 @app.get("/admin/users/{user_id}",
@@ -255,18 +450,26 @@ async def get_all_users(username: str = "", email: str = "") -> List[schemas.Use
                           "description": "Utilisateur introuvable"}},
          )
 async def get_user_by_id(user_id: int) -> schemas.User:
-  with Session(engine) as session:
-    try:
-      """ Search the user in the database with its id  """
-      query = (
-          select(models.User)
-          .where(models.User.id == user_id)
-      )
-      user = session.execute(query).scalar_one()
-    # manage error in case no user was found
-    except exc.NoResultFound:
-      raise HTTPException(status_code=404,
-                          detail="Utilisateur introuvable")
+  user = user_cache.get(user_id)
+  if user is not None:
+    return user
+  generation = user_cache.generation
+  # cached: read from the primary (see get_all_products)
+  with replicas.primary_reads():
+    async with async_session() as session:
+      try:
+        """ Search the user in the database with its id  """
+        query = (
+            select(models.User)
+            .where(models.User.id == user_id)
+        )
+        user = (await session.execute(query)).scalar_one()
+      # manage error in case no user was found
+      except exc.NoResultFound:
+        raise HTTPException(status_code=404,
+                            detail="Utilisateur introuvable")
+  user = schemas.User.model_validate(user, from_attributes=True)
+  user_cache.put(user_id, user, generation)
   return user
 
 
@@ -280,58 +483,37 @@ async def get_user_by_id(user_id: int) -> schemas.User:
                            "description": "Utilisateur déjà existant"}},
           )
 async def add_user(new_user: schemas.UserBase) -> schemas.User:
-  with Session(engine) as session:
+  async with async_session() as session:
+    """ Add the user to the database  """
+    # create a user model compatible with SQLAlchemy using the models module
+    db_user = models.User(username=new_user.username,
+                          email=new_user.email,
+                          address=new_user.address,
+                          password=new_user.password,
+                          )
+    await assign_ids(models.User, [db_user])
+    session.add(db_user)
     try:
-      """
-      Check that the user is not already in the database
-      2 users are considered identical if they have the same name
-      """
-      query = (
-          select(models.User)
-          .where(models.User.username == new_user.username,
-                 models.User.email == new_user.email,
-                 models.User.address == new_user.address,
-                 models.User.password == new_user.password,
-                 )
-      )
-      # WARNING: KEEP the .scalar_one() to raise the exception
-      session.execute(query).scalar_one()
+      # commit to register in the database, the flush sets the id of the user
+      await session.commit()
+    except exc.IntegrityError:
+      # the user already exists: its username or its email is already used
+      # (unique indexes, an identical user has the same username)
       raise HTTPException(status_code=409,
                           detail="Utilisateur déjà existant")
-    except exc.NoResultFound:
-      """ Add the user to the database  """
-      # create a user model compatible with SQLAlchemy using the models module
-      max_id_query = select(func.max(models.User.id))
-      max_id = session.execute(max_id_query).scalar_one()
-      db_user = models.User(id=max_id + 1,
-                            username=new_user.username,
-                            email=new_user.email,
-                            address=new_user.address,
-                            password=new_user.password,
-                            )
-      session.add(db_user)
-      # commit to register in the database
-      session.commit()
-      """ Retrieve the user and its id in the database  """
-      query = (
-          select(models.User)
-          .where(models.User.username == new_user.username,
-                 models.User.email == new_user.email,
-                 models.User.address == new_user.address,
-                 models.User.password == new_user.password,
-                 )
-      )
-      return session.execute(query).scalar_one()
+    return db_user
 
 
 @app.put("/admin/users/{user_id}",
          description="Modifier un utilisateur existant",
          response_description="Utilisateur mis à jour",
          responses={404: {"model": ErrorMessage,
-                          "description": "Utilisateur introuvable"}},
+                          "description": "Utilisateur introuvable"},
+                    409: {"model": ErrorMessage,
+                          "description": "Nom d'utilisateur ou email déjà utilisé"}},
          )
 async def modify_user(user_id: int, new_user: schemas.UserBase) -> schemas.User:
-  with Session(engine) as session:
+  async with async_session() as session:
     """ Search the given user in the database with its id  """
     query = (
         update(models.User)
@@ -342,23 +524,25 @@ async def modify_user(user_id: int, new_user: schemas.UserBase) -> schemas.User:
                 password=new_user.password,
                 )
     )
-    rows_affected = session.execute(query).rowcount
+    try:
+      rows_affected = (await session.execute(query)).rowcount
+    except exc.IntegrityError:
+      # the username or the email is already used by another user (unique indexes)
+      raise HTTPException(status_code=409,
+                          detail="Nom d'utilisateur ou email déjà utilisé")
     if rows_affected == 0:
       raise HTTPException(status_code=404,
                           detail="Utilisateur introuvable")
 
     # Do not forget to save changes in the database
-    session.commit()
-    """ Retrieve the user and its id in the database  """
+    await session.commit()
+    user_cache.invalidate(user_id)
+    """ Retrieve the user in the database with its id  """
     query = (
         select(models.User)
-        .where(models.User.username == new_user.username,
-               models.User.email == new_user.email,
-               models.User.address == new_user.address,
-               models.User.password == new_user.password,
-               )
+        .where(models.User.id == user_id)
     )
-    return session.execute(query).scalar_one()
+    return (await session.execute(query)).scalar_one()
 
 
 @app.delete("/admin/users/{user_id}",
@@ -369,20 +553,21 @@ async def modify_user(user_id: int, new_user: schemas.UserBase) -> schemas.User:
                              "description": "Utilisateur introuvable"}},
             )
 async def delete_user(user_id: int):
-  with Session(engine) as session:
+  async with async_session() as session:
     """ Search the given user in the database with its name  """
     query = (
         delete(models.User)
         .where(models.User.id == user_id)
     )
-    rows_affected = session.execute(query).rowcount
+    rows_affected = (await session.execute(query)).rowcount
     if rows_affected == 0:
       # no row was changed
       raise HTTPException(status_code=404,
                           detail="Utilisateur introuvable")
 
     # Do not forget to save changes in the database
-    session.commit()
+    await session.commit()
+    user_cache.invalidate(user_id)
 
 
 """
@@ -390,15 +575,79 @@ Define all endpoints relative to orders below
 """
 
 
+async def amount_is_correct(session, order: schemas.OrderBase) -> bool:
+  """
+  Check that the total attribute of the order is equal to the sum of the prices
+  of the ordered products.
+  The prices are retrieved with a single query using the session of the request.
+  """
+  product_ids = {item.product_id for item in order.items}
+  """ Retrieve the price of all the products of the items list """
+  query = (
+      select(models.Product.id, models.Product.price)
+      .where(models.Product.id.in_(product_ids))
+  )
+  prices = dict((await session.execute(query)).all())
+  if len(prices) != len(product_ids):
+    # at least one of the ordered products does not exist
+    return False
+  amount = 0.0
+  for item in order.items:
+    amount += prices[item.product_id] * item.ordered_quantity
+  # WARNING: make sure you round up the amount to avoid approximation errors
+  return round(amount, 2) == order.total
+
+
 @app.get("/admin/orders",
-         description="Retourne un tableau JSON contenant les commandes avec leurs détails",
+         description="Retourne un tableau JSON contenant les commandes avec leurs détails. "
+         "Le résultat est paginé: passer le curseur next de la réponse dans le paramètre "
+         "cursor pour obtenir la page suivante",
          response_description="Liste des commandes",
          )
-async def get_all_orders() -> List[schemas.Order]:
-  with Session(engine) as session:
-    query = select(models.Order)
-    orders = session.execute(query).scalars().all()
-    return [order.to_dict() for order in orders]
+async def get_all_orders(limit: int = DEFAULT_PAGE_SIZE,
+                         cursor: str = "",
+                         ) -> schemas.Page[schemas.Order]:
+  async with async_session() as session:
+    # load the orderlines of all the orders with a second query (SELECT ... IN)
+    # instead of one query per order
+    query = select(models.Order).options(selectinload(models.Order.items))
+    orders, next_cursor = await paginate(session, query, [models.Order.id], limit, cursor)
+    if FAST_JSON:
+      return fast_response({"items": [order_to_dict(order) for order in orders],
+                            "next": next_cursor})
+    return {"items": [order.to_dict() for order in orders], "next": next_cursor}
+
+
+async def export_orders():
+  """
+  Yield the orders with their orderlines as NDJSON, one batch at a time
+  """
+  async with async_session() as session:
+    query = (
+        select(models.Order)
+        .options(selectinload(models.Order.items))
+        .order_by(models.Order.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    result = await session.stream(query)
+    async for orders in result.scalars().partitions():
+      if FAST_JSON:
+        yield b"".join(dumps(order_to_dict(order)) + b"\n" for order in orders)
+        continue
+      yield "".join(
+          schemas.Order.model_validate(order.to_dict(), from_attributes=True).model_dump_json()
+          + "\n"
+          for order in orders
+      )
+
+
+@app.get("/admin/orders/export",
+         description="Exporte toutes les commandes au format NDJSON (un objet JSON par ligne)",
+         response_description="Flux NDJSON des commandes",
+         response_class=StreamingResponse,
+         )
+async def get_orders_export():
+  return StreamingResponse(export_orders(), media_type="application/x-ndjson")
 
 
 @app.get("/admin/orders/{order_id}",
@@ -408,116 +657,144 @@ async def get_all_orders() -> List[schemas.Order]:
                           "description": "Commande introuvable"}},
          )
 async def get_order_by_id(order_id: int) -> schemas.Order:
-  with Session(engine) as session:
-    try:
-      """ Search the order in the database with its id  """
-      query = (
-          select(models.Order)
-          .where(models.Order.id == order_id)
-      )
-      order = session.execute(query).scalar_one().to_dict()
-    # manage error in case no order was found
-    except exc.NoResultFound:
-      raise HTTPException(status_code=404,
-                          detail="Commande introuvable")
+  order = order_cache.get(order_id)
+  if order is not None:
+    return order
+  generation = order_cache.generation
+  # cached: read from the primary (see get_all_products)
+  with replicas.primary_reads():
+    async with async_session() as session:
+      try:
+        """ Search the order in the database with its id  """
+        query = (
+            select(models.Order)
+            .where(models.Order.id == order_id)
+            .options(selectinload(models.Order.items))
+        )
+        order = (await session.execute(query)).scalar_one()
+        order = order.to_dict()
+      # manage error in case no order was found
+      except exc.NoResultFound:
+        raise HTTPException(status_code=404,
+                            detail="Commande introuvable")
+  order = schemas.Order.model_validate(order, from_attributes=True)
+  order_cache.put(order_id, order, generation)
   return order
 
 
+async def new_orderlines(items: List[schemas.OrderLineBase]) -> List[dict]:
+  """
+  Return the rows of the orderlines table for the items, without their order_id.
+  With the hilo allocator, their ids are allocated here: before the request
+  locks rows of the database, as the allocator writes in its own transaction.
+  """
+  mappings = [item.to_dict() for item in items]
+  await assign_mapping_ids(models.OrderLine, mappings)
+  return mappings
+
+
+async def insert_orderlines(session, order_id: int, mappings: List[dict]):
+  """
+  Insert the orderlines of an order with a single executemany statement: their
+  ids are not returned by the api, so they are not read back (which would need
+  one INSERT per row on the databases without RETURNING)
+  """
+  if not mappings:
+    return
+  for mapping in mappings:
+    mapping["order_id"] = order_id
+  await session.execute(insert(models.OrderLine), mappings)
+
+
 @app.post("/admin/orders",
-          description="Ajouter une nouvelle commande",
+          description="Ajouter une nouvelle commande. Une requête envoyée à nouveau avec le "
+          "même en-tête Idempotency-Key renvoie la réponse de la première requête sans créer "
+          "de nouvelle commande",
           response_description="Commande ajoutée",
           status_code=201,
-          responses={409: {"model": ErrorMessage,
-                           "description": "Commande déjà existante"},
-                      400: {"model": ErrorMessage,
-                            "description": "Commande incorrecte"}},
+          responses={400: {"model": ErrorMessage,
+                           "description": "Commande incorrecte"},
+                     422: {"model": ErrorMessage,
+                           "description": "Clé d'idempotence déjà utilisée pour une autre "
+                           "requête"}},
           )
-async def add_order(new_order: schemas.OrderBase) -> schemas.Order:
-  with Session(engine) as session:
+async def add_order(new_order: schemas.OrderBase,
+                    idempotency_key: Optional[str] = Header(default=None),
+                    ) -> schemas.Order:
+  if idempotency_key:
+    """ Replay the response if the request was already made with this key """
+    idempotency.check_key(idempotency_key)
+    fingerprint = idempotency.fingerprint(new_order)
+    async with async_session() as session:
+      replay = await idempotency.stored_response(session, idempotency_key, fingerprint)
+    if replay is not None:
+      return replay
+  async with async_session() as session:
     try:
-      """
-      Check that the order is not already in the database
-      2 orders are considered identical if they have the same user, total and status
-      """
-      query = (
-          select(models.Order)
-          .where(models.Order.user_id == new_order.user_id,
-                 models.Order.total == new_order.total,
-                 models.Order.status == new_order.status,
-                 )
-      )
-      # WARNING: KEEP the .scalar_one() to raise the exception
-      session.execute(query).scalar_one()
-      raise HTTPException(status_code=409,
-                          detail="Commande déjà existante")
-    except exc.NoResultFound:
-      """ The order is not in the db  """
-      try:
-        assert new_order.amount_is_correct()
-        assert new_order.status in schemas.allowed_status
-        for item in new_order.items:
-          assert item.ordered_quantity > 0
-          """ Update the stock of the product in the products table """
-          # update the stock of the ordered product
-          query = (
-              select(models.Product)
-              .where(models.Product.id == item.product_id)
-          )
-          product = session.execute(query).scalar_one()
-          new_stock = product.stock - item.ordered_quantity
-          assert new_stock >= 0
-          # update the product's stock
-          query = (
-              update(models.Product)
-              .where(models.Product.id == item.product_id)
-              .values(stock=new_stock)
-          )
-          session.execute(query)
-          session.commit()
-
-        """  Add a new row in the orders table   """
-        max_id_query = select(func.max(models.Order.id))
-        max_id = session.execute(max_id_query).scalar_one()
-        query = (
-            insert(models.Order)
-            .values(id=max_id + 1,
-                    user_id=new_order.user_id,
-                    total=new_order.total,
-                    status=new_order.status,
-                    )
-        )
-        session.execute(query)
-        session.commit()
-        """ Retrieve the order and its id in the database  """
+      assert await amount_is_correct(session, new_order)
+      assert new_order.status in schemas.allowed_status
+      """  Allocate the ids of the new rows before locking the products  """
+      db_order = models.Order(user_id=new_order.user_id,
+                              total=new_order.total,
+                              status=new_order.status,
+                              )
+      await assign_ids(models.Order, [db_order])
+      orderlines = await new_orderlines(new_order.items)
+      """ Update the stock of the ordered products in the products table """
+      # total quantity ordered for each product
+      quantities = {}
+      for item in new_order.items:
+        assert item.ordered_quantity > 0
+        quantities[item.product_id] = (quantities.get(item.product_id, 0)
+                                       + item.ordered_quantity)
+      # the stock is checked and decremented by the database in a single statement,
+      # so that two concurrent orders cannot both take the last units of a product.
+      # The products are updated in the order of their ids: concurrent orders lock
+      # the rows in the same order and cannot deadlock.
+      for product_id, quantity in sorted(quantities.items()):
         query = (
-            select(models.Order)
-            .where(models.Order.user_id == new_order.user_id,
-                   #    models.Order.total == new_order.total,
-                   models.Order.status == new_order.status,
-                   )
+            update(models.Product)
+            .where(models.Product.id == product_id,
+                   models.Product.stock >= quantity)
+            .values(stock=models.Product.stock - quantity)
         )
-        db_order = session.execute(query).scalar_one()
-        """  Add rows corresponding to the items in the orderlines table   """
-        # WARNING: the update of the orderlines table should be made AFTER
-        # the update of the orders table to respect DB integrity
-        for item in new_order.items:
-          max_id_query = select(func.max(models.OrderLine.id))
-          max_id = session.execute(max_id_query).scalar_one()
-          query = (
-              insert(models.OrderLine)
-              .values(id=max_id + 1,
-                      product_id=item.product_id,
-                      ordered_quantity=item.ordered_quantity,
-                      order_id=db_order.id,
-                      unit_price=item.unit_price,
-                      )
-          )
-          session.execute(query)
-          session.commit()
-        return db_order.to_dict()
-      except (AssertionError):
-        raise HTTPException(status_code=400,
-                            detail="Commande incorrecte")
+        rows_affected = (await session.execute(query)).rowcount
+        # no row was changed: the stock is not sufficient
+        assert rows_affected == 1
+
+      """  Add the new row of the orders table, then its orderlines   """
+      session.add(db_order)
+      # the id of the order is needed by its orderlines
+      await session.flush()
+      await insert_orderlines(session, db_order.id, orderlines)
+      order = schemas.Order(id=db_order.id, **new_order.model_dump())
+      response = None
+      if idempotency_key:
+        # the response is stored with the order: both are committed or none
+        body = order.model_dump_json()
+        await idempotency.remember(session, idempotency_key, fingerprint, 201, body)
+        response = Response(body, status_code=201, media_type="application/json")
+      # the stock updates, the order and its orderlines are committed once
+      await session.commit()
+    except (AssertionError):
+      # cancel the stock updates already made
+      await session.rollback()
+      raise HTTPException(status_code=400,
+                          detail="Commande incorrecte")
+    except exc.IntegrityError:
+      if not idempotency_key:
+        raise
+      # a concurrent request with the same key created the order first:
+      # nothing was written by this one, return the response of the other
+      await session.rollback()
+      replay = await idempotency.stored_response(session, idempotency_key, fingerprint)
+      if replay is None:
+        raise
+      return replay
+  # the stock of the ordered products changed
+  catalog_cache.invalidate()
+  product_cache.invalidate(*quantities)
+  return response or order
 
 
 @app.put("/admin/orders/{order_id}",
@@ -529,11 +806,12 @@ async def add_order(new_order: schemas.OrderBase) -> schemas.Order:
                            "description": "Commande incorrecte"}},
          )
 async def modify_order(order_id: int, new_order: schemas.OrderBase) -> schemas.Order:
-  with Session(engine) as session:
+  async with async_session() as session:
     try:
       # check that the provided order is correct
-      assert new_order.amount_is_correct()
+      assert await amount_is_correct(session, new_order)
       assert new_order.status in schemas.allowed_status
+      orderlines = await new_orderlines(new_order.items)
       """ Search the given order in the database with its id  """
       query = (
           update(models.Order)
@@ -543,12 +821,12 @@ async def modify_order(order_id: int, new_order: schemas.OrderBase) -> schemas.O
                   status=new_order.status,
                   )
       )
-      rows_affected = session.execute(query).rowcount
+      rows_affected = (await session.execute(query)).rowcount
       if rows_affected == 0:
         raise HTTPException(status_code=404,
                             detail="Commande introuvable")
       # Do not forget to save changes in the database
-      session.commit()
+      await session.commit()
       """
             Modify the orderlines table with the provided items
             Strategy (not the best): delete all orderlines concerning this order
@@ -558,32 +836,19 @@ async def modify_order(order_id: int, new_order: schemas.OrderBase) -> schemas.O
           delete(models.OrderLine)
           .where(models.OrderLine.order_id == order_id)
       )
-      session.execute(query)
-      session.commit()
+      await session.execute(query)
+      await session.commit()
 
-      for item in new_order.items:
-        max_id_query = select(func.max(models.OrderLine.id))
-        max_id = session.execute(max_id_query).scalar_one()
-        query = (
-            insert(models.OrderLine)
-            .values(id=max_id + 1,
-                    product_id=item.product_id,
-                    ordered_quantity=item.ordered_quantity,
-                    order_id=order_id,
-                    unit_price=item.unit_price,
-                    )
-        )
-        session.execute(query)
-        session.commit()
-      """ Retrieve the order and its id in the database  """
+      await insert_orderlines(session, order_id, orderlines)
+      await session.commit()
+      order_cache.invalidate(order_id)
+      """ Retrieve the order and its orderlines in the database  """
       query = (
           select(models.Order)
-          .where(models.Order.user_id == new_order.user_id,
-                 #    models.Order.total == new_order.total,
-                 models.Order.status == new_order.status,
-                 )
+          .where(models.Order.id == order_id)
+          .options(selectinload(models.Order.items))
       )
-      db_order = session.execute(query).scalar_one()
+      db_order = (await session.execute(query)).scalar_one()
       return db_order.to_dict()
     except (AssertionError, exc.NoResultFound):
       raise HTTPException(status_code=400,
@@ -598,14 +863,14 @@ async def modify_order(order_id: int, new_order: schemas.OrderBase) -> schemas.O
                              "description": "Commande introuvable"}},
             )
 async def delete_order(order_id: int):
-  with Session(engine) as session:
+  async with async_session() as session:
     try:
       """ Check that the order to delete exists """
       query = (
           select(models.OrderLine)
           .where(models.OrderLine.order_id == order_id)
       )
-      session.execute(query)
+      await session.execute(query)
     except exc.NoResultFound:
       raise HTTPException(status_code=404,
                           detail="Commande introuvable")
@@ -617,13 +882,41 @@ async def delete_order(order_id: int):
           delete(models.OrderLine)
           .where(models.OrderLine.order_id == order_id)
       )
-      session.execute(query)
-      session.commit()
+      await session.execute(query)
+      await session.commit()
 
       """ Delete lines corresponding to the order to delete in the orders table """
       query = (
           delete(models.Order)
           .where(models.Order.id == order_id)
       )
-      session.execute(query)
-      session.commit()
+      await session.execute(query)
+      await session.commit()
+      order_cache.invalidate(order_id)
+
+
+"""
+Define all endpoints relative to the monitoring of the api below
+"""
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+  """ Metrics of the requests in the Prometheus text format """
+  return metrics_response()
+
+
+@app.get("/admin/pool",
+         description="Retourne les statistiques du pool de connexions à la base de données",
+         response_description="Statistiques du pool de connexions",
+         )
+async def get_pool_statistics() -> dict:
+  return pool_statistics()
+
+
+@app.get("/admin/cache",
+         description="Retourne les statistiques des caches (taille, hits, misses, évictions)",
+         response_description="Statistiques des caches",
+         )
+async def get_cache_statistics() -> dict:
+  return cache_statistics()
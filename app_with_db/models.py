@@ -3,9 +3,12 @@ This module defines the model used by SQLAlchemy for Product
 in order to map the object to the SQL table Products
 """
 
-from sqlalchemy import Float, Integer, String, ForeignKey
+import hashlib
+import json
+
+from sqlalchemy import Double, Float, Integer, String, Text, ForeignKey, Index
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from typing import List
+from typing import List, Optional
 
 MAX_STRING_LENGTH: int = 255
 
@@ -14,28 +17,56 @@ class Base(DeclarativeBase):
   pass
 
 
+def product_hash(product_name: str, description: str, price: float, category: str) -> str:
+  """
+  Return the sha256 of the attributes identifying a product: two products with
+  the same hash are identical. The stock is not included since it changes with
+  every order.
+  """
+  values = [product_name, description, float(price), category]
+  return hashlib.sha256(json.dumps(values).encode()).hexdigest()
+
+
 class Product(Base):
   # the name of the SQL table associated to this class
   __tablename__ = "products"
+  # indexes used by the filters of GET /products
+  __table_args__ = (
+      Index("ix_products_product_name", "product_name"),
+      Index("ix_products_category_price", "category", "price"),
+      Index("ix_products_price", "price"),
+      # a product is added only once: detecting a duplicate is one index lookup
+      Index("ix_products_content_hash", "content_hash", unique=True),
+  )
 
   # define product attributes
-  id: Mapped[int] = mapped_column(Integer, primary_key=True)
+  id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
   product_name: Mapped[str] = mapped_column(String(MAX_STRING_LENGTH),
                                             nullable=False)
   description: Mapped[str] = mapped_column(String(MAX_STRING_LENGTH),
                                            nullable=False)
-  price: Mapped[float] = mapped_column(Float, nullable=False)
+  # double precision: the cursor of the pagination sorted on the price holds a
+  # Python float, which is not equal to a single precision FLOAT (MySQL)
+  price: Mapped[float] = mapped_column(Double, nullable=False)
   category: Mapped[str] = mapped_column(String(MAX_STRING_LENGTH),
                                         nullable=False)
   stock: Mapped[int] = mapped_column(Integer, nullable=False)
+  # computed by product_hash, empty for the rows stored before this column existed
+  # until they are filled at the start of the api
+  content_hash: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
 
 
 class User(Base):
   # the name of the SQL table associated to this class
   __tablename__ = "users"
+  # indexes used by the filters of GET /admin/users
+  __table_args__ = (
+      Index("ix_users_username", "username", unique=True),
+      Index("ix_users_email", "email", unique=True),
+  )
 
   # define product attributes
-  id: Mapped[int] = mapped_column(Integer, primary_key=True)
+  id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
   username: Mapped[str] = mapped_column(String(MAX_STRING_LENGTH),
                                         nullable=False)
   email: Mapped[str] = mapped_column(String(MAX_STRING_LENGTH),
@@ -49,15 +80,23 @@ class User(Base):
 class Order(Base):
   # the name of the SQL table associated to this class
   __tablename__ = "orders"
+  __table_args__ = (
+      Index("ix_orders_user_id_status", "user_id", "status"),
+  )
 
   # define product attributes
-  id: Mapped[int] = mapped_column(Integer, primary_key=True)
+  id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
   user_id: Mapped[int] = mapped_column(Integer, nullable=False)
   total: Mapped[float] = mapped_column(Float, nullable=False)
   status: Mapped[str] = mapped_column(String(MAX_STRING_LENGTH),
                                       nullable=False)
 
-  items: Mapped[List["OrderLine"]] = relationship(back_populates="order")
+  # the orderlines must be loaded explicitly with the query of the order
+  # (selectinload): a lazy load would run one more query per order.
+  # raise_on_sql is only a safety net, the number of queries of the order
+  # endpoints is checked by tests/test_order_queries.py
+  items: Mapped[List["OrderLine"]] = relationship(back_populates="order",
+                                                  lazy="raise_on_sql")
 
   def to_dict(self):
     return {
@@ -72,8 +111,13 @@ class Order(Base):
 class OrderLine(Base):
   # the name of the SQL table associated to this class
   __tablename__ = "orderlines"
+  # index used to find the orderlines of an order. On MySQL it is also the index
+  # of the foreign key: it is not added to a table whose foreign key has one.
+  __table_args__ = (
+      Index("ix_orderlines_order_id", "order_id"),
+  )
 
-  id: Mapped[int] = mapped_column(Integer, primary_key=True)
+  id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
   product_id: Mapped[int] = mapped_column(Integer, ForeignKey("products.id"))
   ordered_quantity: Mapped[int] = mapped_column(Integer)
   order_id: Mapped[int] = mapped_column(Integer, ForeignKey("orders.id"))
@@ -89,3 +133,32 @@ class OrderLine(Base):
         "order_id": self.order_id,
         "unit_price": self.unit_price
     }
+
+
+class IdBlock(Base):
+  # the name of the SQL table associated to this class
+  __tablename__ = "id_blocks"
+
+  # the next id which can be reserved for the table named table_name
+  # (used by the hilo id allocator)
+  table_name: Mapped[str] = mapped_column(String(64), primary_key=True)
+  next_id: Mapped[int] = mapped_column(Integer, nullable=False)
+
+
+class IdempotencyKey(Base):
+  # the name of the SQL table associated to this class
+  __tablename__ = "idempotency_keys"
+  # index used to delete the expired keys
+  __table_args__ = (
+      Index("ix_idempotency_keys_expires_at", "expires_at"),
+  )
+
+  # the response of a request sent with an Idempotency-Key header, replayed
+  # when the request is sent again with the same key
+  key: Mapped[str] = mapped_column(String(MAX_STRING_LENGTH), primary_key=True)
+  # sha256 of the body of the request
+  fingerprint: Mapped[str] = mapped_column(String(64), nullable=False)
+  status_code: Mapped[int] = mapped_column(Integer, nullable=False)
+  body: Mapped[str] = mapped_column(Text, nullable=False)
+  # timestamp (in seconds) after which the key can be used again
+  expires_at: Mapped[float] = mapped_column(Float, nullable=False)
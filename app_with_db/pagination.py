@@ -0,0 +1,38 @@
+"""
+This module implements the keyset (cursor) pagination of the collection endpoints.
+
+A page is read with "WHERE (keys) > (keys of the last row of the previous page)
+ORDER BY keys LIMIT limit", so fetching a page costs the same whatever its position.
+The cursor returned to the client is an opaque string containing the keys of
+the last row of the page (see the cursor_pagination package).
+"""
+
+from sqlalchemy import and_, or_
+
+from cursor_pagination import check_limit, decode_cursor, encode_cursor
+
+
+async def paginate(session, query, keys: list, limit: int, cursor: str = ""):
+  """
+  Execute the query sorted on the given columns (the last one must be unique)
+  and return the rows of the page following the cursor, with the cursor of the
+  next page (None for the last page)
+  """
+  check_limit(limit)
+  if cursor:
+    values = decode_cursor(cursor, [key.type.python_type for key in keys])
+    # (k1, k2) > (v1, v2) written as k1 > v1 OR (k1 = v1 AND k2 > v2)
+    # which can use the indexes on every database
+    query = query.where(or_(*[
+        and_(*[key == value for key, value in zip(keys[:i], values[:i])],
+             keys[i] > values[i])
+        for i in range(len(keys))
+    ]))
+  # read one more row to know if there is a next page
+  query = query.order_by(*keys).limit(limit + 1)
+  rows = (await session.execute(query)).scalars().all()
+  next_cursor = None
+  if len(rows) > limit:
+    rows = rows[:limit]
+    next_cursor = encode_cursor([getattr(rows[-1], key.key) for key in keys])
+  return rows, next_cursor
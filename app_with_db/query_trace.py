@@ -0,0 +1,63 @@
+"""
+This module implements the X-Query-Trace debug header.
+
+When QUERY_TRACE=true, a request sent with the header X-Query-Trace: true
+receives the SQL queries it made in the response headers:
+- X-Query-Count: the number of queries
+- X-Query-Trace: a JSON array of [statement, duration in ms] pairs
+Only the queries made before the response headers are sent are listed (the
+queries of a streamed export made afterwards are not).
+The queries of the requests without this header are not recorded, but the slow
+ones are always logged (see SLOW_QUERY_THRESHOLD in db.py). The queries are
+recorded by the hook of the metrics (see metrics.instrument_engine) in the
+statistics of the request: MetricsMiddleware must run before this middleware.
+"""
+
+import json
+
+from metrics import RequestStats, current_request
+
+from .db import get_setting
+
+# the trace exposes the SQL statements: it is disabled by default
+QUERY_TRACE: bool = get_setting("QUERY_TRACE", "false").lower() == "true"
+
+
+def trace_requested(scope) -> bool:
+  return QUERY_TRACE and any(name == b"x-query-trace" and value.lower() == b"true"
+                             for name, value in scope["headers"])
+
+
+def trace_headers(stats: RequestStats) -> list:
+  queries = [[" ".join(statement.split()), round(duration * 1000, 3)]
+             for statement, duration in stats.statements]
+  return [
+      (b"x-query-count", str(len(queries)).encode()),
+      # ensure_ascii: the value of a header is sent in latin-1
+      (b"x-query-trace", json.dumps(queries, ensure_ascii=True).encode()),
+  ]
+
+
+class QueryTraceMiddleware:
+  """
+  Record the SQL queries of the requests asking for their trace, and send them
+  in the response headers
+  """
+
+  def __init__(self, app):
+    self.app = app
+
+  async def __call__(self, scope, receive, send):
+    stats = current_request.get() if scope["type"] == "http" else None
+    if stats is None or not trace_requested(scope):
+      await self.app(scope, receive, send)
+      return
+
+    stats.statements = []
+
+    async def send_with_trace(message):
+      if message["type"] == "http.response.start":
+        message["headers"] = list(message.get("headers", [])) + trace_headers(stats)
+      await send(message)
+
+    await self.app(scope, receive, send_with_trace)
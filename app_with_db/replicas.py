@@ -0,0 +1,186 @@
+"""
+This module sends the reads of the GET requests to read replicas.
+
+The replicas are given by the REPLICA_URLS setting (a comma separated list of
+database URLs, see db.py). The sessions use RoutingSession, which chooses the
+database of each statement:
+- the writes (INSERT, UPDATE, DELETE, SELECT ... FOR UPDATE, flushes) and
+every statement following a write in the same session go to the primary, so
+that a request reads its own writes
+- the other reads of a GET request go to a replica, chosen in turn for each
+session (round-robin)
+- the other reads go to the primary
+A replica which fails is ejected until a health check (SELECT 1 every
+REPLICA_CHECK_INTERVAL seconds) succeeds again. Without a healthy replica, the
+reads go to the primary.
+WARNING: a replica can lag behind the primary, a GET request sent just after a
+write can read the previous data. The reads whose result is cached (see
+cache.py) are made in a primary_reads block: a stale row read from a replica
+would be cached after the invalidation made by the write and served as
+current until it expires.
+"""
+
+import asyncio
+import itertools
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional
+
+from sqlalchemy import Select, event, exc, make_url, text
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.dml import UpdateBase
+
+logger = logging.getLogger(__name__)
+
+# the reads of the request being processed by the current task can be sent to a replica
+replica_reads: ContextVar[bool] = ContextVar("replica_reads", default=False)
+
+
+@contextmanager
+def primary_reads():
+  """
+  Send the reads made in the block to the primary, even in a GET request
+  """
+  token = replica_reads.set(False)
+  try:
+    yield
+  finally:
+    replica_reads.reset(token)
+
+
+class Replica:
+  """
+  A read replica and its state
+  """
+
+  def __init__(self, engine: AsyncEngine):
+    self.engine = engine
+    self.healthy = True
+    self.reads = 0
+    self.ejections = 0
+
+  def statistics(self) -> dict:
+    return {
+        "url": make_url(self.engine.url).render_as_string(hide_password=True),
+        "healthy": self.healthy,
+        "reads": self.reads,
+        "ejections": self.ejections,
+    }
+
+
+class ReplicaSet:
+  """
+  The read replicas, chosen in turn among the healthy ones
+  """
+
+  def __init__(self, engines: List[AsyncEngine]):
+    self.replicas = [Replica(engine) for engine in engines]
+    self._turn = itertools.count()
+    for replica in self.replicas:
+      event.listen(replica.engine.sync_engine, "handle_error",
+                   lambda context, replica=replica: self._on_error(replica, context))
+
+  def choose(self) -> Optional[AsyncEngine]:
+    """
+    Return the next healthy replica, None if there is none
+    """
+    for _ in range(len(self.replicas)):
+      replica = self.replicas[next(self._turn) % len(self.replicas)]
+      if replica.healthy:
+        replica.reads += 1
+        return replica.engine
+    return None
+
+  def eject(self, replica: Replica, reason):
+    if replica.healthy:
+      replica.healthy = False
+      replica.ejections += 1
+      logger.warning("Replica %s ejected: %s", replica.statistics()["url"], reason)
+
+  def _on_error(self, replica: Replica, context):
+    # a lost connection or a database which cannot be reached, not an incorrect query
+    if context.is_disconnect or isinstance(context.sqlalchemy_exception, exc.OperationalError):
+      self.eject(replica, context.original_exception)
+
+  async def check(self):
+    """
+    Eject the replicas which do not answer and admit again the others
+    """
+    for replica in self.replicas:
+      try:
+        async with replica.engine.connect() as conn:
+          await conn.execute(text("SELECT 1"))
+      except (exc.SQLAlchemyError, OSError) as error:
+        self.eject(replica, error)
+        continue
+      if not replica.healthy:
+        replica.healthy = True
+        logger.info("Replica %s admitted again", replica.statistics()["url"])
+
+  async def check_periodically(self, interval: float):
+    """
+    Check the replicas every interval seconds, until cancelled
+    """
+    while True:
+      await asyncio.sleep(interval)
+      await self.check()
+
+  async def dispose(self):
+    for replica in self.replicas:
+      await replica.engine.dispose()
+
+  def statistics(self) -> list:
+    return [replica.statistics() for replica in self.replicas]
+
+
+# created by db.get_engine when REPLICA_URLS is set
+replica_set: Optional[ReplicaSet] = None
+
+
+def is_write(clause) -> bool:
+  if isinstance(clause, UpdateBase):
+    return True
+  # SELECT ... FOR UPDATE locks the rows of the primary
+  return isinstance(clause, Select) and clause._for_update_arg is not None
+
+
+class RoutingSession(Session):
+  """
+  A session sending the reads of the GET requests to the replicas
+  """
+
+  def get_bind(self, mapper=None, clause=None, **kwargs):
+    primary = super().get_bind(mapper=mapper, clause=clause, **kwargs)
+    if self._flushing or is_write(clause):
+      # the next reads of the session must see this write
+      self.info["written"] = True
+      return primary
+    if (replica_set is None or self.info.get("written") or not replica_reads.get()
+        or not isinstance(clause, Select)):
+      return primary
+    # all the reads of a session go to the same replica
+    if "replica" not in self.info:
+      self.info["replica"] = replica_set.choose()
+    replica = self.info["replica"]
+    return replica.sync_engine if replica is not None else primary
+
+
+class ReplicaReadsMiddleware:
+  """
+  Allow the reads of the GET requests to be sent to the replicas
+  """
+
+  def __init__(self, app):
+    self.app = app
+
+  async def __call__(self, scope, receive, send):
+    if scope["type"] != "http" or scope["method"] not in ("GET", "HEAD"):
+      await self.app(scope, receive, send)
+      return
+    token = replica_reads.set(True)
+    try:
+      await self.app(scope, receive, send)
+    finally:
+      replica_reads.reset(token)
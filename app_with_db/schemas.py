@@ -3,11 +3,7 @@ This module defines a schema used by Pydantic for type checking
 """
 
 from pydantic import BaseModel
-from typing import List
-from .db import engine
-from sqlalchemy.orm import Session
-from sqlalchemy import select
-from . import models
+from typing import Generic, List, Optional, TypeVar
 
 allowed_status = ["Completed", "Pending", "Shipped", "Cancelled"]
 
@@ -91,28 +87,6 @@ class OrderBase(BaseModel):
   total: float
   status: str
 
-  def amount_is_correct(self) -> bool:
-    """
-    Check that the total attribute is equal to the sum of the prices of
-    the ordered products
-    """
-    amount = 0.0
-    """ Retrieve the price of each product of the items list """
-    for item in self.items:
-      price = 0.0
-      with Session(engine) as session:
-        query = (
-            select(models.Product)
-            .where(models.Product.id == item.product_id)
-        )
-        # we consider that the execution of the query cannot fail
-        # because our database contains correct product ids
-        product = session.execute(query).scalar_one()
-        price = product.price * item.ordered_quantity
-        amount += price
-    # WARNING: make sure you round up the amount to avoid approximation errors
-    return round(amount, 2) == self.total
-
 
 class Order(OrderBase):
   """
@@ -131,6 +105,46 @@ class Order(OrderBase):
     }
 
 
+"""
+Bulk operations models
+"""
+
+
+class BulkProduct(ProductBase):
+  """
+  A product of the body of PUT /products/bulk: the product is updated if it has an id
+  (only the provided attributes are changed), otherwise it is added
+  """
+  id: Optional[int] = None
+
+
+class BulkResult(BaseModel):
+  """
+  The result of one row of a bulk operation. index is the position of the row in the body
+  and status is one of created, updated, deleted, conflict, not_found or invalid
+  """
+  index: int
+  status: str
+  id: Optional[int] = None
+  detail: Optional[str] = None
+
+
+"""
+Pagination model
+"""
+
+T = TypeVar("T")
+
+
+class Page(BaseModel, Generic[T]):
+  """
+  A page of a collection. next is the cursor to provide to get the following page,
+  it is null on the last page
+  """
+  items: List[T]
+  next: Optional[str] = None
+
+
 """
 Error messages model
 """
@@ -0,0 +1,75 @@
+"""
+This module defines the fast JSON serialization of the rows read from the database.
+
+By default FastAPI validates the returned objects with the Pydantic schemas and
+then encodes them with the json module. The rows read from our own database are
+already correct, so the fast path converts them directly to dictionaries and
+encodes them with orjson.
+The dictionaries have the same keys, in the same order, as the Pydantic schemas.
+"""
+
+import orjson
+from fastapi.responses import JSONResponse, Response
+
+from . import models
+
+
+def product_to_dict(product: models.Product) -> dict:
+  return {
+      "product_name": product.product_name,
+      "description": product.description,
+      "price": product.price,
+      "category": product.category,
+      "stock": product.stock,
+      "id": product.id,
+  }
+
+
+def user_to_dict(user: models.User) -> dict:
+  return {
+      "username": user.username,
+      "email": user.email,
+      "address": user.address,
+      "password": user.password,
+      "id": user.id,
+  }
+
+
+def order_to_dict(order: models.Order) -> dict:
+  return {
+      "user_id": order.user_id,
+      "items": [
+          {
+              "product_id": item.product_id,
+              "ordered_quantity": item.ordered_quantity,
+              "unit_price": item.unit_price,
+          }
+          for item in order.items
+      ],
+      "total": order.total,
+      "status": order.status,
+      "id": order.id,
+  }
+
+
+def dumps(content) -> bytes:
+  """
+  Encode the content in JSON
+  """
+  return orjson.dumps(content)
+
+
+class FastJSONResponse(JSONResponse):
+  """
+  A JSON response encoded with orjson
+  """
+
+  def render(self, content) -> bytes:
+    return dumps(content)
+
+
+def fast_response(content, status_code: int = 200) -> Response:
+  """
+  Return a response which FastAPI sends as is, without validating the content
+  """
+  return Response(dumps(content), status_code=status_code, media_type="application/json")
@@ -1,20 +1,56 @@
-from fastapi import FastAPI, HTTPException
-from typing import List
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Header
+from typing import Optional
+
+from cursor_pagination import DEFAULT_PAGE_SIZE, check_limit, decode_cursor, encode_cursor
+from metrics import MetricsMiddleware, metrics_response
+from shared_store import (
+    IDEMPOTENCY_TABLE, IdempotencyKey, IdempotencyStore,
+    SyncMiddleware, Tables, open_store,
+)
 
-from .resources import all_products, all_users, all_orders
+from .repository import ProductRepository, Repository
+from . import resources
 from .schemas import (
     ProductBase, Product,
     User, UserBase,
     Order, OrderBase,
-    ErrorMessage
+    ErrorMessage, Page,
 )
 
-# start the API server
-app = FastAPI()
 
-products_next_id = len(all_products) + 1
-users_next_id = len(all_users) + 1
-orders_next_id = len(all_orders) + 1
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+  """
+  Close the store when the api server stops (the log store writes its last
+  changes to the disk)
+  """
+  yield
+  tables.close()
+
+
+# start the API server
+app = FastAPI(lifespan=lifespan)
+# count the requests and their latency (see GET /metrics)
+app.add_middleware(MetricsMiddleware)
+
+# the responses of POST /admin/orders sent with an Idempotency-Key header
+idempotent_orders = IdempotencyStore()
+# the products, users and orders are stored in repositories which index them
+all_products = ProductRepository(resources.all_products)
+all_users = Repository(resources.all_users, indexes=("username", "email"))
+all_orders = Repository(resources.all_orders, indexes=("status",))
+# the products, users and orders are written to the store given by STORE_URL,
+# which can share them with the other workers of the api (see shared_store)
+tables = Tables(open_store(), {
+    "products": (Product, all_products),
+    "users": (User, all_users),
+    "orders": (Order, all_orders),
+    IDEMPOTENCY_TABLE: (IdempotencyKey, idempotent_orders),
+})
+tables.load()
+# apply the changes made by the other workers before each request
+app.add_middleware(SyncMiddleware, tables=tables)
 
 
 @app.get("/")
@@ -22,8 +58,16 @@ async def welcome():
   return "Welcome to the API training"
 
 
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+  """ Metrics of the requests in the Prometheus text format """
+  return metrics_response()
+
+
 @app.get("/products",
-         description="Retourne un tableau JSON contenant les produits avec leurs détails",
+         description="Retourne un tableau JSON contenant les produits avec leurs détails. "
+         "Le résultat est paginé: passer le curseur next de la réponse dans le paramètre "
+         "cursor pour obtenir la page suivante",
          # response_description is the description to display when no error occured (code 200)
          response_description="	Liste des produits",
          )
@@ -34,7 +78,10 @@ async def get_all_products(product_name: str = "",
                            min_stock: int = 0,
                            min_price: float = 0,
                            max_price: float = float('inf'),
-                           ) -> List[Product]:
+                           sort: str = "id",
+                           limit: int = DEFAULT_PAGE_SIZE,
+                           cursor: str = "",
+                           ) -> Page[Product]:
   if max_price < min_price:
     raise HTTPException(
         status_code=400,
@@ -50,27 +97,32 @@ async def get_all_products(product_name: str = "",
         status_code=400,
         detail="Stock parameter must be positive"
     )
-  requested_products = set(all_products)
-  select_products_by_name = set(all_products)
-  select_products_by_category = set(all_products)
-  if product_name:
-    select_products_by_name = set(
-        [product for product in all_products if product.product_name == product_name])
-  if product_category:
-    select_products_by_category = set(
-        [product for product in all_products if product.category == product_category])
-  select_products_by_stock = set(
-      [product for product in all_products if product.stock >= min_stock])
-  select_products_by_min_price = set(
-      [product for product in all_products if product.price >= min_price])
-  select_products_by_max_price = set(
-      [product for product in all_products if product.price <= max_price])
-  return requested_products.intersection(select_products_by_name,
-                                         select_products_by_category,
-                                         select_products_by_stock,
-                                         select_products_by_min_price,
-                                         select_products_by_max_price,
-                                         )
+  if sort not in ("id", "price"):
+    raise HTTPException(
+        status_code=400,
+        detail="sort parameter must be id or price"
+    )
+  check_limit(limit)
+  after = None
+  if cursor:
+    # the id makes the sort key unique when sorting on the price
+    after = tuple(decode_cursor(cursor, (float, int) if sort == "price" else (int,)))
+  # read one more product to know if there is a next page
+  products = all_products.query(product_name=product_name,
+                                category=product_category,
+                                min_stock=min_stock,
+                                min_price=min_price,
+                                max_price=max_price,
+                                sort=sort,
+                                after=after,
+                                limit=limit + 1,
+                                )
+  next_cursor = None
+  if len(products) > limit:
+    products = products[:limit]
+    last = products[-1]
+    next_cursor = encode_cursor([last.price, last.id] if sort == "price" else [last.id])
+  return {"items": products, "next": next_cursor}
 
 
 @app.get("/products/{product_id}",
@@ -82,11 +134,11 @@ async def get_all_products(product_name: str = "",
                           "description": "Produit introuvable"}},
          )
 async def get_product_by_id(product_id: int) -> Product:
-  for product in all_products:
-    if product.id == product_id:
-      return product
-  # if no product is found, raise an error
-  raise HTTPException(status_code=404, detail="Produit introuvable")
+  product = all_products.get(product_id)
+  if product is None:
+    # if no product is found, raise an error
+    raise HTTPException(status_code=404, detail="Produit introuvable")
+  return product
 
 
 @app.post("/products",
@@ -99,16 +151,15 @@ async def get_product_by_id(product_id: int) -> Product:
                            "description": "Produit déjà existant"}},
           )
 async def add_product(new_product: ProductBase) -> Product:
-  global products_next_id
   """ Check that the product is not already in the database   """
-  if new_product not in all_products:
-    new_product = Product.add_id(new_product, products_next_id)
-    products_next_id += 1
-    all_products.append(new_product)
-    return new_product
-  else:
-    raise HTTPException(status_code=409,
-                        detail="Produit déjà existant")
+  async with tables.write():
+    if not all_products.exists(new_product):
+      new_product = Product.add_id(new_product, tables.next_id("products"))
+      tables.save("products", new_product)
+      return new_product
+    else:
+      raise HTTPException(status_code=409,
+                          detail="Produit déjà existant")
 
 
 @app.put("/products/{product_id}",
@@ -119,11 +170,11 @@ async def add_product(new_product: ProductBase) -> Product:
          )
 async def modify_product(product_id: int, new_product: ProductBase) -> Product:
   """ Search the given product in the database with its id  """
-  for i, product in enumerate(all_products):
-    if product.id == product_id:
-      # add the id in the URL to the given product
-      new_product_with_id = Product.add_id(new_product, product_id)
-      all_products[i] = new_product_with_id
+  # add the id in the URL to the given product
+  new_product_with_id = Product.add_id(new_product, product_id)
+  async with tables.write():
+    if all_products.get(product_id) is not None:
+      tables.save("products", new_product_with_id)
       return new_product_with_id
   raise HTTPException(status_code=404,
                       detail="Produit introuvable")
@@ -137,17 +188,12 @@ async def modify_product(product_id: int, new_product: ProductBase) -> Product:
                              "description": "Produit introuvable"}},
             )
 async def delete_product(product_id: int):
-  global products_next_id
   """ Search the given product in the database with its id  """
-  found = False
-  for i, product in enumerate(all_products):
-    if product.id == product_id:
-      products_next_id = product.id
-      del all_products[i]
-      found = True
-  if not found:
-    raise HTTPException(status_code=404,
-                        detail="Produit introuvable")
+  async with tables.write():
+    if all_products.get(product_id) is None:
+      raise HTTPException(status_code=404,
+                          detail="Produit introuvable")
+    tables.remove("products", product_id)
 
 
 """
@@ -155,25 +201,35 @@ Define all endpoints relative to user below
 """
 
 
+def page_of(repository: Repository, limit: int, cursor: str, **values):
+  """
+  Return the page of the rows having the given values which follows the cursor,
+  with the cursor of the next page (None for the last page)
+  """
+  check_limit(limit)
+  after = decode_cursor(cursor, (int,))[0] if cursor else None
+  # read one more row to know if there is a next page
+  rows = repository.page(limit + 1, after, **values)
+  next_cursor = None
+  if len(rows) > limit:
+    rows = rows[:limit]
+    next_cursor = encode_cursor([rows[-1].id])
+  return rows, next_cursor
+
+
 @app.get("/admin/users",
-         description="Retourne un tableau JSON contenant les utilisateurs avec leurs détails",
+         description="Retourne un tableau JSON contenant les utilisateurs avec leurs détails. "
+         "Le résultat est paginé: passer le curseur next de la réponse dans le paramètre "
+         "cursor pour obtenir la page suivante",
          response_description="	Liste des utilisateurs",
          )
 async def get_all_users(name: str = "",
                         email: str = "",
-                        ) -> List[User]:
-  requested_users = set(all_users)
-  select_users_by_name = set(all_users)
-  select_users_by_email = set(all_users)
-  if name:
-    select_users_by_name = set(
-        [user for user in all_users if user.username == name])
-  if email:
-    select_users_by_email = set(
-        [user for user in all_users if user.email == email])
-  return requested_users.intersection(select_users_by_name,
-                                      select_users_by_email,
-                                      )
+                        limit: int = DEFAULT_PAGE_SIZE,
+                        cursor: str = "",
+                        ) -> Page[User]:
+  users, next_cursor = page_of(all_users, limit, cursor, username=name, email=email)
+  return {"items": users, "next": next_cursor}
 
 
 @app.get("/admin/users/{user_id}",
@@ -183,11 +239,21 @@ async def get_all_users(name: str = "",
                           "description": "Utilisateur introuvable"}},
          )
 async def get_user_by_id(user_id: int) -> User:
-  for user in all_users:
-    if user.id == user_id:
-      return user
-  # if no user is found, raise an error
-  raise HTTPException(status_code=404, detail="Utilisateur introuvable")
+  user = all_users.get(user_id)
+  if user is None:
+    # if no user is found, raise an error
+    raise HTTPException(status_code=404, detail="Utilisateur introuvable")
+  return user
+
+
+def user_exists(new_user: UserBase) -> bool:
+  """
+  Check if a user identical to the given one is in the database
+  """
+  # User.__eq__ only compares the ids: the attributes are compared, among the
+  # users having the same username (found with the index)
+  same_username = all_users.page(len(all_users), username=new_user.username)
+  return any(user.model_dump(exclude={"id"}) == new_user.model_dump() for user in same_username)
 
 
 @app.post("/users",
@@ -198,16 +264,15 @@ async def get_user_by_id(user_id: int) -> User:
                            "description": "Utilisateur déjà existant"}},
           )
 async def add_user(new_user: UserBase) -> User:
-  global users_next_id
   """ Check that the user is not already in the database   """
-  if new_user not in all_users:
-    new_user = User.add_id(new_user, users_next_id)
-    users_next_id += 1
-    all_users.append(new_user)
-    return new_user
-  else:
-    raise HTTPException(status_code=409,
-                        detail="Utilisateur déjà existant")
+  async with tables.write():
+    if not user_exists(new_user):
+      new_user = User.add_id(new_user, tables.next_id("users"))
+      tables.save("users", new_user)
+      return new_user
+    else:
+      raise HTTPException(status_code=409,
+                          detail="Utilisateur déjà existant")
 
 
 @app.put("/admin/users/{user_id}",
@@ -218,11 +283,11 @@ async def add_user(new_user: UserBase) -> User:
          )
 async def modify_user(user_id: int, new_user: UserBase) -> User:
   """ Search the given user in the database with its id  """
-  for i, user in enumerate(all_users):
-    if user.id == user_id:
-      # add the id in the URL to the given user
-      new_user_with_id = User.add_id(new_user, user_id)
-      all_users[i] = new_user_with_id
+  # add the id in the URL to the given user
+  new_user_with_id = User.add_id(new_user, user_id)
+  async with tables.write():
+    if all_users.get(user_id) is not None:
+      tables.save("users", new_user_with_id)
       return new_user_with_id
   raise HTTPException(status_code=404,
                       detail="Utilisateur introuvable")
@@ -236,17 +301,12 @@ async def modify_user(user_id: int, new_user: UserBase) -> User:
                              "description": "Utilisateur introuvable"}},
             )
 async def delete_user(user_id: int):
-  global users_next_id
   """ Search the given user in the database with its id  """
-  found = False
-  for i, user in enumerate(all_users):
-    if user.id == user_id:
-      users_next_id = user.id
-      del all_users[i]
-      found = True
-  if not found:
-    raise HTTPException(status_code=404,
-                        detail="Utilisateur introuvable")
+  async with tables.write():
+    if all_users.get(user_id) is None:
+      raise HTTPException(status_code=404,
+                          detail="Utilisateur introuvable")
+    tables.remove("users", user_id)
 
 
 """
@@ -255,17 +315,17 @@ Define all endpoints relative to orders below
 
 
 @app.get("/admin/orders",
-         description="Retourne un tableau JSON contenant les commandes avec leurs détails",
+         description="Retourne un tableau JSON contenant les commandes avec leurs détails. "
+         "Le résultat est paginé: passer le curseur next de la réponse dans le paramètre "
+         "cursor pour obtenir la page suivante",
          response_description="	Liste des commandes",
          )
-async def get_all_orders(status: str = "") -> List[Order]:
-  requested_orders = set(all_orders)
-  select_orders_by_status = set(all_orders)
-  if status:
-    select_orders_by_status = set(
-        [order for order in all_orders if order.status == status]
-    )
-  return requested_orders.intersection(select_orders_by_status)
+async def get_all_orders(status: str = "",
+                         limit: int = DEFAULT_PAGE_SIZE,
+                         cursor: str = "",
+                         ) -> Page[Order]:
+  orders, next_cursor = page_of(all_orders, limit, cursor, status=status)
+  return {"items": orders, "next": next_cursor}
 
 
 @app.get("/admin/orders/{order_id}",
@@ -275,37 +335,49 @@ async def get_all_orders(status: str = "") -> List[Order]:
                           "description": "Commande introuvable"}},
          )
 async def get_order_by_id(order_id: int) -> Order:
-  for order in all_orders:
-    if order.id == order_id:
-      return order
-  # if no order is found, raise an error
-  raise HTTPException(status_code=404, detail="Commande introuvable")
+  order = all_orders.get(order_id)
+  if order is None:
+    # if no order is found, raise an error
+    raise HTTPException(status_code=404, detail="Commande introuvable")
+  return order
 
 
 @app.post("/admin/orders",
-          description="Ajouter une nouvelle commande",
+          description="Ajouter une nouvelle commande. Une requête envoyée à nouveau avec le "
+          "même en-tête Idempotency-Key renvoie la réponse de la première requête sans créer "
+          "de nouvelle commande",
           response_description="Commande ajoutée",
           status_code=201,
-          responses={409: {"model": ErrorMessage,
-                           "description": "Commande déjà existante"},
-                     400: {"model": ErrorMessage,
-                           "description": "Commande incorrecte"}},
+          responses={400: {"model": ErrorMessage,
+                           "description": "Commande incorrecte"},
+                     422: {"model": ErrorMessage,
+                           "description": "Clé d'idempotence déjà utilisée pour une autre "
+                           "requête"}},
           )
-async def add_order(new_order: OrderBase) -> Order:
-  global orders_next_id
-  """ Check that the order is correct and is not already in the database   """
-  if new_order not in all_orders:
-    if new_order.is_correct(all_products) is False:
+async def add_order(new_order: OrderBase,
+                    idempotency_key: Optional[str] = Header(default=None),
+                    ) -> Order:
+  """ Return the same order if the request was already made with this key """
+  async with tables.write():
+    if idempotency_key:
+      order = idempotent_orders.get(idempotency_key, new_order)
+      if order is not None:
+        return order
+    """ Check that the order is correct """
+    if new_order.is_correct(all_products.by_id) is False:
       raise HTTPException(status_code=400,
                           detail="Commande incorrecte")
-    else:
-      new_order = Order.add_id(new_order, orders_next_id)
-      orders_next_id += 1
-      all_orders.append(new_order)
-      return new_order
-  else:
-    raise HTTPException(status_code=409,
-                        detail="Commande déjà existante")
+    # update the stock of the ordered products
+    for item in new_order.items:
+      product = all_products.get(item.product_id)
+      tables.save("products", product.model_copy(
+          update={"stock": product.stock - item.ordered_quantity}))
+    order = Order.add_id(new_order, tables.next_id("orders"))
+    tables.save("orders", order)
+    if idempotency_key:
+      # saved with the order: a retry sent to another worker finds it
+      idempotent_orders.remember(tables, idempotency_key, new_order, order)
+  return order
 
 
 @app.put("/admin/orders/{order_id}",
@@ -318,11 +390,11 @@ async def add_order(new_order: OrderBase) -> Order:
          )
 async def modify_order(order_id: int, new_order: OrderBase) -> Order:
   """ Search the given order in the database with its id  """
-  for i, order in enumerate(all_orders):
-    if order.id == order_id:
-      # add the id in the URL to the given order
-      new_order_with_id = Order.add_id(new_order, order_id)
-      all_orders[i] = new_order_with_id
+  # add the id in the URL to the given order
+  new_order_with_id = Order.add_id(new_order, order_id)
+  async with tables.write():
+    if all_orders.get(order_id) is not None:
+      tables.save("orders", new_order_with_id)
       return new_order_with_id
   raise HTTPException(status_code=404,
                       detail="Commande introuvable")
@@ -336,14 +408,9 @@ async def modify_order(order_id: int, new_order: OrderBase) -> Order:
                              "description": "Commande introuvable"}},
             )
 async def delete_order(order_id: int):
-  global orders_next_id
   """ Search the given order in the database with its id  """
-  found = False
-  for i, order in enumerate(all_orders):
-    if order.id == order_id:
-      orders_next_id = order.id
-      del all_orders[i]
-      found = True
-  if not found:
-    raise HTTPException(status_code=404,
-                        detail="Commande introuvable")
+  async with tables.write():
+    if all_orders.get(order_id) is None:
+      raise HTTPException(status_code=404,
+                          detail="Commande introuvable")
+    tables.remove("orders", order_id)
@@ -0,0 +1,246 @@
+"""
+This module defines in-memory repositories with indexes, so that the cost of a
+request does not grow with the number of rows:
+- Repository (users, orders): a dictionary id -> row, the sorted list of the
+ids and optional indexes value -> sorted ids on some attributes, so that a
+page sorted on the id is found with bisect
+- ProductRepository adds hash indexes on the name and the category and sorted
+indexes on the price and the stock, queried with bisect
+All the indexes are updated by add, replace and delete: the rows stored in a
+repository must never be modified in place.
+"""
+
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .schemas import Product, ProductBase
+
+
+def content_key(product: ProductBase) -> tuple:
+  """
+  The attributes used to tell whether two products are identical
+  """
+  return (product.product_name, product.description, product.price,
+          product.category, product.stock)
+
+
+class Repository:
+  """
+  Store rows having an id, sorted on the id
+  """
+
+  def __init__(self, rows: Iterable = (), indexes: Tuple[str, ...] = ()):
+    # the attributes indexed by _by_value
+    self.indexes = indexes
+    self.reset(rows)
+
+  def reset(self, rows: Iterable):
+    """
+    Replace all the rows of the repository
+    """
+    self.by_id: Dict[int, object] = {}
+    # sorted list of the ids (for the pagination on the id)
+    self._ids: List[int] = []
+    # attribute -> value -> sorted list of the ids of the rows having this value
+    self._by_value = {attribute: defaultdict(list) for attribute in self.indexes}
+    for row in rows:
+      self.add(row)
+
+  def __len__(self):
+    return len(self.by_id)
+
+  def __iter__(self):
+    return iter(self.by_id.values())
+
+  def get(self, id_: int):
+    return self.by_id.get(id_)
+
+  def add(self, row):
+    self.by_id[row.id] = row
+    insort(self._ids, row.id)
+    for attribute, index in self._by_value.items():
+      insort(index[getattr(row, attribute)], row.id)
+
+  def delete(self, id_: int) -> bool:
+    row = self.by_id.pop(id_, None)
+    if row is None:
+      return False
+    del self._ids[bisect_left(self._ids, id_)]
+    for attribute, index in self._by_value.items():
+      ids = index[getattr(row, attribute)]
+      del ids[bisect_left(ids, id_)]
+      if not ids:
+        del index[getattr(row, attribute)]
+    return True
+
+  def replace(self, row) -> bool:
+    """
+    Replace the row having the same id, return False if there is none
+    """
+    if not self.delete(row.id):
+      return False
+    self.add(row)
+    return True
+
+  def put(self, row):
+    """
+    Add the row or replace the row having the same id
+    """
+    self.delete(row.id)
+    self.add(row)
+
+  def page(self, limit: int, after: Optional[int] = None, **values) -> list:
+    """
+    Return at most limit rows having the given values of the indexed attributes
+    (the empty values are ignored), sorted on the id and located after the id
+    "after" (keyset pagination)
+    """
+    values = {attribute: value for attribute, value in values.items() if value}
+    ids = self._ids
+    if values:
+      # the sorted ids of the least frequent value
+      ids = min((self._by_value[attribute].get(value, []) for attribute, value in values.items()),
+                key=len)
+    start = bisect_right(ids, after) if after is not None else 0
+    result = []
+    for i in range(start, len(ids)):
+      if len(result) >= limit:
+        break
+      row = self.by_id[ids[i]]
+      if all(getattr(row, attribute) == value for attribute, value in values.items()):
+        result.append(row)
+    return result
+
+
+class ProductRepository(Repository):
+  """
+  Store the products and keep their indexes up to date
+  """
+
+  def reset(self, products: Iterable[Product]):
+    """
+    Replace all the products of the repository
+    """
+    self._by_name = defaultdict(set)
+    self._by_category = defaultdict(set)
+    self._by_content = defaultdict(set)
+    # sorted lists of (price, id) and (stock, id)
+    self._by_price: List[Tuple[float, int]] = []
+    self._by_stock: List[Tuple[int, int]] = []
+    super().reset(products)
+
+  def exists(self, product: ProductBase) -> bool:
+    """
+    Check if a product identical to the given one is in the repository
+    """
+    return bool(self._by_content.get(content_key(product)))
+
+  def add(self, product: Product):
+    super().add(product)
+    self._by_name[product.product_name].add(product.id)
+    self._by_category[product.category].add(product.id)
+    self._by_content[content_key(product)].add(product.id)
+    insort(self._by_price, (product.price, product.id))
+    insort(self._by_stock, (product.stock, product.id))
+
+  def delete(self, product_id: int) -> bool:
+    product = self.by_id.get(product_id)
+    if not super().delete(product_id):
+      return False
+    self._discard(self._by_name, product.product_name, product_id)
+    self._discard(self._by_category, product.category, product_id)
+    self._discard(self._by_content, content_key(product), product_id)
+    del self._by_price[bisect_left(self._by_price, (product.price, product_id))]
+    del self._by_stock[bisect_left(self._by_stock, (product.stock, product_id))]
+    return True
+
+  @staticmethod
+  def _discard(index: dict, key, product_id: int):
+    ids = index[key]
+    ids.discard(product_id)
+    if not ids:
+      del index[key]
+
+  def query(self,
+            product_name: str = "",
+            category: str = "",
+            min_stock: int = 0,
+            min_price: float = 0,
+            max_price: float = float('inf'),
+            sort: str = "id",
+            after: Optional[tuple] = None,
+            limit: Optional[int] = None,
+            ) -> List[Product]:
+    """
+    Return at most limit products matching the filters, sorted on the id or on
+    (price, id), located after the sort key "after" (keyset pagination).
+    The index giving the fewest candidates is used to find the products.
+    """
+    def matches(product: Product) -> bool:
+      return ((not product_name or product.product_name == product_name) and
+              (not category or product.category == category) and
+              product.stock >= min_stock and
+              min_price <= product.price <= max_price)
+
+    def sort_key(product: Product) -> tuple:
+      return (product.price, product.id) if sort == "price" else (product.id,)
+
+    # position of the products in the price and stock ranges
+    price_start = bisect_left(self._by_price, (min_price,))
+    price_end = bisect_right(self._by_price, (max_price, float('inf')))
+    stock_start = bisect_left(self._by_stock, (min_stock,))
+
+    # (number of candidates, candidate ids, sort order of the candidates)
+    sources = [
+        (len(self._ids), lambda: self._ids_after(after), "id"),
+        (max(price_end - price_start, 0),
+         lambda: self._prices_after(after, price_start, price_end), "price"),
+        (len(self._by_stock) - stock_start,
+         lambda: self._range(self._by_stock, stock_start, len(self._by_stock)), None),
+    ]
+    if product_name:
+      ids = self._by_name.get(product_name, set())
+      sources.append((len(ids), lambda ids=ids: iter(ids), None))
+    if category:
+      ids = self._by_category.get(category, set())
+      sources.append((len(ids), lambda ids=ids: iter(ids), None))
+    # the smallest source, preferring the one already sorted in the requested order
+    _, candidates, order = min(sources, key=lambda source: (source[0], source[2] != sort))
+
+    if order == sort:
+      # the candidates are already sorted and start after the cursor:
+      # stop as soon as the page is full
+      result = []
+      for product_id in candidates():
+        product = self.by_id[product_id]
+        if matches(product):
+          result.append(product)
+          if limit is not None and len(result) >= limit:
+            break
+      return result
+
+    result = sorted((self.by_id[product_id] for product_id in candidates()
+                     if matches(self.by_id[product_id])), key=sort_key)
+    if after is not None:
+      result = result[bisect_right([sort_key(product) for product in result], after):]
+    return result[:limit]
+
+  def _ids_after(self, after: Optional[tuple]):
+    start = 0
+    if after is not None and len(after) == 1:
+      start = bisect_right(self._ids, after[0])
+    # iterate on the positions: slicing the list would copy it
+    return (self._ids[i] for i in range(start, len(self._ids)))
+
+  def _prices_after(self, after: Optional[tuple], start: int, end: int):
+    if after is not None and len(after) == 2:
+      start = max(start, bisect_right(self._by_price, tuple(after)))
+    return self._range(self._by_price, start, end)
+
+  @staticmethod
+  def _range(index: list, start: int, end: int):
+    """
+    Yield the ids of the (value, id) pairs of a sorted index between start and end
+    """
+    return (index[i][1] for i in range(start, end))
@@ -3,7 +3,7 @@ This module defines a schema used by Pydantic for type checking
 """
 
 from pydantic import BaseModel
-from typing import List
+from typing import Generic, List, Mapping, Optional, TypeVar
 
 allowed_status = ["Completed", "Pending", "Shipped", "Cancelled"]
 
@@ -157,7 +157,7 @@ class OrderBase(BaseModel):
   total: float
   status: str
 
-  def is_correct(self, products: List[Product]) -> bool:
+  def is_correct(self, products: Mapping[int, Product]) -> bool:
     """
     Check that the order is correct, that is:
     - the user_id exists in the list of users
@@ -166,18 +166,19 @@ class OrderBase(BaseModel):
     - the total amount of the order is correct (equals to the price
     of the products multiplied by the quantity)
     - the status type is allowed (is in the allowed_status list)
+    The products are given by id. Their stock is not modified.
     """
     try:
       order_amount = 0
+      ordered_quantities = {}
       for item in self.items:
         # check that the products in the order exist
         # Note: the name, description, etc are not checked
-        assert item.product_id in {product.id for product in products}
+        assert item.product_id in products
         # check that the products in the order are available
-        product = products[item.product_id]
-        assert item.ordered_quantity <= product.stock
-        # update the product's stock
-        product.stock -= item.ordered_quantity
+        ordered_quantities[item.product_id] = (ordered_quantities.get(item.product_id, 0)
+                                               + item.ordered_quantity)
+        assert ordered_quantities[item.product_id] <= products[item.product_id].stock
         order_amount += item.unit_price * item.ordered_quantity
       # check that the total amount of the order is correct
       assert round(order_amount, 2) == self.total
@@ -235,6 +236,22 @@ class Order(OrderBase):
     return hash(self.id)
 
 
+"""
+Pagination model
+"""
+
+T = TypeVar("T")
+
+
+class Page(BaseModel, Generic[T]):
+  """
+  A page of a collection. next is the cursor to provide to get the following page,
+  it is null on the last page
+  """
+  items: List[T]
+  next: Optional[str] = None
+
+
 """
 Error messages model
 """
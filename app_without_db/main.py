@@ -1,5 +1,12 @@
-from fastapi import FastAPI, HTTPException
-from typing import List
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Header
+from typing import List, Optional
+
+from metrics import MetricsMiddleware, metrics_response
+from shared_store import (
+    IDEMPOTENCY_TABLE, IdempotencyKey, IdempotencyStore,
+    ListTable, SyncMiddleware, Tables, open_store,
+)
 
 from .schemas import (
     Product, ProductBase,
@@ -8,12 +15,35 @@ from .schemas import (
 )
 from .resources import all_products, all_users, all_orders
 
-# start the API server
-app = FastAPI()
 
-products_next_id = len(all_products) + 1
-users_next_id = len(all_users) + 1
-orders_next_id = len(all_orders) + 1
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+  """
+  Close the store when the api server stops (the log store writes its last
+  changes to the disk)
+  """
+  yield
+  tables.close()
+
+
+# start the API server
+app = FastAPI(lifespan=lifespan)
+# count the requests and their latency (see GET /metrics)
+app.add_middleware(MetricsMiddleware)
+
+# the responses of POST /admin/orders sent with an Idempotency-Key header
+idempotent_orders = IdempotencyStore()
+# the lists are written to the store given by STORE_URL, which can share them
+# with the other workers of the api (see shared_store)
+tables = Tables(open_store(), {
+    "products": (Product, ListTable(all_products)),
+    "users": (User, ListTable(all_users)),
+    "orders": (Order, ListTable(all_orders)),
+    IDEMPOTENCY_TABLE: (IdempotencyKey, idempotent_orders),
+})
+tables.load()
+# apply the changes made by the other workers before each request
+app.add_middleware(SyncMiddleware, tables=tables)
 
 
 @app.get("/")
@@ -21,6 +51,12 @@ async def welcome():
   return "Welcome to the API training"
 
 
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+  """ Metrics of the requests in the Prometheus text format """
+  return metrics_response()
+
+
 """
 Define all endpoints relative to product below
 """
@@ -42,44 +78,39 @@ async def get_product_by_id(product_id: int) -> Product:
 
 @app.post("/products")
 async def add_product(new_product: ProductBase) -> Product:
-  global products_next_id
   """ Check that the product is not already in the database   """
-  if new_product not in all_products:
-    new_product = Product.add_id(new_product, products_next_id)
-    products_next_id += 1
-    all_products.append(new_product)
-    return new_product
-  else:
-    raise HTTPException(status_code=409,
-                        detail="Produit déjà existant")
+  async with tables.write():
+    if new_product not in all_products:
+      new_product = Product.add_id(new_product, tables.next_id("products"))
+      tables.save("products", new_product)
+      return new_product
+    else:
+      raise HTTPException(status_code=409,
+                          detail="Produit déjà existant")
 
 
 @app.put("/products/{product_id}")
 async def modify_product(product_id: int, new_product: ProductBase) -> Product:
   """ Search the given product in the database with its id  """
-  for i, product in enumerate(all_products):
-    if product.id == product_id:
-      # add the id in the URL to the given product
-      new_product_with_id = Product.add_id(new_product, product_id)
-      all_products[i] = new_product_with_id
-      return new_product_with_id
+  async with tables.write():
+    for product in all_products:
+      if product.id == product_id:
+        # add the id in the URL to the given product
+        new_product_with_id = Product.add_id(new_product, product_id)
+        tables.save("products", new_product_with_id)
+        return new_product_with_id
   raise HTTPException(status_code=404,
                       detail="Produit introuvable")
 
 
 @app.delete("/products/{product_id}")
 async def delete_product(product_id: int):
-  global products_next_id
   """ Search the given product in the database with its id  """
-  found = False
-  for i, product in enumerate(all_products):
-    if product.id == product_id:
-      products_next_id = product.id
-      del all_products[i]
-      found = True
-  if not found:
-    raise HTTPException(status_code=404,
-                        detail="Produit introuvable")
+  async with tables.write():
+    if not any(product.id == product_id for product in all_products):
+      raise HTTPException(status_code=404,
+                          detail="Produit introuvable")
+    tables.remove("products", product_id)
 
 
 """
@@ -103,44 +134,39 @@ async def get_user_by_id(user_id: int) -> User:
 
 @app.post("/users")
 async def add_user(new_user: UserBase) -> User:
-  global users_next_id
   """ Check that the user is not already in the database   """
-  if new_user not in all_users:
-    new_user = User.add_id(new_user, users_next_id)
-    users_next_id += 1
-    all_users.append(new_user)
-    return new_user
-  else:
-    raise HTTPException(status_code=409,
-                        detail="Utilisateur déjà existant")
+  async with tables.write():
+    if new_user not in all_users:
+      new_user = User.add_id(new_user, tables.next_id("users"))
+      tables.save("users", new_user)
+      return new_user
+    else:
+      raise HTTPException(status_code=409,
+                          detail="Utilisateur déjà existant")
 
 
 @app.put("/admin/users/{user_id}")
 async def modify_user(user_id: int, new_user: UserBase) -> User:
   """ Search the given user in the database with its id  """
-  for i, user in enumerate(all_users):
-    if user.id == user_id:
-      # add the id in the URL to the given user
-      new_user_with_id = User.add_id(new_user, user_id)
-      all_users[i] = new_user_with_id
-      return new_user_with_id
+  async with tables.write():
+    for user in all_users:
+      if user.id == user_id:
+        # add the id in the URL to the given user
+        new_user_with_id = User.add_id(new_user, user_id)
+        tables.save("users", new_user_with_id)
+        return new_user_with_id
   raise HTTPException(status_code=404,
                       detail="Utilisateur introuvable")
 
 
 @app.delete("/admin/users/{user_id}")
 async def delete_user(user_id: int):
-  global users_next_id
   """ Search the given user in the database with its id  """
-  found = False
-  for i, user in enumerate(all_users):
-    if user.id == user_id:
-      users_next_id = user.id
-      del all_users[i]
-      found = True
-  if not found:
-    raise HTTPException(status_code=404,
-                        detail="Utilisateur introuvable")
+  async with tables.write():
+    if not any(user.id == user_id for user in all_users):
+      raise HTTPException(status_code=404,
+                          detail="Utilisateur introuvable")
+    tables.remove("users", user_id)
 
 
 """
@@ -163,50 +189,57 @@ async def get_order_by_id(order_id: int) -> Order:
 
 
 @app.post("/admin/orders")
-async def add_order(new_order: OrderBase) -> Order:
-  global orders_next_id
-  """ Check that the order is correct and is not already in the database   """
-  if new_order not in all_orders:
-    if new_order.is_correct(all_products) is False:
+async def add_order(new_order: OrderBase,
+                    idempotency_key: Optional[str] = Header(default=None),
+                    ) -> Order:
+  """ Return the same order if the request was already made with this key """
+  async with tables.write():
+    if idempotency_key:
+      order = idempotent_orders.get(idempotency_key, new_order)
+      if order is not None:
+        return order
+    """ Check that the order is correct """
+    products = {product.id: product for product in all_products}
+    if new_order.is_correct(products) is False:
       raise HTTPException(status_code=400,
                           detail="Commande incorrecte")
-    else:
-      new_order = Order.add_id(new_order, orders_next_id)
-      orders_next_id += 1
-      all_orders.append(new_order)
-      return new_order
-  else:
-    raise HTTPException(status_code=409,
-                        detail="Commande déjà existante")
+    # update the stock of the ordered products
+    for item in new_order.items:
+      product = products[item.product_id]
+      products[item.product_id] = product.model_copy(
+          update={"stock": product.stock - item.ordered_quantity})
+      tables.save("products", products[item.product_id])
+    order = Order.add_id(new_order, tables.next_id("orders"))
+    tables.save("orders", order)
+    if idempotency_key:
+      # saved with the order: a retry sent to another worker finds it
+      idempotent_orders.remember(tables, idempotency_key, new_order, order)
+  return order
 
 
 @app.put("/admin/orders/{order_id}")
 async def modify_order(order_id: int, new_order: OrderBase) -> Order:
   """ Search the given order in the database with its id  """
-  if new_order.is_correct(all_products) is True:
-    for i, order in enumerate(all_orders):
-      if order.id == order_id:
-        # add the id in the URL to the given order
-        new_order_with_id = Order.add_id(new_order, order_id)
-        all_orders[i] = new_order_with_id
-        return new_order_with_id
-  else:
-    raise HTTPException(status_code=400,
-                        detail="Commande incorrecte")
+  async with tables.write():
+    if new_order.is_correct({product.id: product for product in all_products}) is True:
+      for order in all_orders:
+        if order.id == order_id:
+          # add the id in the URL to the given order
+          new_order_with_id = Order.add_id(new_order, order_id)
+          tables.save("orders", new_order_with_id)
+          return new_order_with_id
+    else:
+      raise HTTPException(status_code=400,
+                          detail="Commande incorrecte")
   raise HTTPException(status_code=404,
                       detail="Commande introuvable")
 
 
 @app.delete("/admin/orders/{order_id}")
 async def delete_order(order_id: int):
-  global orders_next_id
   """ Search the given order in the database with its id  """
-  found = False
-  for i, order in enumerate(all_orders):
-    if order.id == order_id:
-      orders_next_id = order.id
-      del all_orders[i]
-      found = True
-  if not found:
-    raise HTTPException(status_code=404,
-                        detail="Commande introuvable")
+  async with tables.write():
+    if not any(order.id == order_id for order in all_orders):
+      raise HTTPException(status_code=404,
+                          detail="Commande introuvable")
+    tables.remove("orders", order_id)
@@ -2,6 +2,8 @@
 This module defines a list of products
 """
 
+import os
+
 from .schemas import Product, User, Order, Item
 
 all_products = [
@@ -124,3 +126,17 @@ all_orders = [
         status="Pending"
     )
 ]
+
+"""
+To test the api at scale, the lists above are replaced by generated data
+(see the synthetic_data package) when the SYNTHETIC_DATA_PRODUCTS environment
+variable gives the number of products to generate
+"""
+if os.environ.get("SYNTHETIC_DATA_PRODUCTS"):
+  from synthetic_data import generate
+
+  data = generate(int(os.environ["SYNTHETIC_DATA_PRODUCTS"]),
+                  seed=int(os.environ.get("SYNTHETIC_DATA_SEED", 0)))
+  all_products = [Product(**product) for product in data["products"]]
+  all_users = [User(**user) for user in data["users"]]
+  all_orders = [Order(**order) for order in data["orders"]]
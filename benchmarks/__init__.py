@@ -0,0 +1,3 @@
+"""
+Benchmarks of the api, run from the root of the repository with python -m benchmarks.<name>
+"""
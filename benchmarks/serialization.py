@@ -0,0 +1,71 @@
+"""
+Compare the encoding of a list of products read from the database:
+- default path of FastAPI: validation with the Pydantic schema, jsonable_encoder and json
+- fast path (FAST_JSON setting): direct conversion to dictionaries encoded with orjson
+
+Usage: python -m benchmarks.serialization [number of rows] [repetitions]
+"""
+
+import json
+import sys
+import time
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+from app_with_db import models, schemas
+from app_with_db.serialization import dumps, product_to_dict
+
+
+def make_products(count: int) -> list:
+  return [
+      models.Product(id=i,
+                     product_name=f"Produit {i}",
+                     description="Description du produit",
+                     price=round(1 + i % 997 * 0.37, 2),
+                     category=f"Categorie {i % 20}",
+                     stock=i % 50,
+                     )
+      for i in range(1, count + 1)
+  ]
+
+
+def default_path(products: list) -> bytes:
+  # what FastAPI does with the return annotation List[schemas.Product]
+  adapter = TypeAdapter(list[schemas.Product])
+  validated = adapter.validate_python(products, from_attributes=True)
+  return json.dumps(jsonable_encoder(validated), ensure_ascii=False,
+                    separators=(",", ":")).encode()
+
+
+def fast_path(products: list) -> bytes:
+  return dumps([product_to_dict(product) for product in products])
+
+
+def measure(function, products: list, repetitions: int) -> float:
+  """
+  Return the best duration of the function in seconds
+  """
+  best = float('inf')
+  for _ in range(repetitions):
+    start = time.perf_counter()
+    function(products)
+    best = min(best, time.perf_counter() - start)
+  return best
+
+
+def main():
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+  repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+  products = make_products(count)
+  # both paths must produce the same JSON document
+  assert json.loads(default_path(products)) == json.loads(fast_path(products))
+  default = measure(default_path, products, repetitions)
+  fast = measure(fast_path, products, repetitions)
+  print(f"{count} products, best of {repetitions}")
+  print(f"default path: {default * 1000:8.2f} ms")
+  print(f"fast path:    {fast * 1000:8.2f} ms ({default / fast:.1f}x faster)")
+
+
+if __name__ == "__main__":
+  main()
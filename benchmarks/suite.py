@@ -0,0 +1,402 @@
+"""
+Benchmark suite of the three apps (app_without_db, app_with_doc_and_query_params
+and app_with_db on SQLite), called through an ASGI client without network.
+
+For each app and each catalog size, generated data (see synthetic_data) is
+loaded in the app and every endpoint is called during a fixed number of
+requests or seconds. The suite reports the p50 / p99 latency, the throughput and the memory allocated by a
+request (peak measured with tracemalloc), and saves the results in a JSON file.
+The startup time of each app (import and lifespan) is reported too.
+
+Usage:
+  python -m benchmarks.suite [--apps without_db,doc,db] [--sizes 10,1000,100000,1000000]
+                             [--requests 200] [--duration 5] [--concurrency 1]
+                             [--output results.json] [--compare previous.json]
+
+Each (app, size) pair runs in its own process, so that the memory and the state
+of one run do not change the next one.
+"""
+
+import argparse
+import asyncio
+import importlib
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+APPS = ["without_db", "doc", "db"]
+APP_MODULES = {"without_db": "app_without_db.main",
+               "doc": "app_with_doc_and_query_params.main",
+               "db": "app_with_db.main"}
+DEFAULT_SIZES = "10,1000,100000,1000000"
+# the slow endpoints are called at least this number of times, even after the duration
+MIN_REQUESTS = 3
+# number of requests measured with tracemalloc (which slows down the requests)
+ALLOCATION_REQUESTS = 5
+# number of rows in the body of a request to the bulk endpoints of app_with_db
+BULK_SIZE = 100
+RESULTS_DIRECTORY = os.path.join(os.path.dirname(__file__), "results")
+
+
+"""
+Loading of the data in the apps
+"""
+
+
+def load_without_db(dataset: dict):
+  from app_without_db import main
+  from app_without_db.schemas import Order, Product, User
+  main.all_products[:] = [Product(**product) for product in dataset["products"]]
+  main.all_users[:] = [User(**user) for user in dataset["users"]]
+  main.all_orders[:] = [Order(**order) for order in dataset["orders"]]
+  # allocate the next ids after the loaded rows
+  main.tables.load()
+  return main.app
+
+
+def load_doc(dataset: dict):
+  from app_with_doc_and_query_params import main
+  from app_with_doc_and_query_params.schemas import Order, Product, User
+  main.all_products.reset(Product(**product) for product in dataset["products"])
+  main.all_users.reset(User(**user) for user in dataset["users"])
+  main.all_orders.reset(Order(**order) for order in dataset["orders"])
+  # allocate the next ids after the loaded rows
+  main.tables.load()
+  return main.app
+
+
+async def load_db(dataset: dict):
+  # the database is chosen before the import of the app (see run_worker)
+  from app_with_db import main
+  from app_with_db.db import get_engine
+  from synthetic_data.sql import insert_dataset
+  async with get_engine().begin() as conn:
+    await insert_dataset(conn, dataset)
+  return main.app
+
+
+"""
+Endpoints called by the benchmark
+"""
+
+
+def deleted_ids(rows: list, rng: random.Random):
+  """
+  Yield the ids of the rows in a random order, each one once, then ids that do
+  not exist (the requests are then answered with an error, see the status codes)
+  """
+  ids = [row["id"] for row in rows]
+  rng.shuffle(ids)
+  yield from ids
+  yield from range(-1, -10 ** 9, -1)
+
+
+def endpoints(app_name: str, dataset: dict, rng: random.Random) -> list:
+  """
+  Return the (name, function returning the method, url and body of a request)
+  pairs of the endpoints of the app. The DELETE requests come last: they remove
+  rows of the dataset that the other requests use.
+  """
+  products = dataset["products"]
+  users = dataset["users"]
+  orders = dataset["orders"]
+  counter = iter(range(10 ** 9))
+
+  # the orders are made on the 10% of the products having the largest stock
+  in_stock = sorted(products, key=lambda product: product["stock"])[-max(len(products) // 10, 1):]
+
+  def new_order():
+    product = rng.choice(in_stock)
+    return {"user_id": rng.choice(users)["id"],
+            "items": [{"product_id": product["id"], "ordered_quantity": 1,
+                       "unit_price": product["price"]}],
+            "total": product["price"],
+            "status": "Pending"}
+
+  def new_product():
+    return {"product_name": f"Nouveau produit {next(counter)}", "description": "Benchmark",
+            "price": 10.0, "category": "Benchmark", "stock": 100}
+
+  def new_user():
+    number = next(counter)
+    return {"username": f"benchmark.{number}", "email": f"benchmark.{number}@mail.fr",
+            "address": "1 rue du Benchmark Paris", "password": "benchmark"}
+
+  def modified(row: dict) -> dict:
+    # the row without its id (the body of a PUT request)
+    return {key: value for key, value in row.items() if key != "id"}
+
+  def modified_product():
+    product = rng.choice(products)
+    # the stock does not change the content hash of the product (no conflict)
+    return ("PUT", f"/products/{product['id']}",
+            {**modified(product), "stock": rng.randint(0, 1000)})
+
+  def modified_user():
+    user = rng.choice(users)
+    return ("PUT", f"/admin/users/{user['id']}", modified(user))
+
+  def modified_order():
+    return ("PUT", f"/admin/orders/{rng.choice(orders)['id']}", new_order())
+
+  product_ids = deleted_ids(products, rng)
+  user_ids = deleted_ids(users, rng)
+  order_ids = deleted_ids(orders, rng)
+
+  calls = [
+      ("GET /products", lambda: ("GET", "/products", None)),
+      ("GET /products/{id}", lambda: ("GET", f"/products/{rng.choice(products)['id']}", None)),
+      ("GET /admin/users", lambda: ("GET", "/admin/users", None)),
+      ("GET /admin/users/{id}", lambda: ("GET", f"/admin/users/{rng.choice(users)['id']}", None)),
+      ("GET /admin/orders", lambda: ("GET", "/admin/orders", None)),
+      ("GET /admin/orders/{id}",
+       lambda: ("GET", f"/admin/orders/{rng.choice(orders)['id']}", None)),
+      ("POST /products", lambda: ("POST", "/products", new_product())),
+      ("POST /users", lambda: ("POST", "/users", new_user())),
+      ("POST /admin/orders", lambda: ("POST", "/admin/orders", new_order())),
+      ("PUT /products/{id}", modified_product),
+      ("PUT /admin/users/{id}", modified_user),
+      ("PUT /admin/orders/{id}", modified_order),
+  ]
+  if app_name != "without_db":
+    # the query parameters of GET /products
+    calls[1:1] = [
+        ("GET /products?product_category",
+         lambda: ("GET", f"/products?product_category={rng.choice(products)['category']}",
+                  None)),
+        ("GET /products?price range&sort=price",
+         lambda: ("GET", "/products?min_price=100&max_price=120&sort=price", None)),
+    ]
+  if app_name == "db":
+    # the exports stream the whole tables, the bulk requests write BULK_SIZE rows
+    calls += [
+        ("GET /products/export", lambda: ("GET", "/products/export", None)),
+        ("GET /admin/orders/export", lambda: ("GET", "/admin/orders/export", None)),
+        ("POST /products/bulk",
+         lambda: ("POST", "/products/bulk", [new_product() for _ in range(BULK_SIZE)])),
+        ("PUT /products/bulk",
+         lambda: ("PUT", "/products/bulk",
+                  [{"id": rng.choice(products)["id"], "stock": rng.randint(0, 1000)}
+                   for _ in range(BULK_SIZE)])),
+    ]
+  calls += [
+      ("DELETE /admin/orders/{id}", lambda: ("DELETE", f"/admin/orders/{next(order_ids)}", None)),
+      ("DELETE /admin/users/{id}", lambda: ("DELETE", f"/admin/users/{next(user_ids)}", None)),
+      ("DELETE /products/{id}", lambda: ("DELETE", f"/products/{next(product_ids)}", None)),
+  ]
+  if app_name == "db":
+    calls.append(("DELETE /products/bulk",
+                  lambda: ("DELETE", "/products/bulk",
+                           [next(product_ids) for _ in range(BULK_SIZE)])))
+  return calls
+
+
+"""
+Measures
+"""
+
+
+def percentile(values: list, percent: float) -> float:
+  """
+  Nearest-rank percentile of the sorted values
+  """
+  return values[max(math.ceil(len(values) * percent / 100) - 1, 0)]
+
+
+async def measure(client, build, requests: int, duration: float, concurrency: int) -> dict:
+  latencies = []
+  status_codes = Counter()
+  # the first request fills the caches of the app and is not measured
+  method, url, body = build()
+  await client.request(method, url, json=body)
+
+  start = time.perf_counter()
+
+  async def worker():
+    while len(latencies) < requests and (time.perf_counter() - start < duration
+                                         or len(latencies) < MIN_REQUESTS):
+      method, url, body = build()
+      sent = time.perf_counter()
+      response = await client.request(method, url, json=body)
+      latencies.append(time.perf_counter() - sent)
+      status_codes[response.status_code] += 1
+
+  await asyncio.gather(*(worker() for _ in range(concurrency)))
+  elapsed = time.perf_counter() - start
+
+  # memory allocated by a request: peak of the memory traced during the request
+  allocations = []
+  tracemalloc.start()
+  for _ in range(ALLOCATION_REQUESTS):
+    method, url, body = build()
+    before = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    await client.request(method, url, json=body)
+    allocations.append(tracemalloc.get_traced_memory()[1] - before)
+  tracemalloc.stop()
+
+  latencies.sort()
+  return {
+      "requests": len(latencies),
+      "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+      "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+      "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+      "throughput_rps": round(len(latencies) / elapsed, 1),
+      "allocated_kib": round(sorted(allocations)[len(allocations) // 2] / 1024, 1),
+      "status_codes": {str(code): count for code, count in sorted(status_codes.items())},
+  }
+
+
+async def run_app(app_name: str, size: int, options) -> list:
+  import httpx
+  from synthetic_data import generate
+
+  dataset = generate(size, seed=options.seed)
+  # startup: import of the app and run of its lifespan (connection to the database,
+  # creation of the tables and warm-up of the pool for app_with_db)
+  start = time.perf_counter()
+  app = importlib.import_module(APP_MODULES[app_name]).app
+  lifespan = app.router.lifespan_context(app)
+  await lifespan.__aenter__()
+  startup_seconds = round(time.perf_counter() - start, 3)
+
+  start = time.perf_counter()
+  if app_name == "db":
+    await load_db(dataset)
+  elif app_name == "without_db":
+    load_without_db(dataset)
+  else:
+    load_doc(dataset)
+  load_seconds = round(time.perf_counter() - start, 3)
+
+  rng = random.Random(options.seed)
+  results = []
+  transport = httpx.ASGITransport(app=app)
+  async with httpx.AsyncClient(transport=transport, base_url="http://benchmark",
+                               timeout=None) as client:
+    for name, build in endpoints(app_name, dataset, rng):
+      result = await measure(client, build, options.requests, options.duration,
+                             options.concurrency)
+      results.append({"app": app_name, "size": size, "endpoint": name,
+                      "startup_seconds": startup_seconds, "load_seconds": load_seconds,
+                      **result})
+      print(f"  {name:40} p50 {result['p50_ms']:9.2f} ms", file=sys.stderr)
+  # app_with_db closes its connections, the process does not stop while they are open
+  await lifespan.__aexit__(None, None, None)
+  return results
+
+
+def run_worker(app_name: str, size: int, options):
+  """
+  Run the benchmark of one app for one size and print the results in JSON
+  """
+  if app_name == "db":
+    database = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+    os.environ["DATABASE_URL"] = "sqlite+aiosqlite:///" + database
+  results = asyncio.run(run_app(app_name, size, options))
+  print(json.dumps(results))
+
+
+"""
+Run of the suite
+"""
+
+
+def git_commit() -> str:
+  try:
+    return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                          text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return ""
+
+
+def compare(results: list, previous_file: str):
+  """
+  Print the ratio between the p50 latencies of the run and of a previous run
+  """
+  with open(previous_file) as file:
+    previous = {(result["app"], result["size"], result["endpoint"]): result
+                for result in json.load(file)["results"]}
+  print(f"\nComparison with {previous_file} (p50 new / p50 previous)")
+  for result in results:
+    old = previous.get((result["app"], result["size"], result["endpoint"]))
+    if old and old["p50_ms"]:
+      print(f"{result['app']:10} {result['size']:>8} {result['endpoint']:40} "
+            f"{result['p50_ms'] / old['p50_ms']:6.2f}x")
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--apps", default=",".join(APPS))
+  parser.add_argument("--sizes", default=DEFAULT_SIZES)
+  parser.add_argument("--requests", type=int, default=200,
+                      help="maximum number of requests per endpoint")
+  parser.add_argument("--duration", type=float, default=5,
+                      help="maximum duration in seconds per endpoint")
+  parser.add_argument("--concurrency", type=int, default=1,
+                      help="number of requests sent at the same time")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--output", help="JSON file of the results")
+  parser.add_argument("--compare", help="JSON file of a previous run")
+  parser.add_argument("--worker", nargs=2, metavar=("APP", "SIZE"), help=argparse.SUPPRESS)
+  options = parser.parse_args()
+
+  if options.worker:
+    run_worker(options.worker[0], int(options.worker[1]), options)
+    return
+
+  results = []
+  for app_name in options.apps.split(","):
+    if app_name not in APPS:
+      parser.error(f"unknown app {app_name}, choose among {', '.join(APPS)}")
+    for size in map(int, options.sizes.split(",")):
+      print(f"{app_name} with {size} products", file=sys.stderr)
+      command = [sys.executable, "-m", "benchmarks.suite", "--worker", app_name, str(size),
+                 "--requests", str(options.requests), "--duration", str(options.duration),
+                 "--concurrency", str(options.concurrency), "--seed", str(options.seed)]
+      process = subprocess.run(command, stdout=subprocess.PIPE, text=True)
+      if process.returncode != 0:
+        print(f"{app_name} with {size} products failed", file=sys.stderr)
+        continue
+      results.extend(json.loads(process.stdout.strip().splitlines()[-1]))
+
+  output = options.output or os.path.join(
+      RESULTS_DIRECTORY, time.strftime("results-%Y%m%d-%H%M%S.json"))
+  os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+  with open(output, "w") as file:
+    json.dump({
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": {key: value for key, value in vars(options).items()
+                    if key not in ("worker", "output", "compare")},
+        "results": results,
+    }, file, indent=2)
+
+  print(f"\n{'app':10} {'size':>8} {'startup s':>10} {'load s':>8}")
+  for result in {(result["app"], result["size"]): result for result in results}.values():
+    print(f"{result['app']:10} {result['size']:>8} {result['startup_seconds']:10.3f} "
+          f"{result['load_seconds']:8.3f}")
+
+  print(f"\n{'app':10} {'size':>8} {'endpoint':40} {'p50 ms':>9} {'p99 ms':>9} "
+        f"{'req/s':>9} {'KiB':>9}")
+  for result in results:
+    print(f"{result['app']:10} {result['size']:>8} {result['endpoint']:40} "
+          f"{result['p50_ms']:9.2f} {result['p99_ms']:9.2f} "
+          f"{result['throughput_rps']:9.1f} {result['allocated_kib']:9.1f}")
+  print(f"\nResults saved in {output}")
+  if options.compare:
+    compare(results, options.compare)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,11 @@
+"""
+The cursors of the keyset pagination, shared by app_with_db and
+app_with_doc_and_query_params.
+
+The elements of a collection are sorted on a unique key and a page contains
+the limit elements following the key of the last element of the previous
+page. The cursor returned to the client is an opaque string containing this
+key (see cursors.py).
+"""
+
+from .cursors import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, check_limit, decode_cursor, encode_cursor
@@ -0,0 +1,52 @@
+"""
+This module encodes and decodes the cursors of the keyset pagination, and
+checks the page size requested by the client.
+"""
+
+import base64
+import binascii
+import json
+from typing import Sequence
+
+from fastapi import HTTPException
+
+DEFAULT_PAGE_SIZE: int = 100
+MAX_PAGE_SIZE: int = 1000
+
+
+def encode_cursor(values: list) -> str:
+  """
+  Encode the key of the last element of a page in an opaque cursor
+  """
+  return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor: str, types: Sequence[type]) -> list:
+  """
+  Decode a cursor built by encode_cursor and containing a key of the given
+  types (int or float)
+  """
+  try:
+    values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+  except (binascii.Error, ValueError):
+    values = None
+  if not isinstance(values, list) or len(values) != len(types) or not all(
+      valid_key(value, type_) for value, type_ in zip(values, types)):
+    raise HTTPException(status_code=400,
+                        detail="Curseur invalide")
+  return values
+
+
+def valid_key(value, type_: type) -> bool:
+  # bool is a subclass of int, and an integer is a valid float key
+  if isinstance(value, bool):
+    return False
+  return isinstance(value, (int, float) if type_ is float else type_)
+
+
+def check_limit(limit: int):
+  if limit < 1 or limit > MAX_PAGE_SIZE:
+    raise HTTPException(
+        status_code=400,
+        detail=f"limit parameter must be between 1 and {MAX_PAGE_SIZE}"
+    )
@@ -0,0 +1,11 @@
+"""
+Metrics of the apis, exposed in the Prometheus text format at /metrics:
+- MetricsMiddleware records the number, the status codes and the latency of the
+requests of each route, and the number of requests in progress
+- instrument_engine counts the SQL queries and their duration for each request,
+logs the slow queries and records the statements of a request on demand
+"""
+
+from .middleware import MetricsMiddleware, RequestStats, current_request
+from .registry import registry, metrics_response
+from .sqlalchemy import instrument_engine
@@ -0,0 +1,80 @@
+"""
+This module defines the ASGI middleware measuring the requests.
+"""
+
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from .registry import registry
+
+
+class RequestStats:
+  """
+  The SQL queries made while processing a request
+  """
+
+  __slots__ = ("scope", "queries", "db_time", "statements")
+
+  def __init__(self, scope=None):
+    self.scope = scope
+    self.queries = 0
+    self.db_time = 0.0
+    # the (statement, duration) pairs, only recorded when set to a list
+    # (see the X-Query-Trace header of app_with_db)
+    self.statements = None
+
+
+# the statistics of the request being processed by the current task
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+
+def route_of(scope) -> str:
+  """
+  The path template of the route (/products/{product_id} and not /products/1),
+  so that the number of label values does not grow with the ids
+  """
+  route = scope.get("route")
+  return getattr(route, "path", "unmatched")
+
+
+class MetricsMiddleware:
+  """
+  Measure the number, the status codes and the latency of the requests of each route
+  """
+
+  def __init__(self, app):
+    self.app = app
+
+  async def __call__(self, scope, receive, send):
+    if scope["type"] != "http":
+      await self.app(scope, receive, send)
+      return
+
+    method = scope["method"]
+    stats = RequestStats(scope)
+    token = current_request.set(stats)
+    status = 500
+
+    async def send_with_status(message):
+      nonlocal status
+      if message["type"] == "http.response.start":
+        status = message["status"]
+      await send(message)
+
+    registry.in_progress.inc(method)
+    start = time.perf_counter()
+    try:
+      await self.app(scope, receive, send_with_status)
+    finally:
+      duration = time.perf_counter() - start
+      registry.in_progress.dec(method)
+      current_request.reset(token)
+      route = route_of(scope)
+      registry.requests.inc(method, route, str(status))
+      registry.request_duration.observe(duration, method, route)
+      if registry.database:
+        registry.queries.inc(method, route, amount=stats.queries)
+        registry.query_duration.inc(method, route, amount=stats.db_time)
+        registry.request_queries.observe(stats.queries, method, route)
+        registry.request_db_duration.observe(stats.db_time, method, route)
@@ -0,0 +1,141 @@
+"""
+This module defines the metrics and renders them in the Prometheus text format.
+The metrics are kept by each process: with several workers, each worker exposes
+its own metrics.
+"""
+
+import math
+from bisect import bisect_left
+from typing import Dict, Tuple
+
+from fastapi.responses import Response
+
+# buckets of the durations in seconds
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# buckets of the number of queries made by a request
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def escape(value) -> str:
+  return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple) -> str:
+  if not names:
+    return ""
+  return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def format_value(value: float) -> str:
+  if value == math.inf:
+    return "+Inf"
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+  kind = ""
+
+  def __init__(self, name: str, description: str, labels: Tuple[str, ...] = ()):
+    self.name = name
+    self.description = description
+    self.labels = labels
+    self.values: Dict[tuple, float] = {}
+
+  def header(self) -> list:
+    return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+  kind = "counter"
+
+  def inc(self, *labels, amount: float = 1):
+    self.values[labels] = self.values.get(labels, 0) + amount
+
+  def render(self) -> list:
+    return self.header() + [
+        f"{self.name}{format_labels(self.labels, labels)} {format_value(value)}"
+        for labels, value in sorted(self.values.items())
+    ]
+
+
+class Gauge(Counter):
+  kind = "gauge"
+
+  def dec(self, *labels, amount: float = 1):
+    self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+  kind = "histogram"
+
+  def __init__(self, name: str, description: str, labels: Tuple[str, ...] = (),
+               buckets: Tuple[float, ...] = DURATION_BUCKETS):
+    super().__init__(name, description, labels)
+    self.buckets = buckets + (math.inf,)
+    # labels -> [count of each bucket (not cumulative), sum, count]
+    self.values: Dict[tuple, list] = {}
+
+  def observe(self, value: float, *labels):
+    state = self.values.get(labels)
+    if state is None:
+      state = self.values[labels] = [[0] * len(self.buckets), 0, 0]
+    state[0][bisect_left(self.buckets, value)] += 1
+    state[1] += value
+    state[2] += 1
+
+  def render(self) -> list:
+    lines = self.header()
+    for labels, (counts, total, count) in sorted(self.values.items()):
+      cumulative = 0
+      for bound, bucket_count in zip(self.buckets, counts):
+        cumulative += bucket_count
+        lines.append(f"{self.name}_bucket"
+                     f"{format_labels(self.labels + ('le',), labels + (format_value(bound),))}"
+                     f" {cumulative}")
+      lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {format_value(total)}")
+      lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {count}")
+    return lines
+
+
+class Registry:
+  """
+  The metrics of the api
+  """
+
+  def __init__(self):
+    route = ("method", "route")
+    self.requests = Counter("http_requests_total",
+                            "Number of requests by route and status code",
+                            route + ("status",))
+    self.request_duration = Histogram("http_request_duration_seconds",
+                                      "Duration of the requests by route", route)
+    self.in_progress = Gauge("http_requests_in_progress",
+                             "Number of requests being processed", ("method",))
+    self.queries = Counter("db_queries_total",
+                           "Number of SQL queries by route", route)
+    self.query_duration = Counter("db_query_duration_seconds_total",
+                                  "Time spent in SQL queries by route", route)
+    self.request_queries = Histogram("db_queries_per_request",
+                                     "Number of SQL queries made by a request", route,
+                                     buckets=QUERY_BUCKETS)
+    self.request_db_duration = Histogram("db_duration_per_request_seconds",
+                                         "Time spent in SQL queries by a request", route)
+    self.http_metrics = [self.requests, self.request_duration, self.in_progress]
+    self.db_metrics = [self.queries, self.query_duration, self.request_queries,
+                       self.request_db_duration]
+    # the SQL metrics are only recorded by the apps using a database (see instrument_engine)
+    self.database = False
+
+  def render(self) -> str:
+    metrics = self.http_metrics + (self.db_metrics if self.database else [])
+    return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+registry = Registry()
+
+
+def metrics_response() -> Response:
+  """
+  The response of GET /metrics
+  """
+  return Response(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,53 @@
+"""
+This module counts the SQL queries made by each request and their duration,
+logs the slow queries and records the statements of the requests whose
+statistics ask for it (see RequestStats.statements).
+"""
+
+import logging
+import time
+
+from sqlalchemy import event
+
+from .middleware import current_request, route_of
+from .registry import registry
+
+logger = logging.getLogger(__name__)
+
+# maximum length of the parameters written in the log of a slow query (DEBUG level)
+SLOW_QUERY_MAX_PARAMETERS_LENGTH: int = 1000
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  # kept by the execution context of the statement: nothing is left behind when it fails
+  context.query_start = time.perf_counter()
+
+
+def instrument_engine(engine, slow_query_threshold: float = float("inf")):
+  """
+  Listen to the queries of the engine (an Engine or an AsyncEngine). The
+  queries lasting more than slow_query_threshold seconds are logged with their
+  route.
+  """
+  registry.database = True
+
+  def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - context.query_start
+    stats = current_request.get()
+    # the queries made outside of a request (startup, background tasks) are not counted
+    if stats is not None:
+      stats.queries += 1
+      stats.db_time += duration
+      if stats.statements is not None:
+        stats.statements.append((statement, duration))
+    if duration >= slow_query_threshold:
+      route = route_of(stats.scope) if stats is not None else "no request"
+      logger.warning("Slow query (%.1f ms) on %s: %s", duration * 1000, route, statement)
+      # the parameters contain personal data (emails, password hashes): they
+      # are only written at the DEBUG level
+      logger.debug("Parameters of the slow query: %.*s",
+                   SLOW_QUERY_MAX_PARAMETERS_LENGTH, repr(parameters))
+
+  sync_engine = getattr(engine, "sync_engine", engine)
+  event.listen(sync_engine, "before_cursor_execute", before_cursor_execute)
+  event.listen(sync_engine, "after_cursor_execute", after_cursor_execute)
@@ -0,0 +1,50 @@
+"""
+Storage of the apps without database (app_without_db and
+app_with_doc_and_query_params).
+
+The apps keep their products, users and orders in memory (Tables) and write
+every change to a store, chosen with the STORE_URL environment variable:
+- memory (default): the data only live in the memory of the worker, the api
+must run with a single worker
+- sqlite:///path/to/store.db: the data are shared by all the workers through a
+SQLite file. Each worker applies the changes made by the others before
+processing a request, and the writes are serialized by a lock on the file.
+- log:///path/to/directory: the data of a single worker are kept on disk, in
+an append-only log of the writes and in snapshots, so that they survive a
+restart of the api (see log.py). LOG_FSYNC_INTERVAL and SNAPSHOT_EVERY set the
+seconds between two fsync of the log and the number of writes between two
+snapshots.
+
+A store implements load, transaction, next_id, put, delete, changes,
+snapshot_due and close. The shared stores (shared = True) also implement rows,
+which returns all the rows of a table when changes tells that some changes of
+the other workers were missed.
+"""
+
+import os
+
+from . import log
+from .idempotency import IDEMPOTENCY_TABLE, IdempotencyKey, IdempotencyStore
+from .log import LogStore
+from .memory import MemoryStore
+from .middleware import SyncMiddleware
+from .sqlite import SQLiteStore
+from .tables import ListTable, Tables
+
+
+def open_store(url: str = ""):
+  """
+  Return the store of the given URL (STORE_URL by default)
+  """
+  url = url or os.environ.get("STORE_URL", "memory")
+  if url == "memory":
+    return MemoryStore()
+  if url.startswith("sqlite:///"):
+    return SQLiteStore(url[len("sqlite:///"):])
+  if url.startswith("log:///"):
+    return LogStore(
+        url[len("log:///"):],
+        fsync_interval=float(os.environ.get("LOG_FSYNC_INTERVAL", log.LOG_FSYNC_INTERVAL)),
+        snapshot_every=int(os.environ.get("SNAPSHOT_EVERY", log.SNAPSHOT_EVERY)),
+    )
+  raise ValueError(f"Unknown store {url}, use memory, sqlite:///path or log:///path")
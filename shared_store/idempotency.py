@@ -0,0 +1,123 @@
+"""
+This module implements the Idempotency-Key header of POST /admin/orders in the
+apps without database.
+
+The response of a request sent with an Idempotency-Key header is kept for
+IDEMPOTENCY_TTL seconds in the idempotency_keys table of the app (see Tables),
+so that the keys are shared by the workers like the orders. When the client
+sends the request again with the same key (for example after a timeout, to
+another worker), the kept response is returned and no new order is created.
+The key is checked and saved in the write block creating the order: two
+requests with the same key cannot both create an order.
+At most IDEMPOTENCY_MAX_KEYS keys are kept: the least recently used key is
+forgotten first.
+"""
+
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional
+
+from fastapi import HTTPException
+from pydantic import BaseModel
+
+# 24 hours
+IDEMPOTENCY_TTL: float = 24 * 3600
+IDEMPOTENCY_MAX_KEYS: int = int(os.environ.get("IDEMPOTENCY_MAX_KEYS", 100000))
+# the name of the table of the keys
+IDEMPOTENCY_TABLE = "idempotency_keys"
+
+
+class IdempotencyKey(BaseModel):
+  """
+  A row of the idempotency_keys table
+  """
+  id: int
+  key: str
+  # time.time() and not time.monotonic(): the workers share the rows
+  expires_at: float
+  # the JSON body of the request
+  request: str
+  response: Any
+
+
+class IdempotencyStore:
+  """
+  The responses of the requests sent with an Idempotency-Key header: the
+  container of the idempotency_keys table
+  """
+
+  def __init__(self, ttl: float = IDEMPOTENCY_TTL, max_entries: int = IDEMPOTENCY_MAX_KEYS):
+    self.ttl = ttl
+    self.max_entries = max_entries
+    # key -> row, the least recently used key first
+    self._entries: Dict[str, IdempotencyKey] = OrderedDict()
+    # id -> key
+    self._keys: Dict[int, str] = {}
+
+  """
+  Container of the table
+  """
+
+  def __iter__(self) -> Iterator[IdempotencyKey]:
+    return iter(self._entries.values())
+
+  def put(self, row: IdempotencyKey):
+    if row.key in self._entries:
+      del self._keys[self._entries[row.key].id]
+    self._entries[row.key] = row
+    self._entries.move_to_end(row.key)
+    self._keys[row.id] = row.key
+
+  def delete(self, id_: int):
+    key = self._keys.pop(id_, None)
+    if key is not None:
+      del self._entries[key]
+
+  def reset(self, rows: List[IdempotencyKey]):
+    self._entries.clear()
+    self._keys.clear()
+    for row in sorted(rows, key=lambda row: row.id):
+      self.put(row)
+
+  """
+  Keys
+  """
+
+  def get(self, key: str, request_body: BaseModel) -> Optional[Any]:
+    """
+    Return the response of the request made with the key, None if there is none
+    """
+    entry = self._entries.get(key)
+    if entry is None or entry.expires_at < time.time():
+      return None
+    if entry.request != request_body.model_dump_json():
+      raise HTTPException(status_code=422,
+                          detail="Clé d'idempotence déjà utilisée pour une autre requête")
+    self._entries.move_to_end(key)
+    return entry.response
+
+  def remember(self, tables, key: str, request_body: BaseModel, response: Any):
+    """
+    Save the response of the request made with the key, in a write block of the
+    tables. The expired keys and the least recently used keys above the
+    maximum are removed.
+    """
+    now = time.time()
+    # ids of the rows to remove (a dict keeps their order): first the expired
+    # row of the same key
+    forgotten = {self._entries[key].id: None} if key in self._entries else {}
+    for row in self._entries.values():
+      # from the least recently used key
+      if row.expires_at >= now and len(self._entries) - len(forgotten) < self.max_entries:
+        break
+      forgotten[row.id] = None
+    for id_ in forgotten:
+      tables.remove(IDEMPOTENCY_TABLE, id_)
+    tables.save(IDEMPOTENCY_TABLE, IdempotencyKey(
+        id=tables.next_id(IDEMPOTENCY_TABLE),
+        key=key,
+        expires_at=now + self.ttl,
+        request=request_body.model_dump_json(),
+        response=response,
+    ))
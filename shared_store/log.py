@@ -0,0 +1,279 @@
+"""
+This module defines a store keeping the data of a single worker on disk, so
+that a restart does not lose the writes.
+
+Each write is appended to a log file (one JSON line per change). The log is
+written immediately (a crash of the process loses nothing) but fsync is only
+called every LOG_FSYNC_INTERVAL seconds by a background thread: a power
+failure loses at most the writes of the last interval, and the requests never
+wait for the disk.
+Every SNAPSHOT_EVERY writes, a snapshot of all the rows is written in a new
+file and the log starts again in a new segment. A snapshot holds one JSON
+array per table, read at startup from a memory-mapped file and validated in a
+single call for each table. The startup loads the last snapshot and replays
+the log written after it.
+
+Files of the directory:
+- snapshot-<n>: the rows before the log segment n
+- log-<n>: the changes made after the snapshot n
+"""
+
+import gc
+import json
+import mmap
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel, TypeAdapter
+
+# seconds between two fsync of the log
+LOG_FSYNC_INTERVAL: float = 0.1
+# number of writes after which a new snapshot is written
+SNAPSHOT_EVERY: int = 100000
+# number of rows serialized at once when writing a snapshot (the serialization
+# holds the GIL: small chunks let the requests run in between)
+SNAPSHOT_CHUNK_SIZE: int = 10000
+
+
+class LogStore:
+  """
+  A store for a single worker, persisted in a log and in snapshots
+  """
+
+  # the data are not shared with other workers
+  shared = False
+
+  def __init__(self, directory: str, fsync_interval: float = LOG_FSYNC_INTERVAL,
+               snapshot_every: int = SNAPSHOT_EVERY):
+    self.directory = directory
+    self.fsync_interval = fsync_interval
+    self.snapshot_every = snapshot_every
+    os.makedirs(directory, exist_ok=True)
+    self.models: Dict[str, type] = {}
+    self._next_ids: Dict[str, int] = {}
+    self._segment = 0
+    self._fd = None
+    # number of writes in the current log segment
+    self._writes = 0
+    self._dirty = False
+    # protects the file descriptor of the log from the fsync thread
+    self._lock = threading.Lock()
+    self._snapshot_thread: Optional[threading.Thread] = None
+    self._closed = threading.Event()
+    self._fsync_thread: Optional[threading.Thread] = None
+
+  def _path(self, kind: str, segment: int) -> str:
+    return os.path.join(self.directory, f"{kind}-{segment}")
+
+  def _segments(self, kind: str) -> List[int]:
+    prefix = kind + "-"
+    return sorted(int(name[len(prefix):]) for name in os.listdir(self.directory)
+                  if name.startswith(prefix) and name[len(prefix):].isdigit())
+
+  """
+  Loading
+  """
+
+  def load(self, seed: Dict[str, List[BaseModel]],
+           models: Dict[str, type]) -> Optional[Dict[str, List[BaseModel]]]:
+    """
+    Return the rows of the last snapshot updated with the log, or None if the
+    directory is empty (the tables keep the seed rows, which are written in a
+    first snapshot)
+    """
+    self.models = models
+    snapshots = self._segments("snapshot")
+    logs = self._segments("log")
+    if not snapshots and not logs:
+      self._next_ids = {name: max((row.id for row in rows), default=0) + 1
+                        for name, rows in seed.items()}
+      # the snapshot is written before the log is created: after a crash in
+      # between, a log without snapshot would be replayed without the seed rows
+      self._write_snapshot(1, seed, dict(self._next_ids))
+      self._open_segment(1)
+      self._start()
+      return None
+
+    tables = {name: {} for name in models}
+    self._next_ids = {}
+    start = 0
+    if snapshots:
+      start = snapshots[-1]
+      self._read_snapshot(self._path("snapshot", start), tables)
+    for segment in logs:
+      if segment >= start:
+        self._replay(self._path("log", segment), tables)
+    for name, rows in tables.items():
+      self._next_ids[name] = max(self._next_ids.get(name, 1), max(rows, default=0) + 1)
+    # the next writes go to a new segment: the last one can end with a torn line
+    self._open_segment(max(logs + snapshots) + 1)
+    self._start()
+    return {name: list(rows.values()) for name, rows in tables.items()}
+
+  def _read_snapshot(self, path: str, tables: Dict[str, dict]):
+    # the millions of rows created would trigger many useless collections
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+      self._read_sections(path, tables)
+    finally:
+      if gc_enabled:
+        gc.enable()
+
+  def _read_sections(self, path: str, tables: Dict[str, dict]):
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      header_end = data.find(b"\n")
+      header = json.loads(data[:header_end])
+      self._next_ids.update(header["next_ids"])
+      offset = header_end + 1
+      for name, length in header["tables"].items():
+        adapter = TypeAdapter(List[self.models[name]])
+        rows = adapter.validate_json(data[offset:offset + length])
+        tables[name].update((row.id, row) for row in rows)
+        offset += length
+
+  def _replay(self, path: str, tables: Dict[str, dict]):
+    with open(path, "rb") as file:
+      for line in file:
+        try:
+          operation, name, value = json.loads(line)
+        except ValueError:
+          # the last line of a log can be incomplete after a crash
+          break
+        if operation == "put":
+          row = self.models[name].model_validate(value)
+          tables[name][row.id] = row
+        elif operation == "delete":
+          tables[name].pop(value, None)
+        elif operation == "id":
+          self._next_ids[name] = max(self._next_ids.get(name, 1), value + 1)
+
+  """
+  Writes
+  """
+
+  @contextmanager
+  def transaction(self):
+    # a single worker writes: nothing to lock
+    yield
+
+  def _append(self, record: list):
+    line = json.dumps(record, separators=(",", ":")).encode() + b"\n"
+    with self._lock:
+      os.write(self._fd, line)
+      self._dirty = True
+    self._writes += 1
+
+  def next_id(self, name: str) -> int:
+    id_ = self._next_ids.get(name, 1)
+    self._next_ids[name] = id_ + 1
+    self._append(["id", name, id_])
+    return id_
+
+  def put(self, name: str, row: BaseModel):
+    self._next_ids[name] = max(self._next_ids.get(name, 1), row.id + 1)
+    self._append(["put", name, row.model_dump(mode="json")])
+
+  def delete(self, name: str, id_: int):
+    self._append(["delete", name, id_])
+
+  def changes(self) -> Optional[list]:
+    # no other worker can change the data
+    return []
+
+  """
+  Snapshots
+  """
+
+  def snapshot_due(self) -> bool:
+    return (self._writes >= self.snapshot_every
+            and (self._snapshot_thread is None or not self._snapshot_thread.is_alive()))
+
+  def snapshot(self, rows: Dict[str, list]):
+    """
+    Start a new log segment and write the snapshot of the given rows in a
+    background thread, which also syncs the previous segment: the event loop
+    never waits for the disk. The rows must not be modified in place afterwards.
+    """
+    segment = self._segment + 1
+    previous_fd = self._open_segment(segment)
+    self._snapshot_thread = threading.Thread(
+        target=self._write_snapshot, args=(segment, rows, dict(self._next_ids), previous_fd),
+        daemon=True)
+    self._snapshot_thread.start()
+
+  def _write_snapshot(self, segment: int, rows: Dict[str, list], next_ids: Dict[str, int],
+                      previous_fd: Optional[int] = None):
+    if previous_fd is not None:
+      # the previous segment is kept until the snapshot is written: its end
+      # must be on disk
+      os.fsync(previous_fd)
+      os.close(previous_fd)
+    sections = {}
+    for name, table_rows in rows.items():
+      adapter = TypeAdapter(List[self.models[name]])
+      chunks = (adapter.dump_json(table_rows[start:start + SNAPSHOT_CHUNK_SIZE])[1:-1]
+                for start in range(0, len(table_rows), SNAPSHOT_CHUNK_SIZE))
+      sections[name] = b"[" + b",".join(chunks) + b"]"
+    header = json.dumps({"next_ids": next_ids,
+                         "tables": {name: len(data) for name, data in sections.items()}})
+    path = self._path("snapshot", segment)
+    with open(path + ".tmp", "wb") as file:
+      file.write(header.encode() + b"\n")
+      for data in sections.values():
+        file.write(data)
+      file.flush()
+      os.fsync(file.fileno())
+    # the snapshot is complete or absent, never partially written
+    os.replace(path + ".tmp", path)
+    # the previous snapshots and logs are not needed anymore
+    for kind in ("snapshot", "log"):
+      for old in self._segments(kind):
+        if old < segment:
+          os.remove(self._path(kind, old))
+
+  """
+  Log files
+  """
+
+  def _open_segment(self, segment: int) -> Optional[int]:
+    """
+    Write the next changes in the given segment. Return the file descriptor of
+    the previous segment, which the caller must sync and close.
+    """
+    fd = os.open(self._path("log", segment), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    with self._lock:
+      previous_fd = self._fd
+      self._fd = fd
+      self._segment = segment
+      self._dirty = False
+    self._writes = 0
+    return previous_fd
+
+  def _start(self):
+    if self._fsync_thread is None or not self._fsync_thread.is_alive():
+      self._closed.clear()
+      self._fsync_thread = threading.Thread(target=self._fsync_periodically, daemon=True)
+      self._fsync_thread.start()
+
+  def _fsync_periodically(self):
+    while not self._closed.wait(self.fsync_interval):
+      with self._lock:
+        if self._dirty:
+          os.fsync(self._fd)
+          self._dirty = False
+
+  def close(self):
+    self._closed.set()
+    if self._fsync_thread is not None:
+      self._fsync_thread.join()
+    if self._snapshot_thread is not None:
+      self._snapshot_thread.join()
+    with self._lock:
+      if self._fd is not None:
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self._fd = None
+
@@ -0,0 +1,56 @@
+"""
+This module defines the default store, which keeps nothing outside of the
+memory of the worker.
+"""
+
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel
+
+
+class MemoryStore:
+  """
+  A store for a single worker: the tables in memory are the only copy of the
+  data, the store only allocates the ids
+  """
+
+  # the data are not shared with other workers
+  shared = False
+
+  def __init__(self):
+    self._next_ids: Dict[str, int] = {}
+
+  def load(self, seed: Dict[str, List[BaseModel]],
+           models: Dict[str, type]) -> Optional[Dict[str, List[BaseModel]]]:
+    """
+    Return None: the tables keep the seed rows
+    """
+    self._next_ids = {name: max((row.id for row in rows), default=0) + 1
+                      for name, rows in seed.items()}
+    return None
+
+  @contextmanager
+  def transaction(self):
+    yield
+
+  def next_id(self, name: str) -> int:
+    id_ = self._next_ids.get(name, 1)
+    self._next_ids[name] = id_ + 1
+    return id_
+
+  def put(self, name: str, row: BaseModel):
+    self._next_ids[name] = max(self._next_ids.get(name, 1), row.id + 1)
+
+  def delete(self, name: str, id_: int):
+    pass
+
+  def changes(self) -> Optional[list]:
+    # no other worker can change the data
+    return []
+
+  def snapshot_due(self) -> bool:
+    return False
+
+  def close(self):
+    pass
@@ -0,0 +1,18 @@
+"""
+This module defines the ASGI middleware updating the tables before each request.
+"""
+
+
+class SyncMiddleware:
+  """
+  Apply the changes made by the other workers before processing a request
+  """
+
+  def __init__(self, app, tables):
+    self.app = app
+    self.tables = tables
+
+  async def __call__(self, scope, receive, send):
+    if scope["type"] == "http" and self.tables.store.shared:
+      await self.tables.sync()
+    await self.app(scope, receive, send)
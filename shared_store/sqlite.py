@@ -0,0 +1,195 @@
+"""
+This module defines the store shared by several workers through a SQLite file.
+
+The rows are stored as JSON in the rows table. Each write also appends the
+(name, id) of the changed row to the changes table: a worker reads the changes
+made since its last read to update its tables in memory, instead of reloading
+all the rows. PRAGMA data_version tells whether another connection wrote in
+the file, so that the changes table is only read when needed.
+The writes are made in BEGIN IMMEDIATE transactions, which take the write lock
+of the file: the checks made in a transaction cannot be invalidated by another
+worker before the commit.
+"""
+
+import sqlite3
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel
+
+# seconds to wait for the write lock held by another worker
+BUSY_TIMEOUT: float = 5
+# number of changes kept: a worker which missed older changes reloads all the rows
+CHANGE_LOG_SIZE: int = 100000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rows (
+  name TEXT NOT NULL,
+  id INTEGER NOT NULL,
+  data TEXT NOT NULL,
+  PRIMARY KEY (name, id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS next_ids (
+  name TEXT PRIMARY KEY,
+  next_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS changes (
+  seq INTEGER PRIMARY KEY AUTOINCREMENT,
+  name TEXT NOT NULL,
+  id INTEGER NOT NULL
+);
+"""
+
+
+class SQLiteStore:
+  """
+  A store shared by the workers through a SQLite file
+  """
+
+  shared = True
+
+  def __init__(self, path: str, change_log_size: int = CHANGE_LOG_SIZE):
+    self.change_log_size = change_log_size
+    # isolation_level=None: the transactions are started explicitly
+    self.connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None,
+                                      check_same_thread=False)
+    # the readers do not block the writer
+    self.connection.execute("PRAGMA journal_mode=WAL")
+    self.connection.execute("PRAGMA synchronous=NORMAL")
+    self.connection.executescript(SCHEMA)
+    self._in_transaction = False
+    self._data_version = None
+    # the last change read from the changes table
+    self._last_change = 0
+    # the changes of the other workers read but not yet returned by changes():
+    # (name, id) -> JSON of the row, None if it was deleted
+    self._pending: Dict[tuple, Optional[str]] = {}
+    # some changes were removed from the changes table before being read
+    self._missed = False
+    # the model of the rows of each table, given by load
+    self.models: Dict[str, type] = {}
+
+  def _execute(self, query: str, parameters=()):
+    return self.connection.execute(query, parameters)
+
+  def load(self, seed: Dict[str, List[BaseModel]],
+           models: Dict[str, type]) -> Optional[Dict[str, List[BaseModel]]]:
+    """
+    Return the rows of each table, as instances of their model. The first
+    worker to start fills an empty store with the seed rows.
+    """
+    self.models = models
+    with self.transaction():
+      if self._execute("SELECT 1 FROM next_ids LIMIT 1").fetchone() is None:
+        for name, rows in seed.items():
+          self.connection.executemany(
+              "INSERT INTO rows (name, id, data) VALUES (?, ?, ?)",
+              ((name, row.id, row.model_dump_json()) for row in rows)
+          )
+          self._execute("INSERT INTO next_ids (name, next_id) VALUES (?, ?)",
+                        (name, max((row.id for row in rows), default=0) + 1))
+      # the rows read below include all the changes already made
+      self._last_change = self._execute("SELECT coalesce(max(seq), 0) FROM changes").fetchone()[0]
+      self._pending, self._missed = {}, False
+      return {name: self.rows(name) for name in seed}
+
+  def rows(self, name: str) -> List[BaseModel]:
+    model = self.models[name]
+    query = "SELECT data FROM rows WHERE name = ? ORDER BY id"
+    return [model.model_validate_json(data) for (data,) in self._execute(query, (name,))]
+
+  @contextmanager
+  def transaction(self):
+    """
+    Hold the write lock of the file until the end of the block. The changes
+    of the other workers are read first (see changes): the changes logged
+    afterwards are made by this worker.
+    """
+    if self._in_transaction:
+      yield
+      return
+    self._execute("BEGIN IMMEDIATE")
+    self._in_transaction = True
+    try:
+      self._read_changes()
+      yield
+      # the own changes are already applied to the tables in memory. Read before
+      # the commit: afterwards another worker can log new changes.
+      last_change = self._execute("SELECT coalesce(max(seq), 0) FROM changes").fetchone()[0]
+    except BaseException:
+      self._execute("ROLLBACK")
+      raise
+    else:
+      self._execute("COMMIT")
+      self._last_change = last_change
+    finally:
+      self._in_transaction = False
+
+  def next_id(self, name: str) -> int:
+    with self.transaction():
+      row = self._execute("SELECT next_id FROM next_ids WHERE name = ?", (name,)).fetchone()
+      id_ = row[0] if row is not None else 1
+      self._execute("INSERT OR REPLACE INTO next_ids (name, next_id) VALUES (?, ?)",
+                    (name, id_ + 1))
+      return id_
+
+  def _log_change(self, name: str, id_: int):
+    seq = self._execute("INSERT INTO changes (name, id) VALUES (?, ?)", (name, id_)).lastrowid
+    if seq % 1000 == 0:
+      self._execute("DELETE FROM changes WHERE seq <= ?", (seq - self.change_log_size,))
+
+  def put(self, name: str, row: BaseModel):
+    with self.transaction():
+      self._execute("INSERT OR REPLACE INTO rows (name, id, data) VALUES (?, ?, ?)",
+                    (name, row.id, row.model_dump_json()))
+      self._execute("UPDATE next_ids SET next_id = max(next_id, ?) WHERE name = ?",
+                    (row.id + 1, name))
+      self._log_change(name, row.id)
+
+  def delete(self, name: str, id_: int):
+    with self.transaction():
+      self._execute("DELETE FROM rows WHERE name = ? AND id = ?", (name, id_))
+      self._log_change(name, id_)
+
+  def _read_changes(self):
+    """
+    Read the changes made by the other workers since the last read
+    """
+    data_version = self._execute("PRAGMA data_version").fetchone()[0]
+    if data_version == self._data_version:
+      return
+    self._data_version = data_version
+    first = self._execute("SELECT min(seq) FROM changes").fetchone()[0]
+    if first is not None and first > self._last_change + 1:
+      self._missed = True
+    query = """
+      SELECT changes.seq, changes.name, changes.id, rows.data
+      FROM changes LEFT JOIN rows ON rows.name = changes.name AND rows.id = changes.id
+      WHERE changes.seq > ?
+      ORDER BY changes.seq
+    """
+    for seq, name, id_, data in self._execute(query, (self._last_change,)):
+      # the last state of each changed row
+      self._pending[(name, id_)] = data
+      self._last_change = seq
+
+  def changes(self) -> Optional[list]:
+    """
+    Return the (name, id, row or None if it was deleted) of the rows changed by
+    the other workers since the last call, or None if some changes were
+    already removed from the changes table (all the rows must be reloaded)
+    """
+    self._read_changes()
+    pending, self._pending = self._pending, {}
+    if self._missed:
+      self._missed = False
+      return None
+    return [(name, id_, self.models[name].model_validate_json(data) if data is not None else None)
+            for (name, id_), data in pending.items()]
+
+  def snapshot_due(self) -> bool:
+    # the rows table is always up to date
+    return False
+
+  def close(self):
+    self.connection.close()
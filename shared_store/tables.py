@@ -0,0 +1,174 @@
+"""
+This module keeps the tables of an app in memory, in sync with its store.
+"""
+
+import asyncio
+import sys
+from contextlib import asynccontextmanager
+from typing import Dict, Iterator, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+
+class ListTable:
+  """
+  The rows of a table kept in a list, in the order of their insertion
+  """
+
+  def __init__(self, rows: list):
+    self.rows = rows
+
+  def __iter__(self) -> Iterator:
+    return iter(self.rows)
+
+  def _index(self, id_: int):
+    for i, row in enumerate(self.rows):
+      if row.id == id_:
+        return i
+    return None
+
+  def put(self, row):
+    i = self._index(row.id)
+    if i is None:
+      self.rows.append(row)
+    else:
+      self.rows[i] = row
+
+  def delete(self, id_: int):
+    i = self._index(id_)
+    if i is not None:
+      del self.rows[i]
+
+  def reset(self, rows: list):
+    # the list is modified in place: the app keeps a reference to it
+    self.rows[:] = rows
+
+
+class Tables:
+  """
+  The tables of an app: each one is a name, the Pydantic model of its rows and
+  a container of the rows in memory with the methods put, delete, reset and
+  __iter__ (see ListTable).
+  The reads use the containers only. The writes are made with write, save and
+  remove, which update the store and the containers.
+  The files of a shared store are read and locked in a thread: waiting for the
+  lock held by another worker does not block the event loop.
+  """
+
+  def __init__(self, store, tables: Dict[str, Tuple[type, object]]):
+    self.store = store
+    self.tables = tables
+    # a row was written in the current write block
+    self._written = False
+    # one write block or sync at a time in the worker: they share the
+    # connection of the store
+    self._lock = asyncio.Lock()
+
+  def load(self):
+    """
+    Fill the store with the rows of the containers if it is empty, and the
+    containers with the rows of the store otherwise
+    """
+    rows = self.store.load({name: list(table) for name, (_, table) in self.tables.items()},
+                           {name: model for name, (model, _) in self.tables.items()})
+    if rows is not None:
+      self._reset(rows)
+
+  def _reset(self, rows: Dict[str, list]):
+    for name, (_, table) in self.tables.items():
+      table.reset(rows[name])
+
+  async def _run(self, function, *args):
+    if self.store.shared:
+      return await run_in_threadpool(function, *args)
+    return function(*args)
+
+  def _all_rows(self) -> Dict[str, list]:
+    # only the shared stores keep the rows (the other ones have no rows method)
+    return {name: self.store.rows(name) for name in self.tables}
+
+  def _read_changes(self) -> Tuple[Optional[list], Optional[Dict[str, list]]]:
+    """
+    Return the changes made by the other workers, or None and all the rows if
+    some changes were missed
+    """
+    changes = self.store.changes()
+    if changes is None:
+      return None, self._all_rows()
+    return changes, None
+
+  def _apply(self, changes: Optional[list], rows: Optional[Dict[str, list]]):
+    if rows is not None:
+      self._reset(rows)
+      return
+    for name, id_, row in changes:
+      table = self.tables[name][1]
+      if row is None:
+        table.delete(id_)
+      else:
+        table.put(row)
+
+  async def sync(self):
+    """
+    Apply to the containers the changes made by the other workers. Skipped
+    while a write block of this worker waits for the lock of the store: the
+    reads do not wait for the writes of the other workers, and the write block
+    applies their changes when it gets the lock.
+    """
+    if self._lock.locked():
+      return
+    async with self._lock:
+      self._apply(*await self._run(self._read_changes))
+
+  @asynccontextmanager
+  async def write(self):
+    """
+    A block where the tables are up to date and cannot be changed by the other
+    workers. It should not contain any await: the block is a transaction of the
+    store, which holds its lock.
+    """
+    async with self._lock:
+      self._written = False
+      transaction = self.store.transaction()
+
+      def begin():
+        transaction.__enter__()
+        try:
+          return self._read_changes()
+        except BaseException:
+          transaction.__exit__(*sys.exc_info())
+          raise
+
+      self._apply(*await self._run(begin))
+      try:
+        yield
+      except BaseException as error:
+        await self._run(transaction.__exit__, type(error), error, error.__traceback__)
+        if self._written and self.store.shared:
+          # the writes were rolled back in the store but not in the containers
+          self._reset(await self._run(self._all_rows))
+        raise
+      await self._run(transaction.__exit__, None, None, None)
+    if self.store.snapshot_due():
+      # the rows are replaced, never modified in place: the store can write
+      # the copies of the lists while the app keeps on writing
+      self.store.snapshot({name: list(table) for name, (_, table) in self.tables.items()})
+
+  def next_id(self, name: str) -> int:
+    return self.store.next_id(name)
+
+  def save(self, name: str, row):
+    """
+    Add or replace the row having the same id
+    """
+    self.store.put(name, row)
+    self._written = True
+    self.tables[name][1].put(row)
+
+  def remove(self, name: str, id_: int):
+    self.store.delete(name, id_)
+    self._written = True
+    self.tables[name][1].delete(id_)
+
+  def close(self):
+    self.store.close()
@@ -0,0 +1,8 @@
+"""
+Deterministic generator of realistic products, users and orders, used to test
+the apis at scale instead of the five fixtures of resources.py:
+- generate builds the data as dictionaries accepted by the schemas of the apps
+- sql.load_database bulk loads the data in a database of app_with_db
+"""
+
+from .generator import generate
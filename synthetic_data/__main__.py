@@ -0,0 +1,41 @@
+"""
+Generate data and load it in a database of app_with_db or save it in a JSON file.
+
+Usage:
+  python -m synthetic_data --products 100000 --database-url sqlite+aiosqlite:///shop.db
+  python -m synthetic_data --products 1000 --output data.json
+"""
+
+import argparse
+import asyncio
+import json
+
+from .generator import generate
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--products", type=int, required=True)
+  parser.add_argument("--users", type=int, help="products / 10 by default")
+  parser.add_argument("--orders", type=int, help="products / 10 by default")
+  parser.add_argument("--seed", type=int, default=0)
+  target = parser.add_mutually_exclusive_group(required=True)
+  target.add_argument("--database-url",
+                      help="async SQLAlchemy url of a database without products, users and orders")
+  target.add_argument("--output", help="JSON file")
+  options = parser.parse_args()
+
+  dataset = generate(options.products, options.users, options.orders, options.seed)
+  if options.output:
+    with open(options.output, "w") as file:
+      json.dump(dataset, file)
+  else:
+    from .sql import load_database
+    asyncio.run(load_database(options.database_url, dataset))
+  print(f"{len(dataset['products'])} products, {len(dataset['users'])} users and "
+        f"{len(dataset['orders'])} orders generated")
+
+
+if __name__ == "__main__":
+  main()
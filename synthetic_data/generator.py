@@ -0,0 +1,137 @@
+"""
+This module generates the data. The distributions are skewed as in a real shop:
+- a few categories contain most of the products (Zipf law)
+- a few products receive most of the orders, and a few users make most of them
+- the prices follow a log-normal law around a typical price of the category
+The same seed always gives the same data.
+"""
+
+import itertools
+import random
+from typing import List, Optional
+
+# (category, typical price, names of products, adjectives)
+CATEGORIES = [
+    ("Electronique", 120.0, ["Smartwatch", "Casque Audio", "Enceinte", "Tablette", "Chargeur"],
+     ["Alpha", "Pro", "Max", "Mini", "Connecte"]),
+    ("Alimentation", 12.0, ["Cafe", "The", "Chocolat", "Miel", "Huile d'Olive"],
+     ["Gourmet", "Bio", "Artisanal", "Equitable", "Premium"]),
+    ("Vetements", 45.0, ["T-shirt", "Pull", "Veste", "Jean", "Echarpe"],
+     ["Coton", "Laine", "Classique", "Sport", "Slim"]),
+    ("Maison", 35.0, ["Lampe", "Coussin", "Tapis", "Vase", "Horloge"],
+     ["Design", "Scandinave", "Vintage", "Moderne", "Zen"]),
+    ("Mobilier", 180.0, ["Chaise de Bureau", "Bureau", "Etagere", "Canape", "Table"],
+     ["Ergonomique", "Pliable", "Chene", "Compact", "Industriel"]),
+    ("Sport", 60.0, ["Ballon", "Tapis de Yoga", "Haltere", "Raquette", "Gourde"],
+     ["Performance", "Leger", "Resistant", "Compact", "Pro"]),
+    ("Livres", 18.0, ["Roman", "Guide", "Bande Dessinee", "Dictionnaire", "Essai"],
+     ["Illustre", "Poche", "Collector", "Edition Limitee", "Classique"]),
+    ("Jardin", 40.0, ["Arrosoir", "Secateur", "Jardiniere", "Tuyau", "Hamac"],
+     ["Robuste", "Ecologique", "Extensible", "Inox", "Mural"]),
+    ("Beaute", 25.0, ["Creme", "Parfum", "Shampoing", "Savon", "Serum"],
+     ["Hydratant", "Naturel", "Bio", "Doux", "Intense"]),
+    ("Jouets", 30.0, ["Puzzle", "Peluche", "Jeu de Societe", "Voiture", "Poupee"],
+     ["Educatif", "Geant", "Classique", "Magique", "Junior"]),
+]
+
+FIRST_NAMES = ["Alice", "Bob", "Charlie", "Diana", "Eve", "Louis", "Emma", "Hugo", "Lea",
+               "Jules", "Chloe", "Nathan", "Manon", "Lucas", "Ines", "Adam", "Sarah",
+               "Gabriel", "Camille", "Arthur"]
+LAST_NAMES = ["Martin", "Bernard", "Dubois", "Thomas", "Robert", "Richard", "Petit",
+              "Durand", "Leroy", "Moreau", "Simon", "Laurent", "Lefebvre", "Michel"]
+STREETS = ["rue de la Paix", "avenue des Fleurs", "boulevard Voltaire", "rue du Moulin",
+           "chemin des Vignes", "place de la Gare", "allee des Tilleuls"]
+CITIES = ["Paris", "Lyon", "Marseille", "Toulouse", "Nantes", "Lille", "Bordeaux", "Rennes"]
+DOMAINS = ["example.com", "mail.fr", "exemple.org"]
+
+# weights of the status of the orders
+STATUS_WEIGHTS = {"Completed": 60, "Shipped": 20, "Pending": 15, "Cancelled": 5}
+
+
+def zipf_weights(count: int, exponent: float = 1.1) -> List[float]:
+  """
+  Cumulative weights of a Zipf law: the element of rank k has a weight 1 / k^exponent
+  """
+  return list(itertools.accumulate(1 / rank ** exponent for rank in range(1, count + 1)))
+
+
+def generate_products(count: int, rng: random.Random) -> List[dict]:
+  category_weights = zipf_weights(len(CATEGORIES))
+  products = []
+  for id_ in range(1, count + 1):
+    category, typical_price, names, adjectives = rng.choices(
+        CATEGORIES, cum_weights=category_weights)[0]
+    name, adjective = rng.choice(names), rng.choice(adjectives)
+    products.append({
+        "id": id_,
+        # the reference makes the products unique
+        "product_name": f"{name} {adjective} {id_:07d}",
+        "description": f"{name} {adjective.lower()} de la gamme {category.lower()}.",
+        "price": round(max(rng.lognormvariate(0, 0.6) * typical_price, 0.5), 2),
+        "category": category,
+        # 5% of the products are out of stock, a few have a large stock
+        "stock": 0 if rng.random() < 0.05 else int(rng.paretovariate(1.2) * 20),
+    })
+  return products
+
+
+def generate_users(count: int, rng: random.Random) -> List[dict]:
+  users = []
+  for id_ in range(1, count + 1):
+    first_name, last_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+    username = f"{first_name.lower()}.{last_name.lower()}{id_}"
+    users.append({
+        "id": id_,
+        "username": username,
+        "email": f"{username}@{rng.choice(DOMAINS)}",
+        "address": f"{rng.randint(1, 200)} {rng.choice(STREETS)} {rng.choice(CITIES)}",
+        "password": f"{rng.getrandbits(64):016x}",
+    })
+  return users
+
+
+def generate_orders(count: int, products: List[dict], users: List[dict],
+                    rng: random.Random) -> List[dict]:
+  # the popularity of a product or a user does not depend on its id
+  popular_products = rng.sample(products, len(products))
+  product_weights = zipf_weights(len(products))
+  active_users = rng.sample(users, len(users))
+  user_weights = zipf_weights(len(users), exponent=0.8)
+  status, status_weights = list(STATUS_WEIGHTS), list(STATUS_WEIGHTS.values())
+  orders = []
+  for id_ in range(1, count + 1):
+    ordered = {product["id"]: product for product in rng.choices(
+        popular_products, cum_weights=product_weights, k=rng.choices([1, 2, 3, 4],
+                                                                      [50, 25, 15, 10])[0])}
+    items = [
+        {"product_id": product["id"],
+         "ordered_quantity": rng.choices([1, 2, 3], [70, 20, 10])[0],
+         "unit_price": product["price"]}
+        for product in ordered.values()
+    ]
+    orders.append({
+        "id": id_,
+        "user_id": rng.choices(active_users, cum_weights=user_weights)[0]["id"],
+        "items": items,
+        "total": round(sum(item["unit_price"] * item["ordered_quantity"] for item in items), 2),
+        "status": rng.choices(status, status_weights)[0],
+    })
+  return orders
+
+
+def generate(products: int, users: Optional[int] = None, orders: Optional[int] = None,
+             seed: int = 0) -> dict:
+  """
+  Return {"products": [...], "users": [...], "orders": [...]} with the given number
+  of products, and by default one user and one order for 10 products
+  """
+  rng = random.Random(seed)
+  users = max(products // 10, 1) if users is None else users
+  orders = max(products // 10, 1) if orders is None else orders
+  all_products = generate_products(products, rng)
+  all_users = generate_users(users, rng)
+  return {
+      "products": all_products,
+      "users": all_users,
+      "orders": generate_orders(orders, all_products, all_users, rng) if all_products else [],
+  }
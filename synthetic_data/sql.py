@@ -0,0 +1,52 @@
+"""
+This module bulk loads generated data in a database of app_with_db
+"""
+
+from typing import Iterator, List
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app_with_db import models
+
+# number of rows inserted by a statement (executemany)
+BATCH_SIZE: int = 10000
+
+
+def batches(rows: List[dict]) -> Iterator[List[dict]]:
+  for start in range(0, len(rows), BATCH_SIZE):
+    yield rows[start:start + BATCH_SIZE]
+
+
+async def insert_dataset(conn, dataset: dict):
+  """
+  Insert the data returned by generate with the given connection
+  """
+  products = [
+      dict(product, content_hash=models.product_hash(product["product_name"],
+                                                     product["description"],
+                                                     product["price"],
+                                                     product["category"]))
+      for product in dataset["products"]
+  ]
+  orders = [{key: order[key] for key in ("id", "user_id", "total", "status")}
+            for order in dataset["orders"]]
+  orderlines = [dict(item, order_id=order["id"])
+                for order in dataset["orders"] for item in order["items"]]
+  for model, rows in ((models.Product, products), (models.User, dataset["users"]),
+                      (models.Order, orders), (models.OrderLine, orderlines)):
+    for batch in batches(rows):
+      await conn.execute(insert(model), batch)
+
+
+async def load_database(url: str, dataset: dict):
+  """
+  Create the tables of app_with_db in the database and insert the data
+  """
+  engine = create_async_engine(url)
+  try:
+    async with engine.begin() as conn:
+      await conn.run_sync(models.Base.metadata.create_all)
+      await insert_dataset(conn, dataset)
+  finally:
+    await engine.dispose()
@@ -0,0 +1,52 @@
+"""
+Common fixtures of the tests of app_with_db, run on a temporary SQLite database
+"""
+
+import os
+import tempfile
+
+import httpx
+import pytest
+from sqlalchemy import event
+
+# set before app_with_db is imported: the engine reads it when it is created
+os.environ["DATABASE_URL"] = ("sqlite+aiosqlite:///"
+                              + os.path.join(tempfile.mkdtemp(), "tests.db"))
+
+from app_with_db.main import app  # noqa: E402
+
+
+class QueryCounter:
+  """
+  Count the queries run by the engine in a with block
+  """
+
+  def __init__(self, engine):
+    self.engine = engine.sync_engine
+    self.statements = []
+
+  def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+    self.statements.append(statement)
+
+  def __enter__(self):
+    event.listen(self.engine, "after_cursor_execute", self.after_cursor_execute)
+    return self
+
+  def __exit__(self, *args):
+    event.remove(self.engine, "after_cursor_execute", self.after_cursor_execute)
+
+
+@pytest.fixture
+def anyio_backend():
+  return "asyncio"
+
+
+@pytest.fixture
+async def client():
+  """
+  A client of app_with_db, with the database connected and the tables created
+  """
+  async with app.router.lifespan_context(app):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+      yield client
@@ -0,0 +1,135 @@
+"""
+The bulk endpoints (/products/bulk) write the valid rows of a batch and give
+the result of each row
+"""
+
+import itertools
+import json
+from collections import Counter
+
+import pytest
+
+from app_with_db import main
+
+pytestmark = pytest.mark.anyio
+
+# each test uses its own product names
+names = (f"Bulk {i}" for i in itertools.count())
+
+
+def new_product(**attributes) -> dict:
+  return {"product_name": next(names), "description": "Bulk", "price": 5.0,
+          "category": "Bulk", "stock": 10, **attributes}
+
+
+async def add(client, product: dict) -> int:
+  response = await client.post("/products", json=product)
+  assert response.status_code == 201
+  return response.json()["id"]
+
+
+def statuses(results: list) -> Counter:
+  return Counter(result["status"] for result in results)
+
+
+async def test_insert_mixed_batch(client):
+  existing = new_product()
+  existing_id = await add(client, existing)
+  first, second = new_product(), new_product()
+  response = await client.post("/products/bulk", json=[
+      first,
+      existing,
+      second,
+      # identical to a previous row of the body
+      first,
+      {"product_name": "Bulk invalid", "price": "cheap"},
+  ])
+  assert response.status_code == 200
+  results = response.json()
+  assert [result["index"] for result in results] == [0, 1, 2, 3, 4]
+  assert statuses(results) == {"created": 2, "conflict": 2, "invalid": 1}
+  assert results[1]["id"] == existing_id
+  assert "price" in results[4]["detail"]
+  for index, product in ((0, first), (2, second)):
+    stored = (await client.get(f"/products/{results[index]['id']}")).json()
+    assert stored["product_name"] == product["product_name"]
+
+
+async def test_insert_ndjson(client):
+  products = [new_product(), new_product()]
+  response = await client.post("/products/bulk",
+                               content="\n".join(json.dumps(product) for product in products),
+                               headers={"Content-Type": "application/x-ndjson"})
+  assert response.status_code == 200
+  assert statuses(response.json()) == {"created": 2}
+
+
+async def test_upsert_mixed_batch(client):
+  updated = new_product()
+  updated_id = await add(client, updated)
+  other = new_product()
+  other_id = await add(client, other)
+  response = await client.put("/products/bulk", json=[
+      # only the stock changes
+      {"id": updated_id, "stock": 3},
+      {"id": 10 ** 9, "stock": 1},
+      new_product(),
+      # would become identical to the product updated_id
+      {"id": other_id, "product_name": updated["product_name"]},
+      {"id": "not an id"},
+  ])
+  assert response.status_code == 200
+  results = response.json()
+  assert statuses(results) == {"updated": 1, "not_found": 1, "created": 1, "conflict": 1,
+                               "invalid": 1}
+  stored = (await client.get(f"/products/{updated_id}")).json()
+  assert stored["stock"] == 3
+  assert stored["product_name"] == updated["product_name"]
+  assert (await client.get(f"/products/{other_id}")).json()["product_name"] == other["product_name"]
+
+
+async def test_delete_batch(client):
+  deleted_id = await add(client, new_product())
+  ordered_id = await add(client, new_product(price=2.0))
+  response = await client.post("/admin/orders", json={
+      "user_id": 1,
+      "items": [{"product_id": ordered_id, "ordered_quantity": 1, "unit_price": 2.0}],
+      "total": 2.0,
+      "status": "Pending",
+  })
+  assert response.status_code == 201
+  response = await client.request("DELETE", "/products/bulk",
+                                  json=[deleted_id, deleted_id, ordered_id, 10 ** 9, "x"])
+  assert response.status_code == 200
+  results = response.json()
+  assert [result["status"] for result in results] == [
+      "deleted", "not_found", "conflict", "not_found", "invalid"]
+  assert (await client.get(f"/products/{deleted_id}")).status_code == 404
+  assert (await client.get(f"/products/{ordered_id}")).status_code == 200
+
+
+@pytest.mark.parametrize("ndjson", [False, True])
+async def test_oversized_batch_is_refused(client, monkeypatch, ndjson):
+  monkeypatch.setattr(main, "BULK_MAX_ROWS", 3)
+  products = [new_product() for _ in range(4)]
+  if ndjson:
+    response = await client.post("/products/bulk",
+                                 content="\n".join(json.dumps(product) for product in products),
+                                 headers={"Content-Type": "application/x-ndjson"})
+  else:
+    response = await client.post("/products/bulk", json=products)
+  assert response.status_code == 413
+  # nothing was written
+  response = await client.get("/products", params={"product_name": products[0]["product_name"]})
+  assert response.json()["items"] == []
+  # the maximum is accepted
+  response = await client.post("/products/bulk", json=products[:3])
+  assert statuses(response.json()) == {"created": 3}
+
+
+async def test_invalid_body(client):
+  response = await client.post("/products/bulk", content=b"{not json",
+                               headers={"Content-Type": "application/json"})
+  assert response.status_code == 400
+  response = await client.post("/products/bulk", json={"product_name": "not an array"})
+  assert response.status_code == 400
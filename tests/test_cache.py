@@ -0,0 +1,166 @@
+"""
+The responses of GET /products and the rows read by id are cached, and every
+write invalidates them
+"""
+
+import itertools
+
+import pytest
+
+from app_with_db import db, main
+from app_with_db.cache import CatalogCache, EntityCache, catalog_cache
+
+from conftest import QueryCounter
+
+pytestmark = pytest.mark.anyio
+
+# each test adds its products in a new category
+categories = (f"Cache {i}" for i in itertools.count())
+
+
+def new_product(category: str, name: str = "Cached", **attributes) -> dict:
+  return {"product_name": name, "description": "Cache", "price": 8.0,
+          "category": category, "stock": 20, **attributes}
+
+
+async def catalog(client, category: str, etag: str = None):
+  headers = {"If-None-Match": etag} if etag else {}
+  return await client.get("/products", params={"product_category": category}, headers=headers)
+
+
+async def test_etag_and_304(client):
+  category = next(categories)
+  await client.post("/products", json=new_product(category))
+  first = await catalog(client, category)
+  assert first.status_code == 200
+  etag = first.headers["ETag"]
+  with QueryCounter(db.get_engine()) as counter:
+    second = await catalog(client, category)
+    not_modified = await catalog(client, category, etag)
+    weak = await catalog(client, category, f'"other", W/{etag}')
+  # answered from the cache
+  assert counter.statements == []
+  assert second.content == first.content
+  assert second.headers["ETag"] == etag
+  assert not_modified.status_code == weak.status_code == 304
+  assert not_modified.content == b""
+  assert (await catalog(client, category, '"other"')).status_code == 200
+
+
+async def test_catalog_is_invalidated_by_the_writes(client):
+  category = next(categories)
+  product_id = (await client.post("/products", json=new_product(category))).json()["id"]
+
+  async def names_after(etag: str) -> list:
+    response = await catalog(client, category, etag)
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    return response.headers["ETag"], [product["product_name"]
+                                      for product in response.json()["items"]]
+
+  etag = (await catalog(client, category)).headers["ETag"]
+  await client.post("/products", json=new_product(category, "Added"))
+  etag, names = await names_after(etag)
+  assert names == ["Cached", "Added"]
+
+  await client.put(f"/products/{product_id}", json=new_product(category, "Modified"))
+  etag, names = await names_after(etag)
+  assert names == ["Modified", "Added"]
+
+  await client.delete(f"/products/{product_id}")
+  etag, names = await names_after(etag)
+  assert names == ["Added"]
+
+
+@pytest.mark.parametrize("collection", ["products", "users", "orders"])
+async def test_entities_are_invalidated_by_the_writes(client, collection):
+  category = next(categories)
+  product = (await client.post("/products", json=new_product(category))).json()
+  body, url, changed = {
+      "products": (new_product(category), "/products", {"stock": 5}),
+      "users": ({"username": category, "email": f"{category}@mail.fr", "password": "secret"},
+                "/admin/users", {"address": "2 rue du Cache Lyon"}),
+      "orders": ({"user_id": 1, "status": "Pending", "total": 8.0,
+                  "items": [{"product_id": product["id"], "ordered_quantity": 1,
+                             "unit_price": 8.0}]},
+                 "/admin/orders", {"status": "Shipped"}),
+  }[collection]
+  if collection == "users":
+    id_ = (await client.post("/users", json=body)).json()["id"]
+  elif collection == "orders":
+    id_ = (await client.post("/admin/orders", json=body)).json()["id"]
+  else:
+    id_ = product["id"]
+  assert (await client.get(f"{url}/{id_}")).status_code == 200
+  with QueryCounter(db.get_engine()) as counter:
+    assert (await client.get(f"{url}/{id_}")).status_code == 200
+  assert counter.statements == []
+
+  response = await client.put(f"{url}/{id_}", json={**body, **changed})
+  assert response.status_code == 200
+  stored = (await client.get(f"{url}/{id_}")).json()
+  assert {key: stored[key] for key in changed} == changed
+
+  await client.delete(f"{url}/{id_}")
+  assert (await client.get(f"{url}/{id_}")).status_code == 404
+
+
+async def test_order_invalidates_the_stock(client):
+  category = next(categories)
+  product = (await client.post("/products", json=new_product(category))).json()
+  assert (await client.get(f"/products/{product['id']}")).json()["stock"] == 20
+  etag = (await catalog(client, category)).headers["ETag"]
+  await client.post("/admin/orders", json={
+      "user_id": 1, "status": "Pending", "total": 24.0,
+      "items": [{"product_id": product["id"], "ordered_quantity": 3, "unit_price": 8.0}],
+  })
+  assert (await client.get(f"/products/{product['id']}")).json()["stock"] == 17
+  response = await catalog(client, category, etag)
+  assert response.status_code == 200
+  assert response.json()["items"][0]["stock"] == 17
+
+
+async def test_page_read_during_a_write_is_not_cached(client, monkeypatch):
+  category = next(categories)
+  await client.post("/products", json=new_product(category))
+  paginate = main.paginate
+
+  async def paginate_during_a_write(*args, **kwargs):
+    page = await paginate(*args, **kwargs)
+    # a write on the products is committed while the page is read
+    catalog_cache.invalidate()
+    return page
+
+  monkeypatch.setattr(main, "paginate", paginate_during_a_write)
+  assert (await catalog(client, category)).status_code == 200
+  monkeypatch.setattr(main, "paginate", paginate)
+  with QueryCounter(db.get_engine()) as counter:
+    assert (await catalog(client, category)).status_code == 200
+  # the page read before the write was not cached
+  assert counter.statements
+
+
+def test_catalog_cache_generation():
+  cache = CatalogCache(max_entries=10, ttl=60)
+  generation = cache.generation
+  cache.invalidate()
+  etag = cache.put(("key",), b"stale", generation)
+  assert etag.startswith('"')
+  assert cache.get(("key",)) is None
+  etag = cache.put(("key",), b"fresh", cache.generation)
+  assert cache.get(("key",)) == (etag, b"fresh")
+  cache.invalidate()
+  assert cache.get(("key",)) is None
+
+
+def test_entity_cache_generation_and_eviction():
+  cache = EntityCache(max_entries=2, ttl=60)
+  generation = cache.generation
+  cache.invalidate(1)
+  cache.put(1, "stale", generation)
+  assert cache.get(1) is None
+  for key in (1, 2, 3):
+    cache.put(key, f"value {key}", cache.generation)
+  assert cache.get(1) is None
+  assert cache.get(3) == "value 3"
+  assert cache.statistics()["evictions"] == 1
@@ -0,0 +1,40 @@
+"""
+Many concurrent orders for the same product must never oversell it: the stock
+is checked and decremented by the database in a single statement
+"""
+
+import asyncio
+from collections import Counter
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+STOCK = 50
+QUANTITY = 2
+ORDERS = 200
+
+
+async def test_hot_sku_is_not_oversold(client):
+  response = await client.post("/products", json={
+      "product_name": "Hot SKU", "price": 10.0, "stock": STOCK,
+  })
+  product_id = response.json()["id"]
+  order = {
+      "user_id": 1,
+      "items": [{"product_id": product_id, "ordered_quantity": QUANTITY, "unit_price": 10.0}],
+      "total": 10.0 * QUANTITY,
+      "status": "Pending",
+  }
+
+  async def send() -> int:
+    return (await client.post("/admin/orders", json=order)).status_code
+
+  statuses = Counter(await asyncio.gather(*(send() for _ in range(ORDERS))))
+  remaining = (await client.get(f"/products/{product_id}")).json()["stock"]
+
+  # the other orders are refused because the stock is not sufficient
+  assert set(statuses) <= {201, 400}, statuses
+  assert remaining >= 0
+  assert statuses[201] * QUANTITY == STOCK
+  assert remaining == 0
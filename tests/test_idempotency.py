@@ -0,0 +1,134 @@
+"""
+POST /admin/orders sent again with the same Idempotency-Key header returns the
+response of the first request without creating a second order
+"""
+
+import asyncio
+import itertools
+
+import httpx
+import pytest
+
+from app_with_db import idempotency, main
+
+pytestmark = pytest.mark.anyio
+
+keys = (f"key-{i}" for i in itertools.count())
+names = (f"Idempotent {i}" for i in itertools.count())
+
+STOCK = 10
+QUANTITY = 2
+
+
+@pytest.fixture
+async def order(client) -> dict:
+  """
+  The body of an order of a new product
+  """
+  response = await client.post("/products", json={
+      "product_name": next(names), "price": 4.0, "stock": STOCK,
+  })
+  product_id = response.json()["id"]
+  return {
+      "user_id": 1,
+      "items": [{"product_id": product_id, "ordered_quantity": QUANTITY, "unit_price": 4.0}],
+      "total": 4.0 * QUANTITY,
+      "status": "Pending",
+  }
+
+
+async def order_count(client) -> int:
+  response = await client.get("/admin/orders", params={"limit": 1000})
+  return len(response.json()["items"])
+
+
+async def stock(client, order: dict) -> int:
+  product_id = order["items"][0]["product_id"]
+  return (await client.get(f"/products/{product_id}")).json()["stock"]
+
+
+async def test_replay_returns_the_first_response(client, order):
+  key = next(keys)
+  orders = await order_count(client)
+  first = await client.post("/admin/orders", json=order, headers={"Idempotency-Key": key})
+  second = await client.post("/admin/orders", json=order, headers={"Idempotency-Key": key})
+  assert first.status_code == second.status_code == 201
+  assert second.content == first.content
+  assert second.headers["Idempotent-Replayed"] == "true"
+  assert await order_count(client) == orders + 1
+  assert await stock(client, order) == STOCK - QUANTITY
+
+
+async def test_same_key_with_another_body_is_refused(client, order):
+  key = next(keys)
+  response = await client.post("/admin/orders", json=order, headers={"Idempotency-Key": key})
+  assert response.status_code == 201
+  orders = await order_count(client)
+  other = dict(order, status="Shipped")
+  response = await client.post("/admin/orders", json=other, headers={"Idempotency-Key": key})
+  assert response.status_code == 422
+  assert await order_count(client) == orders
+  assert await stock(client, order) == STOCK - QUANTITY
+
+
+async def test_concurrent_requests_with_the_same_key(client, order, monkeypatch):
+  key = next(keys)
+  orders = await order_count(client)
+  # both requests look for the key before any of them stores it: the second
+  # one to commit gets an IntegrityError and returns the stored response
+  stored_response = idempotency.stored_response
+  calls = []
+  both_checked = asyncio.Event()
+
+  async def checked_together(session, key, fingerprint):
+    calls.append(key)
+    if len(calls) <= 2:
+      if len(calls) == 2:
+        both_checked.set()
+      await both_checked.wait()
+    return await stored_response(session, key, fingerprint)
+
+  monkeypatch.setattr(main.idempotency, "stored_response", checked_together)
+  responses = await asyncio.gather(*(
+      client.post("/admin/orders", json=order, headers={"Idempotency-Key": key})
+      for _ in range(2)
+  ))
+  assert [response.status_code for response in responses] == [201, 201]
+  assert responses[0].json() == responses[1].json()
+  # the replay after the IntegrityError
+  assert len(calls) == 3
+  assert sum(response.headers.get("Idempotent-Replayed") == "true"
+             for response in responses) == 1
+  assert await order_count(client) == orders + 1
+  assert await stock(client, order) == STOCK - QUANTITY
+
+
+async def test_least_recently_used_key_is_forgotten(monkeypatch):
+  """
+  The apps without database keep at most IDEMPOTENCY_MAX_KEYS keys in their store
+  """
+  from app_with_doc_and_query_params import main as doc
+
+  monkeypatch.setattr(doc.idempotent_orders, "max_entries", 2)
+  product = doc.all_products.get(2)
+  order = {
+      "user_id": 1,
+      "items": [{"product_id": product.id, "ordered_quantity": 1, "unit_price": product.price}],
+      "total": product.price,
+      "status": "Pending",
+  }
+  transport = httpx.ASGITransport(app=doc.app)
+  async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+
+    async def send(key: str) -> int:
+      response = await client.post("/admin/orders", json=order, headers={"Idempotency-Key": key})
+      assert response.status_code == 201
+      return response.json()["id"]
+
+    first, second = await send("lru-1"), await send("lru-2")
+    # lru-1 is used again: lru-2 becomes the least recently used key
+    assert await send("lru-1") == first
+    await send("lru-3")
+    assert len(list(doc.idempotent_orders)) == 2
+    assert await send("lru-1") == first
+    assert await send("lru-2") != second
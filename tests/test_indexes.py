@@ -0,0 +1,38 @@
+"""
+The indexes declared on the models are added to the existing databases, unless
+an existing index already covers their columns
+"""
+
+from sqlalchemy import create_engine, text
+
+from app_with_db import db, models
+
+
+def missing_index_names(tmp_path, *statements: str) -> set:
+  engine = create_engine("sqlite:///" + str(tmp_path / "indexes.db"))
+  with engine.begin() as conn:
+    models.Base.metadata.create_all(conn)
+    for statement in statements:
+      conn.execute(text(statement))
+  with engine.connect() as conn:
+    names = {index.name for index in db.missing_indexes(conn)}
+  engine.dispose()
+  return names
+
+
+def test_missing_index_is_added(tmp_path):
+  assert missing_index_names(tmp_path) == set()
+  assert missing_index_names(tmp_path, "DROP INDEX ix_orderlines_order_id",
+                             "DROP INDEX ix_users_email") == {
+      "ix_orderlines_order_id", "ix_users_email"}
+
+
+def test_index_of_the_foreign_key_is_kept(tmp_path):
+  # the index created by MySQL for the foreign key orderlines.order_id
+  assert missing_index_names(tmp_path, "DROP INDEX ix_orderlines_order_id",
+                             "CREATE INDEX order_id ON orderlines (order_id)") == set()
+
+
+def test_unique_index_is_not_covered(tmp_path):
+  assert missing_index_names(tmp_path, "DROP INDEX ix_users_email",
+                             "CREATE INDEX email ON users (email)") == {"ix_users_email"}
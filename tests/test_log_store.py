@@ -0,0 +1,80 @@
+"""
+The log store keeps the data of a single worker across restarts, in snapshots
+and in the log segments written after them (see shared_store/log.py)
+"""
+
+import os
+
+import pytest
+
+from app_without_db.schemas import Product
+from shared_store import ListTable, LogStore, Tables
+
+pytestmark = pytest.mark.anyio
+
+
+def product(id_: int, stock: int = 10) -> Product:
+  return Product(id=id_, product_name=f"Stored {id_}", description="Store", price=2.0,
+                 category="Store", stock=stock)
+
+
+def open_tables(directory: str, rows: list) -> Tables:
+  store = LogStore(directory, fsync_interval=0.01, snapshot_every=3)
+  tables = Tables(store, {"products": (Product, ListTable(rows))})
+  tables.load()
+  return tables
+
+
+async def save(tables: Tables, *products: Product):
+  for row in products:
+    async with tables.write():
+      tables.save("products", row)
+
+
+def stored(tables: Tables) -> dict:
+  return {row.id: row.stock for row in tables.tables["products"][1]}
+
+
+def files(directory) -> list:
+  return sorted(os.listdir(directory))
+
+
+async def test_log_store_survives_restarts(tmp_path):
+  directory = str(tmp_path)
+  tables = open_tables(directory, [product(1), product(2)])
+  # the first snapshot holds the seed rows
+  assert files(directory) == ["log-1", "snapshot-1"]
+
+  # a snapshot after 3 writes: snapshot-2 holds the first 3 writes, log-2 the
+  # last two
+  await save(tables, product(3), product(1, stock=5), product(4), product(2, stock=7))
+  async with tables.write():
+    tables.remove("products", 4)
+  tables.close()
+  assert files(directory) == ["log-2", "snapshot-2"]
+
+  tables = open_tables(directory, [])
+  assert stored(tables) == {1: 5, 2: 7, 3: 10}
+  # the writes after a restart go to a new segment
+  await save(tables, product(5))
+  tables.close()
+  assert files(directory) == ["log-2", "log-3", "snapshot-2"]
+
+  # both segments written after the snapshot are replayed
+  tables = open_tables(directory, [])
+  assert stored(tables) == {1: 5, 2: 7, 3: 10, 5: 10}
+  assert tables.next_id("products") == 6
+  tables.close()
+
+
+async def test_log_store_ignores_a_torn_line(tmp_path):
+  directory = str(tmp_path)
+  tables = open_tables(directory, [product(1)])
+  await save(tables, product(1, stock=3))
+  tables.close()
+  # the process died while writing a line
+  with open(os.path.join(directory, "log-1"), "ab") as file:
+    file.write(b'["put","products",{"id":1,')
+  tables = open_tables(directory, [])
+  assert stored(tables) == {1: 3}
+  tables.close()
@@ -0,0 +1,55 @@
+"""
+The order endpoints load the orderlines of all the orders with one query:
+the number of queries must not grow with the number of orders
+"""
+
+import pytest
+
+from app_with_db import db
+from app_with_db.cache import order_cache
+
+from conftest import QueryCounter
+
+pytestmark = pytest.mark.anyio
+
+ORDERS = 5
+
+
+async def add_orders(client, product_name: str) -> list:
+  response = await client.post("/products", json={
+      "product_name": product_name, "price": 2.0, "stock": 100,
+  })
+  product_id = response.json()["id"]
+  ids = []
+  for i in range(ORDERS):
+    response = await client.post("/admin/orders", json={
+        "user_id": 1,
+        "items": [{"product_id": product_id, "ordered_quantity": 1, "unit_price": 2.0},
+                  {"product_id": product_id, "ordered_quantity": 2, "unit_price": 2.0}],
+        "total": 6.0,
+        "status": "Pending",
+    })
+    assert response.status_code == 201
+    ids.append(response.json()["id"])
+  return ids
+
+
+async def test_get_all_orders_queries(client):
+  await add_orders(client, "All orders")
+  with QueryCounter(db.get_engine()) as counter:
+    response = await client.get("/admin/orders", params={"limit": 100})
+  assert response.status_code == 200
+  assert len(response.json()["items"]) >= ORDERS
+  assert all(len(order["items"]) == 2 for order in response.json()["items"][-ORDERS:])
+  # the orders, then their orderlines (SELECT ... IN)
+  assert len(counter.statements) == 2, counter.statements
+
+
+async def test_get_order_by_id_queries(client):
+  order_id = (await add_orders(client, "Order by id"))[0]
+  order_cache.invalidate(order_id)
+  with QueryCounter(db.get_engine()) as counter:
+    response = await client.get(f"/admin/orders/{order_id}")
+  assert response.status_code == 200
+  assert len(response.json()["items"]) == 2
+  assert len(counter.statements) == 2, counter.statements
@@ -0,0 +1,118 @@
+"""
+Walking all the pages of a collection returns every row exactly once, and a
+malformed cursor is refused
+"""
+
+import base64
+import itertools
+import json
+
+import httpx
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+# each test adds its products in a new category
+categories = (f"Pagination {i}" for i in itertools.count())
+# prices which are not exact in single precision, several products per price
+PRICES = [19.99, 0.1, 3.3, 19.99, 7.77, 0.1, 3.3, 19.99, 12.01, 7.77, 0.3]
+
+
+async def walk(client, url: str, params: dict) -> list:
+  """
+  Return the ids of the items of all the pages
+  """
+  ids = []
+  cursor = ""
+  while True:
+    response = await client.get(url, params={**params, "cursor": cursor})
+    assert response.status_code == 200
+    page = response.json()
+    ids.extend(item["id"] for item in page["items"])
+    cursor = page["next"]
+    if cursor is None:
+      return ids
+
+
+@pytest.fixture
+async def category(client) -> str:
+  category = next(categories)
+  for i, price in enumerate(PRICES):
+    response = await client.post("/products", json={
+        "product_name": f"Page {i}", "price": price, "category": category, "stock": 1,
+    })
+    assert response.status_code == 201
+  return category
+
+
+async def product_ids(client, category: str) -> dict:
+  """
+  The prices of the products of the category, by id
+  """
+  response = await client.get("/products", params={"product_category": category,
+                                                   "limit": 1000})
+  return {product["id"]: product["price"] for product in response.json()["items"]}
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 100])
+async def test_products_sorted_on_the_id(client, category, limit):
+  prices = await product_ids(client, category)
+  assert len(prices) == len(PRICES)
+  ids = await walk(client, "/products", {"product_category": category, "limit": limit})
+  assert ids == sorted(prices)
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 100])
+async def test_products_sorted_on_the_price(client, category, limit):
+  prices = await product_ids(client, category)
+  assert len(prices) == len(PRICES)
+  ids = await walk(client, "/products",
+                   {"product_category": category, "sort": "price", "limit": limit})
+  assert ids == sorted(prices, key=lambda id_: (prices[id_], id_))
+
+
+async def test_users(client):
+  for i in range(5):
+    response = await client.post("/users", json={
+        "username": f"page.{i}", "email": f"page.{i}@mail.fr", "password": "secret",
+    })
+    assert response.status_code == 201
+  ids = await walk(client, "/admin/users", {"limit": 2})
+  assert ids == sorted(set(ids))
+  assert len(ids) == len((await client.get("/admin/users", params={"limit": 1000})).json()["items"])
+
+
+def cursor_of(value) -> str:
+  return base64.urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+
+@pytest.mark.parametrize("cursor", [
+    "not a cursor", "%%%", cursor_of({"id": 1}), cursor_of([]), cursor_of(["1"]),
+    cursor_of([True]), cursor_of([1, 2]), cursor_of([None]),
+])
+@pytest.mark.parametrize("url", ["/products", "/admin/users", "/admin/orders"])
+async def test_malformed_cursor(client, url, cursor):
+  response = await client.get(url, params={"cursor": cursor})
+  assert response.status_code == 400
+
+
+async def test_malformed_price_cursor(client):
+  response = await client.get("/products", params={"sort": "price", "cursor": cursor_of([1])})
+  assert response.status_code == 400
+  response = await client.get("/products", params={"sort": "price",
+                                                   "cursor": cursor_of(["1.5", 1])})
+  assert response.status_code == 400
+
+
+@pytest.mark.parametrize("sort", ["id", "price"])
+async def test_products_of_the_api_without_database(sort):
+  from app_with_doc_and_query_params import main
+
+  transport = httpx.ASGITransport(app=main.app)
+  async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+    ids = await walk(client, "/products", {"sort": sort, "limit": 2})
+  products = list(main.all_products)
+  assert len(products) > 2
+  key = (lambda product: product.id) if sort == "id" else (lambda product: (product.price,
+                                                                          product.id))
+  assert ids == [product.id for product in sorted(products, key=key)]
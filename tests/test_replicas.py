@@ -0,0 +1,148 @@
+"""
+The reads of the GET requests go to the replicas, the writes and the reads
+which are cached go to the primary (see app_with_db/replicas.py). Two SQLite
+databases stand in for the replicas.
+"""
+
+import os
+
+import pytest
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app_with_db import db, models, replicas
+
+from conftest import QueryCounter
+
+pytestmark = pytest.mark.anyio
+
+
+def sqlite_url(path: str) -> str:
+  return "sqlite+aiosqlite:///" + path
+
+
+@pytest.fixture
+async def replica_set(client, tmp_path):
+  """
+  Two empty replicas, used by the app during the test
+  """
+  engines = [create_async_engine(sqlite_url(str(tmp_path / f"replica-{i}.db"))) for i in (1, 2)]
+  for engine in engines:
+    async with engine.begin() as conn:
+      await conn.run_sync(models.Base.metadata.create_all)
+  replicas.replica_set = replicas.ReplicaSet(engines)
+  yield replicas.replica_set
+  replicas.replica_set = None
+  for engine in engines:
+    await engine.dispose()
+
+
+class Counters:
+  """
+  Count the queries of the primary and of each replica in a with block
+  """
+
+  def __init__(self, replica_set):
+    self.primary = QueryCounter(db.get_engine())
+    self.replicas = [QueryCounter(replica.engine) for replica in replica_set.replicas]
+
+  def __enter__(self):
+    for counter in [self.primary] + self.replicas:
+      counter.__enter__()
+    return self
+
+  def __exit__(self, *args):
+    for counter in [self.primary] + self.replicas:
+      counter.__exit__(*args)
+
+  def replica_queries(self) -> int:
+    return sum(len(counter.statements) for counter in self.replicas)
+
+
+async def test_get_requests_read_the_replicas(client, replica_set):
+  with Counters(replica_set) as counters:
+    for _ in range(4):
+      assert (await client.get("/admin/users")).status_code == 200
+  assert counters.primary.statements == []
+  # in turn
+  assert [len(counter.statements) for counter in counters.replicas] == [2, 2]
+  assert [replica.reads for replica in replica_set.replicas] == [2, 2]
+
+
+async def test_writes_go_to_the_primary(client, replica_set):
+  with Counters(replica_set) as counters:
+    response = await client.post("/products", json={
+        "product_name": "Primary", "price": 3.0, "stock": 10,
+    })
+    assert response.status_code == 201
+    product = response.json()
+    product_id = product.pop("id")
+    response = await client.put(f"/products/{product_id}", json={**product, "stock": 5})
+    assert response.status_code == 200
+    response = await client.delete(f"/products/{product_id}")
+    assert response.status_code == 204
+  assert counters.primary.statements
+  assert counters.replica_queries() == 0
+
+
+async def test_cached_reads_go_to_the_primary(client, replica_set):
+  # the replicas are empty: they lag behind the primary
+  response = await client.post("/products", json={
+      "product_name": "Not replicated", "price": 3.0, "stock": 10,
+  })
+  product_id = response.json()["id"]
+  with Counters(replica_set) as counters:
+    response = await client.get("/products", params={"product_name": "Not replicated"})
+    assert [product["id"] for product in response.json()["items"]] == [product_id]
+    assert (await client.get(f"/products/{product_id}")).status_code == 200
+  assert counters.replica_queries() == 0
+
+
+async def test_select_for_update_goes_to_the_primary(client, replica_set):
+  token = replicas.replica_reads.set(True)
+  try:
+    async with db.async_session() as session:
+      session = session.sync_session
+      primary = db.get_engine().sync_engine
+      assert session.get_bind(clause=select(models.Product)) is not primary
+      assert session.get_bind(clause=select(models.Product).with_for_update()) is primary
+  finally:
+    replicas.replica_reads.reset(token)
+
+
+async def test_session_which_wrote_stays_on_the_primary(client, replica_set):
+  token = replicas.replica_reads.set(True)
+  try:
+    with Counters(replica_set) as counters:
+      async with db.async_session() as session:
+        await session.execute(update(models.Product).where(models.Product.id == -1)
+                              .values(stock=0))
+        await session.execute(select(models.Product).where(models.Product.id == -1))
+        await session.rollback()
+  finally:
+    replicas.replica_reads.reset(token)
+  assert len(counters.primary.statements) == 2
+  assert counters.replica_queries() == 0
+
+
+async def test_failing_replica_is_ejected_then_admitted_again(client, tmp_path):
+  # the directory of the database does not exist yet: SQLite cannot open it
+  directory = tmp_path / "later"
+  engine = create_async_engine(sqlite_url(str(directory / "replica.db")))
+  replicas.replica_set = replica_set = replicas.ReplicaSet([engine])
+  try:
+    await replica_set.check()
+    replica = replica_set.replicas[0]
+    assert not replica.healthy
+    assert replica.ejections == 1
+    # without a healthy replica, the reads go to the primary
+    assert replica_set.choose() is None
+    assert (await client.get("/admin/users")).status_code == 200
+
+    os.makedirs(directory)
+    await replica_set.check()
+    assert replica.healthy
+    assert replica_set.choose() is engine
+  finally:
+    replicas.replica_set = None
+    await engine.dispose()
@@ -0,0 +1,64 @@
+"""
+The SQLite store is shared by several workers of app_without_db: the stock
+they sell is checked under the lock of the file
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+from app_without_db.schemas import Order, Product
+from shared_store import SQLiteStore
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ORDERS_PER_WORKER = 100
+# a worker sending ORDERS_PER_WORKER orders of app_without_db, once the go
+# file exists. It prints the number of orders accepted.
+WORKER = """
+import os, sys, time
+from fastapi.testclient import TestClient
+from app_without_db.main import app, all_products
+
+ready, go, orders = sys.argv[1], sys.argv[2], int(sys.argv[3])
+product = next(product for product in all_products if product.id == 1)
+order = {"user_id": 1, "status": "Pending", "total": product.price,
+         "items": [{"product_id": 1, "ordered_quantity": 1, "unit_price": product.price}]}
+open(ready, "w").close()
+while not os.path.exists(go):
+  time.sleep(0.01)
+with TestClient(app) as client:
+  print(sum(client.post("/admin/orders", json=order).status_code == 200 for _ in range(orders)))
+"""
+
+
+def test_two_workers_do_not_oversell(tmp_path):
+  path = str(tmp_path / "store.db")
+  env = dict(os.environ, STORE_URL="sqlite:///" + path)
+  go = tmp_path / "go"
+  workers = [subprocess.Popen([sys.executable, "-c", WORKER, str(tmp_path / f"ready-{i}"),
+                               str(go), str(ORDERS_PER_WORKER)],
+                              cwd=ROOT, env=env, stdout=subprocess.PIPE, text=True)
+             for i in (1, 2)]
+  # both workers have loaded the store before ordering
+  deadline = time.monotonic() + 60
+  while not all((tmp_path / f"ready-{i}").exists() for i in (1, 2)):
+    assert time.monotonic() < deadline
+    assert all(worker.poll() is None for worker in workers)
+    time.sleep(0.01)
+  go.touch()
+  accepted = []
+  for worker in workers:
+    output, _ = worker.communicate(timeout=120)
+    assert worker.returncode == 0
+    accepted.append(int(output))
+
+  store = SQLiteStore(path)
+  rows = store.load({"products": [], "orders": []}, {"products": Product, "orders": Order})
+  store.close()
+  stock = next(row for row in rows["products"] if row.id == 1).stock
+  # the 150 products of the seed are sold to the two workers, not more
+  assert sum(accepted) == 150
+  assert all(accepted)
+  assert stock == 0